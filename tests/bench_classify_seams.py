@@ -0,0 +1,68 @@
+#! /usr/bin/env python2
+
+"""Benchmark seam comparison in weld
+
+Builds two specs of 10,000 seams each, differing in a tenth of them, and
+times classify_seams() together with the set and sort operations that lean
+on Seam.__eq__, __hash__ and __lt__.
+
+Run it from the top of the weld checkout:
+
+    python2 tests/bench_classify_seams.py [number-of-seams]
+"""
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from welded.db import Base, Seam
+from welded.utils import classify_seams
+
+def make_seams(nr_seams, changed_every):
+    base = Base()
+    base.name = "base"
+    base.uri = "file:///nowhere/base"
+    for i in range(nr_seams):
+        s = Seam()
+        s.base = base
+        s.source = "src/dir%d"%i
+        if (i%changed_every == 0):
+            s.dest = "moved/dir%d"%i
+        else:
+            s.dest = "dest/dir%d"%i
+        base.seams.append(s)
+    return base.seams
+
+def timed(what, fn, repeat = 5):
+    best = None
+    for i in range(repeat):
+        start = time.time()
+        rv = fn()
+        taken = time.time() - start
+        if (best is None or taken < best):
+            best = taken
+    print "%-32s %8.2f ms"%(what, best * 1000.0)
+    return rv
+
+def main(args):
+    if (len(args) > 0):
+        nr_seams = int(args[0])
+    else:
+        nr_seams = 10000
+
+    old_seams = make_seams(nr_seams, nr_seams)
+    new_seams = make_seams(nr_seams, 10)
+    print "%d seams, %d old and new instances"%(nr_seams, len(old_seams) + len(new_seams))
+
+    (deleted, changed, created) = timed("classify_seams", lambda: classify_seams(old_seams, new_seams))
+    print " -> %d deleted, %d changed, %d created"%(len(deleted), len(changed), len(created))
+    timed("set(old) & set(new)", lambda: set(old_seams) & set(new_seams))
+    timed("sorted(new)", lambda: sorted(new_seams))
+    timed("old == new (pairwise)", lambda: [ a == b for (a, b) in zip(old_seams, new_seams) ])
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
+
+# End file.
@@ -0,0 +1,92 @@
+#! /usr/bin/env python2
+
+"""Benchmark how long weld takes to start up
+
+Times `weld help`, `weld look`, `weld status` and `weld status --offline`
+as fresh processes, taking the best of several runs of each, with a bare
+`python -c pass` for comparison. Each command must succeed. By default
+this is done in a throwaway weld with no bases, whose origin is a bare
+repository beside it; give the path of a weld to time it there instead.
+
+Run it from the top of the weld checkout:
+
+    python2 tests/bench_startup.py [weld-directory [runs]]
+"""
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+top_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+weld_cmd = [ sys.executable, os.path.join(top_dir, 'weld') ]
+
+EMPTY_WELD = """<?xml version="1.0" ?>
+<weld name="bench">
+</weld>
+"""
+
+def git(args, cwd, env):
+    with open(os.devnull, 'w') as devnull:
+        subprocess.check_call([ 'git' ] + args, cwd = cwd, env = env,
+                              stdout = devnull, stderr = devnull)
+
+def make_weld(where):
+    xml_file = os.path.join(where, 'bench.xml')
+    with open(xml_file, 'w') as f:
+        f.write(EMPTY_WELD)
+    weld_dir = os.path.join(where, 'weld')
+    os.mkdir(weld_dir)
+    env = os.environ.copy()
+    for v in ('AUTHOR', 'COMMITTER'):
+        env.setdefault('GIT_%s_NAME'%v, 'bench')
+        env.setdefault('GIT_%s_EMAIL'%v, 'bench@example.com')
+    subprocess.check_call(weld_cmd + [ 'init', xml_file ], cwd = weld_dir, env = env,
+                          stdout = open(os.devnull, 'w'))
+    # So that "weld status" has an origin to ask.
+    origin_dir = os.path.join(where, 'origin.git')
+    git([ 'init', '--bare', origin_dir ], where, env)
+    git([ 'remote', 'add', 'origin', origin_dir ], weld_dir, env)
+    git([ 'push', '-u', 'origin', 'HEAD' ], weld_dir, env)
+    return weld_dir
+
+def timed(what, cmd, cwd, runs):
+    best = None
+    with open(os.devnull, 'w') as devnull:
+        for i in range(runs):
+            start = time.time()
+            rv = subprocess.call(cmd, cwd = cwd, stdout = devnull, stderr = devnull)
+            taken = time.time() - start
+            if (rv != 0):
+                raise Exception("'%s' failed with exit code %d"%(' '.join(cmd), rv))
+            if (best is None or taken < best):
+                best = taken
+    print "%-32s %8.2f ms"%(what, best * 1000.0)
+
+def main(args):
+    tmp_dir = None
+    if (len(args) > 0):
+        weld_dir = os.path.abspath(args[0])
+    else:
+        tmp_dir = tempfile.mkdtemp(prefix = 'weld_bench')
+        weld_dir = make_weld(tmp_dir)
+    if (len(args) > 1):
+        runs = int(args[1])
+    else:
+        runs = 10
+
+    try:
+        print "Best of %d runs in %s"%(runs, weld_dir)
+        timed("python -c pass", [ sys.executable, '-c', 'pass' ], weld_dir, runs)
+        for verb in ([ 'help' ], [ 'look' ], [ 'status' ], [ 'status', '--offline' ]):
+            timed("weld %s"%' '.join(verb), weld_cmd + verb, weld_dir, runs)
+    finally:
+        if tmp_dir is not None:
+            shutil.rmtree(tmp_dir)
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
+
+# End file.
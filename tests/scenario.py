@@ -0,0 +1,252 @@
+#! /usr/bin/env python2
+
+"""A small scenario weld for the tests
+
+Builds, in a transient directory, two bases - project124 (with "one" and
+"two") and igniting_duck (with "one", "two" and "three") - each a bare
+repository with a working clone beside it, and a weld of them with a bare
+origin of its own:
+
+    <base name="project124">      seam dest="124"
+    <base name="igniting_duck">   seam source="one" dest="one-duck"
+                                  seam source="two" dest="two-duck"
+
+Unlike test1.py, this needs nothing from the network, so the tests built on
+it can be run anywhere weld can.
+"""
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+from support_for_tests import *
+
+# Run weld with the Python we're running under.
+WELD = [ sys.executable, WELD_CMD ]
+
+weld_xml_file = """\
+<?xml version="1.0" ?>
+<weld name="scenario">
+  <origin uri="file://{repo_base}/weld.git" />
+  <base name="project124" uri="file://{repo_base}/project124.git"/>
+    <seam base="project124" dest="124" />
+  <base name="igniting_duck" uri="file://{repo_base}/igniting_duck.git" />
+    <seam base="igniting_duck" source="one" dest="one-duck" />
+    <seam base="igniting_duck" source="two" dest="two-duck" />
+</weld>
+"""
+
+BASES = { 'project124' : [ 'one', 'two' ],
+          'igniting_duck' : [ 'one', 'two', 'three' ] }
+
+def set_git_identity():
+    for who in ('AUTHOR', 'COMMITTER'):
+        os.environ.setdefault('GIT_%s_NAME'%who, 'Weld Tests')
+        os.environ.setdefault('GIT_%s_EMAIL'%who, 'weld-tests@example.com')
+
+def run_weld(args, cwd, verbose=True):
+    """Run weld with the list 'args' in 'cwd'.
+
+    Returns ( exit code, output ), with stdout and stderr folded together.
+    """
+    return captured_cmd_seq(WELD + args, verbose=verbose, cwd=cwd)
+
+def weld_ok(args, cwd, verbose=True):
+    """Run weld with the list 'args' in 'cwd', and return its output.
+
+    Raises GiveUp if it fails.
+    """
+    rv, out = run_weld(args, cwd, verbose=verbose)
+    if rv:
+        raise GiveUp('weld %s failed with exit code %d:\n%s'%(' '.join(args), rv, out))
+    return out
+
+def git_out(args, cwd):
+    """Run git with the list 'args' in 'cwd', and return its output, stripped.
+    """
+    return subprocess.check_output([ 'git' ] + args, cwd=cwd).strip()
+
+def read_file(path):
+    with open(path, 'r') as f:
+        return f.read()
+
+def write_file(path, content):
+    d = os.path.dirname(path)
+    if d and not os.path.exists(d):
+        os.makedirs(d)
+    with open(path, 'w') as f:
+        f.write(content)
+
+def verbs(weld_dir):
+    """Return the verbs "weld look" offers in 'weld_dir'.
+    """
+    out = weld_ok([ 'look' ], weld_dir, verbose=False)
+    return [ l.strip() for l in out.splitlines()
+             if l.strip() and l.strip() != 'No verbs available.' ]
+
+def drive(weld_dir, first=None):
+    """Step, commit and finish the operation in progress in 'weld_dir'
+    until it is done.
+
+    If 'first' is given, stop as soon as it is one of the verbs on offer
+    (without doing it), and return True; otherwise return False once the
+    operation has finished.
+    """
+    for i in range(50):
+        v = verbs(weld_dir)
+        if first is not None and first in v:
+            return True
+        if 'finish' in v:
+            weld_ok([ 'finish' ], weld_dir)
+        elif 'commit' in v:
+            weld_ok([ 'commit' ], weld_dir)
+        elif 'step' in v:
+            weld_ok([ 'step' ], weld_dir)
+        else:
+            return False
+    raise GiveUp('The operation in %s never finished'%weld_dir)
+
+def commit_headers(where, rev='HEAD'):
+    """Return the "X-Weld-State:" lines in the message of 'rev' in 'where'.
+    """
+    message = git_out([ 'log', '-1', '--format=%B', rev ], where)
+    return [ l.strip() for l in message.splitlines() if l.startswith('X-Weld-State:') ]
+
+def tree_files(where, rev, path=None):
+    """Return a dictionary of file name -> content for 'rev' in 'where'
+    (under 'path', if given, with names relative to it).
+    """
+    cmd = [ 'ls-tree', '-r', '--name-only', rev ]
+    if path is not None:
+        cmd.append(path)
+    files = { }
+    for name in git_out(cmd, where).splitlines():
+        rel = name
+        if path is not None:
+            rel = os.path.relpath(name, path)
+        files[rel] = git_out([ 'show', '%s:%s'%(rev, name) ], where)
+    return files
+
+class Scenario(object):
+    """The scenario weld and its bases, in a directory of their own.
+    """
+
+    def __init__(self, keep=False):
+        self.keep = keep
+        self.where = None
+        self.weld_dir = None
+
+    def __enter__(self):
+        set_git_identity()
+        self.where = os.path.realpath(tempfile.mkdtemp(prefix='weld_test'))
+        return self
+
+    def __exit__(self, etype, value, tb):
+        if self.keep or etype is not None:
+            print 'Test directory kept in %s'%self.where
+        else:
+            shutil.rmtree(self.where)
+        return False
+
+    def base_src(self, base_name):
+        """The working clone of 'base_name', which pushes to its bare repository.
+        """
+        return os.path.join(self.where, 'src-%s'%base_name)
+
+    def base_clone(self, base_name):
+        """The weld's own clone of 'base_name', in .weld/bases.
+        """
+        return os.path.join(self.weld_dir, '.weld', 'bases', base_name)
+
+    def make_base(self, base_name, subdirs):
+        bare = os.path.join(self.where, '%s.git'%base_name)
+        git('init -q --bare %s'%bare, verbose=False)
+        src = self.base_src(base_name)
+        git('clone -q %s %s'%(bare, src), verbose=False)
+        for name in subdirs:
+            write_file(os.path.join(src, name, 'Makefile'), 'all: %s\n'%name)
+            write_file(os.path.join(src, name, '%s.c'%name),
+                       '// This is %s/%s\n'%(base_name, name))
+        git('add -A', cwd=src, verbose=False)
+        git('commit -q -m "Initial commit of %s"'%base_name, cwd=src, verbose=False)
+        git('push -q origin HEAD:master', cwd=src, verbose=False)
+
+    def change_base(self, base_name, path, content, message):
+        """Change 'path' in 'base_name', and push it to the bare repository.
+        """
+        src = self.base_src(base_name)
+        write_file(os.path.join(src, path), content)
+        git('add -A', cwd=src, verbose=False)
+        git('commit -q -m "%s"'%message, cwd=src, verbose=False)
+        git('push -q origin HEAD:master', cwd=src, verbose=False)
+        return git_out([ 'rev-parse', 'HEAD' ], src)
+
+    def change_weld(self, path, content, message):
+        """Change 'path' in the weld, and commit it.
+        """
+        write_file(os.path.join(self.weld_dir, path), content)
+        git('add -A', cwd=self.weld_dir, verbose=False)
+        git('commit -q -m "%s"'%message, cwd=self.weld_dir, verbose=False)
+        return git_out([ 'rev-parse', 'HEAD' ], self.weld_dir)
+
+    def build(self, pull=True, pull_opts=()):
+        """Build the bases and the weld, and (if 'pull') pull each base
+        into it with 'pull_opts'.
+
+        Returns the weld directory.
+        """
+        for base_name in sorted(BASES):
+            self.make_base(base_name, BASES[base_name])
+        git('init -q --bare %s'%os.path.join(self.where, 'weld.git'), verbose=False)
+        xml = os.path.join(self.where, 'scenario.xml')
+        write_file(xml, weld_xml_file.format(repo_base=self.where))
+        self.weld_dir = os.path.join(self.where, 'weld')
+        os.mkdir(self.weld_dir)
+        weld_ok([ 'init', xml ], self.weld_dir)
+        git('push -q origin HEAD:master', cwd=self.weld_dir, verbose=False)
+        git('branch -q --set-upstream-to=origin/master', cwd=self.weld_dir, verbose=False)
+        weld_ok([ 'base-pull', '_all' ], self.weld_dir)
+        if pull:
+            for base_name in sorted(BASES):
+                self.pull(base_name, pull_opts)
+        return self.weld_dir
+
+    def pull(self, base_name, opts=()):
+        """"weld pull" 'base_name', driving it to the end.
+        """
+        weld_ok(list(opts) + [ 'pull', base_name ], self.weld_dir)
+        drive(self.weld_dir)
+
+    def push(self, base_name, opts=()):
+        """"weld push" 'base_name', driving it to the end.
+        """
+        weld_ok(list(opts) + [ 'push', base_name ], self.weld_dir)
+        drive(self.weld_dir)
+
+def run_test(test, doc):
+    """The main program of a test script: run 'test(keep)', and report.
+    """
+    args = sys.argv[1:]
+    keep = False
+    while args:
+        word = args.pop(0)
+        if word in ('-h', '-help', '--help'):
+            print doc
+            return
+        elif word == '-keep':
+            keep = True
+        else:
+            print 'Unexpected command line argument %r'%word
+            sys.exit(1)
+    try:
+        test(keep)
+        print '\nGREEN light\n'
+    except Exception as e:
+        print
+        traceback.print_exc()
+        print '\nRED light\n'
+        sys.exit(1)
+
+# vim: set tabstop=8 softtabstop=4 shiftwidth=4 expandtab:
@@ -0,0 +1,110 @@
+#! /usr/bin/env python2
+
+"""Test picking up a pull started by an older weld
+
+Older welds kept the state of an operation as a pickled dictionary in
+.weld/state/data.bin, and each verb as a little Python file in
+.weld/state/verbs (and pending_verbs). Start a pull, turn its state into
+that layout (dropping the fields older welds didn't have), and check that
+the pull can be both aborted and finished.
+
+    python2 tests/test_legacy_state.py [-keep]
+"""
+
+import json
+import os
+import pickle
+import shutil
+import sys
+
+from scenario import *
+
+sys.path.insert(0, PARENT_DIR)
+import welded.statestore as statestore
+
+# Fields that older welds didn't write.
+NEW_FIELDS = ( 'work_root', 'worktree', 'content_aware', 'transplant',
+               'plan', 'seam_stats' )
+
+VERB_FILE = """\
+import ops
+def go(spec, opts):
+ import {0}
+ {0}.{1}(spec, opts)
+
+"""
+
+def make_legacy(weld_dir):
+    """Rewrite the state of the operation in progress in 'weld_dir' as an
+    older weld would have left it.
+    """
+    state_dir = os.path.join(weld_dir, '.weld', 'state')
+    with open(os.path.join(state_dir, 'verbs.json'), 'r') as f:
+        table = json.load(f)
+    for (which, dir_name) in (('current', 'verbs'), ('pending', 'pending_verbs')):
+        d = os.path.join(state_dir, dir_name)
+        os.mkdir(d)
+        for verb, (module, fn) in table[which].items():
+            write_file(os.path.join(d, '%s.py'%verb), VERB_FILE.format(module, fn))
+    os.remove(os.path.join(state_dir, 'verbs.json'))
+
+    db_file = os.path.join(state_dir, 'state.db')
+    data = dict((k, v) for (k, v) in statestore.read(db_file).items()
+                if k not in NEW_FIELDS)
+    # StateLists pickle as plain lists.
+    with open(os.path.join(state_dir, 'data.bin'), 'w') as f:
+        f.write(pickle.dumps(data))
+    os.remove(db_file)
+
+def start_legacy_pull(s, n):
+    w = s.weld_dir
+    s.change_base('project124', 'one/one.c', '// project124/one, version %d\n'%n,
+                  'Change one, version %d'%n)
+    weld_ok([ 'base-pull', 'project124' ], w)
+    weld_ok([ 'pull', 'project124' ], w)
+    assert 'commit' in verbs(w)
+    make_legacy(w)
+    assert not os.path.exists(os.path.join(w, '.weld', 'state', 'verbs.json'))
+
+def test(keep):
+    with Scenario(keep=keep) as s:
+        s.build()
+        w = s.weld_dir
+        before = git_out([ 'rev-parse', 'HEAD' ], w)
+
+        banner('Abort a pull left by an older weld')
+        start_legacy_pull(s, 1)
+        out = weld_ok([ 'status' ], w)
+        assert 'Part way through a weld command - pull_step' in out
+        v = verbs(w)
+        assert 'commit' in v and 'abort' in v
+        weld_ok([ 'abort' ], w)
+        assert verbs(w) == [ ]
+        assert not os.path.exists(os.path.join(w, '.weld', 'state', 'data.bin'))
+        assert git_out([ 'rev-parse', 'HEAD' ], w) == before
+        assert git_out([ 'rev-parse', '--abbrev-ref', 'HEAD' ], w) == 'master'
+        assert git_out([ 'status', '--porcelain' ], w) == ''
+
+        banner('Finish a pull left by an older weld')
+        start_legacy_pull(s, 2)
+        drive(w)
+        assert verbs(w) == [ ]
+        assert read_file(os.path.join(w, '124', 'one', 'one.c')) == '// project124/one, version 2\n'
+        head = git_out([ 'rev-parse', 'HEAD' ], s.base_clone('project124'))
+        assert commit_headers(w) == [
+            'X-Weld-State: Merged project124/%s [[null, "124"]]'%head ]
+        assert git_out([ 'status', '--porcelain' ], w) == ''
+
+        banner('With only the state left, we can still abort')
+        start_legacy_pull(s, 3)
+        for d in ('verbs', 'pending_verbs'):
+            shutil.rmtree(os.path.join(w, '.weld', 'state', d))
+        assert verbs(w) == [ 'abort' ]
+        weld_ok([ 'abort' ], w)
+        assert verbs(w) == [ ]
+        assert git_out([ 'rev-parse', '--abbrev-ref', 'HEAD' ], w) == 'master'
+
+if __name__ == '__main__':
+    run_test(test, __doc__)
+
+# vim: set tabstop=8 softtabstop=4 shiftwidth=4 expandtab:
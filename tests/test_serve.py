@@ -0,0 +1,141 @@
+#! /usr/bin/env python2
+
+"""Test "weld serve"
+
+Start a server for the scenario weld, and check that "weld look" and the
+verbs of a pull are handed to it - with their output and exit code coming
+back as they should - while commands it mustn't run are declined and run
+by the client instead. Then stop it with "weld serve stop".
+
+    python2 tests/test_serve.py [-keep]
+"""
+
+import json
+import os
+import subprocess
+import sys
+import time
+
+from scenario import *
+
+sys.path.insert(0, PARENT_DIR)
+import welded.layout as layout
+import welded.server as server
+
+def wait_for(what, check, timeout=30.0):
+    end = time.time() + timeout
+    while not check():
+        if time.time() > end:
+            raise GiveUp('Gave up waiting for %s'%what)
+        time.sleep(0.1)
+
+def server_up(weld_dir, proc):
+    if proc.poll() is not None:
+        raise GiveUp('weld serve exited with %d'%proc.returncode)
+    sock = server.connect(weld_dir)
+    if sock is None:
+        return False
+    # An empty request, which the server ignores.
+    server.send_frame(sock, 'q')
+    sock.close()
+    return True
+
+def request(weld_dir, argv):
+    """Send 'argv' to the server ourselves, and return the frames that come
+    back: ( kind, data ) for each, ending with the exit code or declined.
+    """
+    sock = server.connect(weld_dir)
+    assert sock is not None
+    try:
+        server.send_frame(sock, 'r', json.dumps({ 'argv' : argv,
+                                                  'cwd' : weld_dir,
+                                                  'env' : dict(os.environ) }))
+        frames = [ ]
+        while True:
+            (kind, data) = server.read_frame(sock)
+            if kind is None:
+                raise GiveUp('The server went away during "weld %s"'%' '.join(argv))
+            frames.append((kind, data))
+            if kind in ('x', 'd'):
+                return frames
+    finally:
+        sock.close()
+
+def test(keep):
+    with Scenario(keep=keep) as s:
+        s.build()
+        w = s.weld_dir
+        log_file = os.path.join(s.where, 'serve.log')
+        sock_path = layout.server_socket(w)
+
+        banner('Start "weld serve"')
+        with open(log_file, 'w') as log:
+            proc = subprocess.Popen(WELD + [ '-v', 'serve' ], cwd=w,
+                                    stdout=log, stderr=subprocess.STDOUT)
+        try:
+            wait_for('the server to start', lambda: server_up(w, proc))
+            rv, out = run_weld([ 'serve' ], w)
+            assert rv != 0 and 'There is already a weld server' in out
+
+            banner('Start a pull, and look at it through the server')
+            s.change_base('project124', 'one/one.c', '// project124/one, served\n',
+                          'Change one')
+            weld_ok([ 'base-pull', 'project124' ], w)
+            weld_ok([ 'pull', 'project124' ], w)
+            out = weld_ok([ 'look' ], w)
+            assert 'commit' in out.split()
+            assert '> weld look' in read_file(log_file)
+
+            frames = request(w, [ 'look' ])
+            assert frames[-1] == ('x', '0')
+            output = ''.join(data for (kind, data) in frames if kind == 'o')
+            assert 'commit' in output.split() and 'abort' in output.split()
+
+            banner('A failing verb comes back with its exit code')
+            rv, out = run_weld([ 'nonesuch' ], w)
+            print out
+            assert rv == 1
+            assert "You see no 'nonesuch' here" in out
+            assert '> weld nonesuch' in read_file(log_file)
+            assert request(w, [ 'nonesuch' ])[-1] == ('x', '1')
+
+            banner('Commands the server mustn\'t run are declined')
+            for argv in ([ 'status' ], [ 'pull', 'igniting_duck' ],
+                         [ '-e', 'commit' ], [ '--no-such-option' ]):
+                assert request(w, argv) == [ ('d', '') ], argv
+            # .. and so run by the client.
+            out = weld_ok([ 'status' ], w)
+            assert 'Part way through a weld command - pull_step' in out
+            assert 'commit' in verbs(w)
+
+            banner('Finish the pull through the server')
+            drive(w)
+            assert verbs(w) == [ ]
+            assert (read_file(os.path.join(w, '124', 'one', 'one.c')) ==
+                    '// project124/one, served\n')
+            head = git_out([ 'rev-parse', 'HEAD' ], s.base_clone('project124'))
+            assert commit_headers(w) == [
+                'X-Weld-State: Merged project124/%s [[null, "124"]]'%head ]
+            assert git_out([ 'status', '--porcelain' ], w) == ''
+
+            banner('The server listens again once the operation is done')
+            wait_for('the server to listen again', lambda: server_up(w, proc))
+
+            banner('Stop it')
+            weld_ok([ 'serve', 'stop' ], w)
+            wait_for('the server to stop', lambda: proc.poll() is not None)
+            assert proc.returncode == 0
+            assert 'weld serve: stopped' in read_file(log_file)
+            assert not os.path.exists(sock_path)
+            out = weld_ok([ 'serve', 'stop' ], w)
+            assert 'No weld server is running' in out
+        finally:
+            if proc.poll() is None:
+                proc.kill()
+                proc.wait()
+            print read_file(log_file)
+
+if __name__ == '__main__':
+    run_test(test, __doc__)
+
+# vim: set tabstop=8 softtabstop=4 shiftwidth=4 expandtab:
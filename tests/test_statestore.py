@@ -0,0 +1,273 @@
+#! /usr/bin/env python2
+
+"""Test the store that keeps the state of a pull or push
+
+Checks that every kind of field survives a round trip through the store,
+that changes to the list fields - by slice, append and index assignment -
+are written as they should be (and only as much as they need be), and that
+a data.bin pickled by an older weld can still be read.
+
+    python2 tests/test_statestore.py [-keep]
+"""
+
+import os
+import pickle
+import shutil
+import sqlite3
+import sys
+import tempfile
+
+from scenario import *
+
+sys.path.insert(0, PARENT_DIR)
+import welded.db as db
+import welded.layout as layout
+import welded.ops as ops
+import welded.statestore as statestore
+
+from welded.utils import GiveUp as WeldGiveUp
+
+def make_base():
+    base = db.Base()
+    base.name = 'project124'
+    base.uri = 'file:///somewhere/project124'
+    base.branch = 'master'
+    for (source, dest) in ((None, '124'), ('two', 'two-124')):
+        seam = db.Seam()
+        seam.base = base
+        seam.source = source
+        seam.dest = dest
+        base.seams.append(seam)
+    return base
+
+def check_base(base):
+    assert isinstance(base, db.Base)
+    assert base.name == 'project124'
+    assert base.uri == 'file:///somewhere/project124'
+    assert base.branch == 'master' and base.tag is None and base.rev is None
+    assert [ (s.get_source(), s.get_dest()) for s in base.get_seams() ] == [
+        ('.', '124'), ('two', 'two-124') ]
+    for s in base.get_seams():
+        assert s.base is base
+        assert s.key() == (s.source, s.dest, 'project124', None)
+
+def rows(db_file, name):
+    conn = sqlite3.connect(db_file)
+    try:
+        return conn.execute("SELECT pos FROM items WHERE name = ? ORDER BY pos",
+                            (name,)).fetchall()
+    finally:
+        conn.close()
+
+def test_round_trip(where):
+    banner('Round trip of every kind of field')
+    db_file = os.path.join(where, 'state.db')
+    base = make_base()
+    fields = { 'cmd' : 'pull_step',
+               'next_idx_to_merge' : 3,
+               'last_idx_merged' : -1,
+               'verbose' : False,
+               'edit_commit_file' : None,
+               'ratio' : 0.5,
+               'name' : u'unicode name',
+               'pair' : ( 'a', 1 ),
+               'seam_stats' : { 'skipped' : 2 },
+               'seen' : set([ 'x', 'y' ]),
+               'base_obj' : base,
+               'base_seams' : base.get_seams(),
+               'changes' : [ 'c1', 'c2', 'c3' ],
+               'plan' : [ True, False, True ],
+               'commit_list' : [ ],
+               'log' : [ 'one', 'two' ] }
+    statestore.write(db_file, fields)
+    state = statestore.read(db_file)
+    assert sorted(state.keys()) == sorted(fields.keys())
+    assert len(state) == len(fields)
+    for k in fields:
+        if k not in ('base_obj', 'base_seams'):
+            assert state[k] == fields[k], k
+            assert type(state[k]) == type(fields[k]) or k in statestore.LIST_FIELDS, k
+    check_base(state['base_obj'])
+    assert [ s.key() for s in state['base_seams'] ] == [ s.key() for s in base.get_seams() ]
+    assert 'nonesuch' not in state
+    assert state.get('nonesuch', 7) == 7
+    try:
+        state['nonesuch']
+        raise GiveUp('Looking up a missing field should raise KeyError')
+    except KeyError:
+        pass
+
+    banner('Only what changed is written')
+    state = statestore.read(db_file)
+    assert state.flush() == 0
+    state['next_idx_to_merge']
+    assert state.flush() == 0
+    state['next_idx_to_merge'] = 4
+    assert state.flush() == 1
+    # A dict may have been changed in place, so it is written back.
+    state['seam_stats']['skipped'] += 1
+    assert state.flush() == 1
+    del state['pair']
+    state.flush()
+    state = statestore.read(db_file)
+    assert state['next_idx_to_merge'] == 4
+    assert state['seam_stats'] == { 'skipped' : 3 }
+    assert 'pair' not in state
+    generation = state.generation
+    state['cmd'] = 'push_step'
+    state.flush()
+    assert statestore.read(db_file).generation == generation + 1
+
+def test_lists(where):
+    banner('List fields')
+    db_file = os.path.join(where, 'lists.db')
+    statestore.write(db_file, { 'log' : [ 'a', 'b' ], 'commit_list' : [ ] })
+
+    # New entries at the start, as pull and push add to the log.
+    state = statestore.read(db_file)
+    state['log'][0:0] = [ 'n1', 'n2' ]
+    assert state.flush() == 2
+    # .. and at the end, as push adds to the commit list.
+    state['commit_list'].append('c1')
+    state['commit_list'].extend([ 'c2', 'c3' ])
+    state['log'].append('z')
+    assert state.flush() == 4
+    state = statestore.read(db_file)
+    assert state['log'] == [ 'n1', 'n2', 'a', 'b', 'z' ]
+    assert state['commit_list'] == [ 'c1', 'c2', 'c3' ]
+    assert len(rows(db_file, 'log')) == 5
+
+    # Both at once, several times over.
+    for i in range(3):
+        state = statestore.read(db_file)
+        state['log'][0:0] = [ 'p%d'%i ]
+        state['log'] += [ 'e%d'%i ]
+        assert state.flush() == 2
+    state = statestore.read(db_file)
+    assert state['log'] == [ 'p2', 'p1', 'p0', 'n1', 'n2', 'a', 'b', 'z', 'e0', 'e1', 'e2' ]
+
+    # Anything else rewrites the list.
+    state['log'][1] = 'P1'
+    assert state.flush() == 11
+    state = statestore.read(db_file)
+    assert state['log'][:3] == [ 'p2', 'P1', 'p0' ]
+    del state['log'][0]
+    state['log'].insert(3, 'mid')
+    state.flush()
+    state = statestore.read(db_file)
+    assert state['log'][:5] == [ 'P1', 'p0', 'n1', 'mid', 'n2' ]
+    assert [ r[0] for r in rows(db_file, 'log') ] == range(len(state['log']))
+
+    # Assigning a new list replaces the old one.
+    state['log'] = [ 'fresh' ]
+    state['commit_list'] = [ ]
+    state.flush()
+    state = statestore.read(db_file)
+    assert state['log'] == [ 'fresh' ]
+    assert state['commit_list'] == [ ]
+    assert rows(db_file, 'commit_list') == [ ]
+
+    # A list field must be a list.
+    try:
+        state['log'] = 'not a list'
+        raise GiveUp('Setting a list field to a string should fail')
+    except WeldGiveUp:
+        pass
+
+class OldBase(object):
+    """A Base as pickled by an older weld, before it had slots.
+    """
+    pass
+
+class OldSeam(object):
+    """A Seam as pickled by an older weld.
+    """
+    pass
+
+def old_pickle(data):
+    """Pickle 'data' as an older weld would have, with OldBase and OldSeam
+    standing in for Base and Seam.
+    """
+    saved = (db.Base, db.Seam)
+    OldBase.__module__ = OldSeam.__module__ = 'welded.db'
+    OldBase.__name__ = 'Base'
+    OldSeam.__name__ = 'Seam'
+    try:
+        (db.Base, db.Seam) = (OldBase, OldSeam)
+        return pickle.dumps(data)
+    finally:
+        (db.Base, db.Seam) = saved
+
+def test_legacy(where):
+    banner('A data.bin left by an older weld')
+    weld_dir = os.path.join(where, 'weld')
+    os.makedirs(os.path.join(weld_dir, '.weld', 'state'))
+    base = OldBase()
+    base.name = 'project124'
+    base.uri = 'file:///somewhere/project124'
+    base.branch = 'master'
+    base.tag = None
+    base.rev = None
+    base.seams = [ ]
+    for (source, dest) in ((None, '124'), ('two', 'two-124')):
+        seam = OldSeam()
+        seam.name = None
+        seam.base = base
+        seam.source = source
+        seam.dest = dest
+        seam.current = None
+        base.seams.append(seam)
+    data = old_pickle({ 'cmd' : 'pull_step',
+                        'base_obj' : base,
+                        'base_seams' : base.seams,
+                        'log' : [ 'older' ],
+                        'next_idx_to_merge' : 2 })
+    with open(layout.legacy_state_data_file(weld_dir), 'w') as f:
+        f.write(data)
+
+    state = ops.read_state_data_with_file(weld_dir)
+    assert state['cmd'] == 'pull_step'
+    assert state['next_idx_to_merge'] == 2
+    assert state['log'] == [ 'older' ]
+    check_base(state['base_obj'])
+    assert ops.have_cmd(weld_dir) == 'pull_step'
+
+    # Writing it back moves it into the store.
+    state['log'][0:0] = [ 'newer' ]
+    spec = db.Weld()
+    spec.set_dir(weld_dir)
+    ops.write_state_data(spec, state)
+    assert not os.path.exists(layout.legacy_state_data_file(weld_dir))
+    state = ops.read_state_data_with_file(weld_dir)
+    assert state['log'] == [ 'newer', 'older' ]
+    check_base(state['base_obj'])
+
+    banner('A data.bin that cannot be read')
+    os.remove(layout.state_db_file(weld_dir))
+    with open(layout.legacy_state_data_file(weld_dir), 'w') as f:
+        f.write('not a pickle')
+    try:
+        ops.read_state_data_with_file(weld_dir)
+        raise GiveUp('Reading a broken data.bin should give up')
+    except WeldGiveUp as e:
+        print e
+        assert 'Finish or abort the operation with the weld that started it' in str(e)
+
+def test(keep):
+    where = tempfile.mkdtemp(prefix='weld_test')
+    try:
+        test_round_trip(where)
+        test_lists(where)
+        test_legacy(where)
+    except:
+        print 'Test directory kept in %s'%where
+        raise
+    if keep:
+        print 'Test directory kept in %s'%where
+    else:
+        shutil.rmtree(where)
+
+if __name__ == '__main__':
+    run_test(test, __doc__)
+
+# vim: set tabstop=8 softtabstop=4 shiftwidth=4 expandtab:
@@ -0,0 +1,137 @@
+#! /usr/bin/env python2
+
+"""Test "weld status --bases"
+
+Change the bases and the weld of the scenario, both inside and outside
+the seams, and check the counts of commits waiting to be pulled and pushed
+- as a table and as JSON - with and without --fetch, and that the clones
+in .weld/bases are left as they were.
+
+    python2 tests/test_status_bases.py [-keep]
+"""
+
+import json
+import os
+
+from scenario import *
+
+def status_json(w, opts=()):
+    out = weld_ok([ 'status', '--bases', '--json' ] + list(opts), w, verbose=False)
+    return dict((row['name'], row) for row in json.loads(out))
+
+def counts(row):
+    assert 'error' not in row, row
+    return (row['behind'], row['behind_seams'], row['ahead'], row['ahead_seams'])
+
+def last_merged(w, base_name):
+    return git_out([ 'log', '-1', '--format=%H',
+                     '--grep=^X-Weld-State: Merged %s/'%base_name ], w)
+
+def weld_since(w, base_name):
+    """How many weld commits since 'base_name' was last merged?
+    """
+    return int(git_out([ 'rev-list', '--count',
+                         '%s..HEAD'%last_merged(w, base_name) ], w))
+
+def clone_state(s, base_name):
+    clone = s.base_clone(base_name)
+    return (git_out([ 'rev-parse', 'HEAD' ], clone),
+            git_out([ 'status', '--porcelain' ], clone))
+
+def test(keep):
+    with Scenario(keep=keep) as s:
+        s.build()
+        w = s.weld_dir
+
+        banner('Nothing to pull or push')
+        rows = status_json(w)
+        assert sorted(rows.keys()) == [ 'igniting_duck', 'project124' ]
+        for name in rows:
+            row = rows[name]
+            # igniting_duck was pulled first, so the pull of project124
+            # counts as waiting to be pushed - but none of it in its seams.
+            assert counts(row) == (0, 0, weld_since(w, name), 0), row
+            assert row['last_sync'] == 'merge'
+            assert row['weld_sync'] == last_merged(w, name)
+            assert row['base_sync'] == row['base_head'] == clone_state(s, name)[0]
+            assert row['fetched'] is not None
+
+        banner('Change the bases, in their seams and out')
+        s.change_base('project124', 'one/one.c', '// project124/one, changed\n', 'Change one')
+        s.change_base('igniting_duck', 'three/three.c', '// igniting_duck/three, changed\n',
+                      'Change three')
+        s.change_base('igniting_duck', 'two/two.c', '// igniting_duck/two, changed\n',
+                      'Change two')
+        s.change_base('igniting_duck', 'three/new.c', '// igniting_duck/three/new.c\n',
+                      'Add new.c')
+
+        banner('.. and the weld')
+        s.change_weld('one-duck/one.c', '// one-duck, changed in the weld\n', 'Change one-duck')
+        s.change_weld('README', 'Not in any seam\n', 'Add a README')
+        s.change_weld('124/two/two.c', '// 124/two, changed in the weld\n', 'Change 124/two')
+
+        banner('Without --fetch, we go by what our clones already have')
+        before = dict((name, clone_state(s, name)) for name in BASES)
+        rows = status_json(w)
+        duck_ahead = weld_since(w, 'igniting_duck')
+        assert duck_ahead > 3
+        assert counts(rows['igniting_duck']) == (0, 0, duck_ahead, 1)
+        assert counts(rows['project124']) == (0, 0, 3, 1)
+        for name in BASES:
+            assert clone_state(s, name) == before[name]
+
+        banner('With --fetch, we see what the bases have too')
+        rows = status_json(w, [ '--fetch' ])
+        assert counts(rows['igniting_duck']) == (3, 1, duck_ahead, 1)
+        assert counts(rows['project124']) == (1, 1, 3, 1)
+        for name in BASES:
+            # Fetched, but not checked out.
+            assert clone_state(s, name) == before[name]
+            assert rows[name]['base_head'] == git_out([ 'rev-parse', 'master' ],
+                                                      s.base_src(name))
+            assert rows[name]['base_sync'] == before[name][0]
+
+        banner('.. and go on seeing it without')
+        assert status_json(w) == rows
+        assert status_json(w, [ '-j', '1' ]) == rows
+
+        banner('As a table')
+        out = weld_ok([ 'status', '--bases' ], w)
+        lines = dict((l.split()[0], l.split()) for l in out.splitlines()
+                     if l.split() and l.split()[0] in BASES)
+        assert lines['igniting_duck'][1:5] == [ '3', '(1)', str(duck_ahead), '(1)' ]
+        assert lines['project124'][1:5] == [ '1', '(1)', '3', '(1)' ]
+
+        banner('Name just one base')
+        rows = status_json(w, [ 'project124' ])
+        assert rows.keys() == [ 'project124' ]
+        assert counts(rows['project124']) == (1, 1, 3, 1)
+
+        banner('Once pulled, there is nothing more to pull')
+        weld_ok([ 'base-pull', 'igniting_duck' ], w)
+        s.pull('igniting_duck')
+        rows = status_json(w)
+        assert counts(rows['igniting_duck']) == (0, 0, 0, 0)
+        assert rows['igniting_duck']['weld_sync'] == git_out([ 'rev-parse', 'HEAD' ], w)
+        assert counts(rows['project124']) == (1, 1, weld_since(w, 'project124'), 1)
+
+        banner('A base with no clone is reported as such')
+        clone = s.base_clone('project124')
+        os.rename(clone, clone + '.moved')
+        try:
+            rows = status_json(w)
+            assert 'no clone in .weld/bases' in rows['project124']['error']
+            assert counts(rows['igniting_duck']) == (0, 0, 0, 0)
+            rv, out = run_weld([ 'status', '--bases', '--fetch' ], w)
+            assert 'project124: no clone in .weld/bases' in out
+        finally:
+            os.rename(clone + '.moved', clone)
+
+        banner('--fetch and --offline don\'t go together')
+        rv, out = run_weld([ 'status', '--bases', '--fetch', '--offline' ], w)
+        assert rv != 0 and "--fetch and --offline don't go together" in out
+
+if __name__ == '__main__':
+    run_test(test, __doc__)
+
+# vim: set tabstop=8 softtabstop=4 shiftwidth=4 expandtab:
@@ -0,0 +1,100 @@
+#! /usr/bin/env python2
+
+"""Test "weld pull --transplant" and "weld push --transplant"
+
+These build their commits from trees rather than by applying patches, so
+check that they leave the weld and the bases just as they should be, with
+the right headers on the commits.
+
+    python2 tests/test_transplant.py [-keep]
+"""
+
+import os
+
+from scenario import *
+
+def check_seams_match(s, rev='HEAD', base_rev='HEAD'):
+    """Check that each seam in the weld at 'rev' matches its base at 'base_rev'.
+    """
+    for base_name, seams in [ ('project124', [ (None, '124') ]),
+                              ('igniting_duck', [ ('one', 'one-duck'),
+                                                  ('two', 'two-duck') ]) ]:
+        clone = s.base_clone(base_name)
+        for (source, dest) in seams:
+            in_weld = tree_files(s.weld_dir, rev, dest)
+            in_base = tree_files(clone, base_rev, source)
+            if in_weld != in_base:
+                raise GiveUp('%s in the weld does not match %s:%s\n%r\n%r'%(
+                    dest, base_name, source or '.', in_weld, in_base))
+
+def check_merged(s, base_name, seams):
+    """Check that HEAD in the weld says it merged the HEAD of 'base_name'.
+    """
+    head = git_out([ 'rev-parse', 'HEAD' ], s.base_clone(base_name))
+    assert commit_headers(s.weld_dir) == [
+        'X-Weld-State: Merged %s/%s %s'%(base_name, head, seams) ]
+
+def test_pull(s):
+    banner('Pull each base with --transplant')
+    s.build(pull_opts=[ '--transplant' ])
+    w = s.weld_dir
+    check_seams_match(s)
+    assert not os.path.exists(os.path.join(w, 'three'))
+    check_merged(s, 'project124', '[[null, "124"]]')
+    assert git_out([ 'status', '--porcelain' ], w) == ''
+
+    banner('Pull some changes to a base with --transplant')
+    s.change_base('project124', 'one/one.c', '// project124/one, changed\n', 'Change one')
+    s.change_base('project124', 'two/new.c', '// project124/two/new.c\n', 'Add new.c')
+    weld_ok([ 'base-pull', 'project124' ], w)
+    head = git_out([ 'rev-parse', 'HEAD' ], s.base_clone('project124'))
+    s.pull('project124', [ '--transplant' ])
+    check_seams_match(s)
+    assert read_file(os.path.join(w, '124', 'one', 'one.c')) == '// project124/one, changed\n'
+    assert read_file(os.path.join(w, '124', 'two', 'new.c')) == '// project124/two/new.c\n'
+    check_merged(s, 'project124', '[[null, "124"]]')
+    # The changes came in on a commit of their own, just before the marker.
+    ported = git_out([ 'log', '-1', '--format=%B', 'HEAD^' ], w)
+    assert 'X-Weld-Stepwise-Pull: project124 %s'%head in ported
+    assert 'Change one' in ported and 'Add new.c' in ported
+    assert git_out([ 'status', '--porcelain' ], w) == ''
+
+def test_push(s):
+    banner('Push some weld changes to a base with --transplant')
+    w = s.weld_dir
+    clone = s.base_clone('igniting_duck')
+    base_before = git_out([ 'rev-parse', 'master' ], clone)
+    three_before = tree_files(clone, 'master', 'three')
+    s.change_weld('one-duck/one.c', '// one-duck, changed in the weld\n', 'Change one-duck')
+    s.change_weld('two-duck/extra.c', '// two-duck/extra.c\n', 'Add extra.c')
+    s.push('igniting_duck', [ '--transplant' ])
+    assert git_out([ 'rev-parse', '--abbrev-ref', 'HEAD' ], clone) == 'master'
+    assert git_out([ 'status', '--porcelain' ], clone) == ''
+    check_seams_match(s, base_rev='master')
+    assert (git_out([ 'show', 'master:one/one.c' ], clone) ==
+            '// one-duck, changed in the weld')
+    assert tree_files(clone, 'master', 'three') == three_before
+
+    # The base gets a commit per weld commit, and then the Pushed marker.
+    pushed = git_out([ 'rev-parse', 'master' ], clone)
+    assert commit_headers(clone, 'master') == [
+        'X-Weld-State: Pushed igniting_duck from weld scenario' ]
+    steps = git_out([ 'log', '--format=%s', '%s..master^'%base_before ], clone).splitlines()
+    assert len(steps) == 2
+    assert 'Add extra.c' in steps[0] and 'Change one-duck' in steps[1]
+    for line in steps:
+        assert line.startswith('X-Weld-Stepwise-Push: scenario ')
+
+    # .. and the weld records what it pushed.
+    assert commit_headers(w) == [
+        'X-Weld-State: Pushed igniting_duck/%s [["one", "one-duck"], ["two", "two-duck"]]'%pushed ]
+    assert git_out([ 'status', '--porcelain' ], w) == ''
+
+if __name__ == '__main__':
+    def test(keep):
+        with Scenario(keep=keep) as s:
+            test_pull(s)
+            test_push(s)
+    run_test(test, __doc__)
+
+# vim: set tabstop=8 softtabstop=4 shiftwidth=4 expandtab:
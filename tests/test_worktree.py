@@ -0,0 +1,100 @@
+#! /usr/bin/env python2
+
+"""Test "weld pull --worktree" and "weld push --worktree"
+
+The work is done in a linked working tree in .weld/state, so the user's
+checkout mustn't move until "weld finish", "weld abort" must take the
+working tree away, and a second pull mustn't be started while one is in
+progress.
+
+    python2 tests/test_worktree.py [-keep]
+"""
+
+import os
+
+from scenario import *
+
+def weld_state(s):
+    """What the user's checkout looks like: ( HEAD, branch, "git status" ).
+    """
+    return (git_out([ 'rev-parse', 'HEAD' ], s.weld_dir),
+            git_out([ 'rev-parse', '--abbrev-ref', 'HEAD' ], s.weld_dir),
+            git_out([ 'status', '--porcelain' ], s.weld_dir))
+
+def test(keep):
+    with Scenario(keep=keep) as s:
+        banner('Build the weld, pulling with --worktree')
+        s.build(pull_opts=[ '--worktree' ])
+        w = s.weld_dir
+        worktree = os.path.join(w, '.weld', 'state', 'worktree')
+        assert read_file(os.path.join(w, '124', 'one', 'one.c')) == '// This is project124/one\n'
+        assert read_file(os.path.join(w, 'two-duck', 'two.c')) == '// This is igniting_duck/two\n'
+        assert not os.path.exists(worktree)
+
+        banner('Pull: nothing moves until finish')
+        s.change_base('project124', 'one/one.c', '// project124/one, changed\n', 'Change one')
+        weld_ok([ 'base-pull', 'project124' ], w)
+        before = weld_state(s)
+        weld_ok([ '--worktree', 'pull', 'project124' ], w)
+        assert drive(w, first='finish')
+        assert os.path.isdir(worktree)
+        assert weld_state(s) == before
+        assert read_file(os.path.join(w, '124', 'one', 'one.c')) == '// This is project124/one\n'
+
+        banner('A second pull is refused while the first is in progress')
+        rv, out = run_weld([ '--worktree', 'pull', 'igniting_duck' ], w)
+        print out
+        assert rv != 0
+        assert 'part way through a weld operation' in out
+        assert weld_state(s) == before
+        assert 'finish' in verbs(w)
+
+        weld_ok([ 'finish' ], w)
+        assert not os.path.exists(worktree)
+        assert read_file(os.path.join(w, '124', 'one', 'one.c')) == '// project124/one, changed\n'
+        assert git_out([ 'rev-parse', '--abbrev-ref', 'HEAD' ], w) == before[1]
+        assert git_out([ 'status', '--porcelain' ], w) == ''
+        assert verbs(w) == [ ]
+
+        banner('Abort a pull: the working tree goes, the weld stays put')
+        s.change_base('project124', 'two/two.c', '// project124/two, changed\n', 'Change two')
+        weld_ok([ 'base-pull', 'project124' ], w)
+        before = weld_state(s)
+        weld_ok([ '--worktree', 'pull', 'project124' ], w)
+        assert os.path.isdir(worktree)
+        weld_ok([ 'abort' ], w)
+        assert not os.path.exists(worktree)
+        assert weld_state(s) == before
+        assert verbs(w) == [ ]
+        assert 'worktree' not in git_out([ 'worktree', 'list' ], w)
+
+        banner('Push: nothing moves until finish')
+        s.pull('project124', [ '--worktree' ])
+        s.change_weld('two-duck/two.c', '// two-duck, changed in the weld\n', 'Change two-duck')
+        before = weld_state(s)
+        weld_ok([ '--worktree', 'push', 'igniting_duck' ], w)
+        assert drive(w, first='finish')
+        assert weld_state(s) == before
+        weld_ok([ 'finish' ], w)
+        assert not os.path.exists(worktree)
+        assert weld_state(s)[1] == before[1]
+        assert git_out([ 'status', '--porcelain' ], w) == ''
+        base = s.base_clone('igniting_duck')
+        assert (git_out([ 'show', 'master:two/two.c' ], base) ==
+                '// two-duck, changed in the weld')
+
+        banner('Abort a push')
+        s.change_weld('one-duck/one.c', '// one-duck, changed in the weld\n', 'Change one-duck')
+        before = weld_state(s)
+        base_before = git_out([ 'rev-parse', 'master' ], base)
+        weld_ok([ '--worktree', 'push', 'igniting_duck' ], w)
+        assert 'abort' in verbs(w)
+        weld_ok([ 'abort' ], w)
+        assert not os.path.exists(worktree)
+        assert weld_state(s) == before
+        assert git_out([ 'rev-parse', 'master' ], base) == base_before
+
+if __name__ == '__main__':
+    run_test(test, __doc__)
+
+# vim: set tabstop=8 softtabstop=4 shiftwidth=4 expandtab:
@@ -24,23 +24,30 @@ Options are rated on the UK terrorism threat scale:
 # the help message unless you actually ask for it
 # (=> faster startup)
 
+import json
 import os
+import sys
+import traceback
 
 from optparse import OptionParser
 
-import welded.init
-import welded.parser
-import welded.query as query
-import welded.status
-import welded.ops as ops
-import welded.git as git
-
-from welded.layout import spec_file
-from welded.push_step import push_step
-from welded.pull_step import pull_step
-from welded.utils import Bug, GiveUp, find_weld_dir
-from welded.headers import pickle_seams, decode_log_entry, decode_headers, decode_commit_data
-from welded.headers import decode_commit_headers
+from welded.layout import spec_file, spec_cache_file
+from welded.utils import Bug, GiveUp, LazyModule, find_weld_dir
+
+# The modules that do the work are only imported when a command uses
+# them, so that "weld help" or "weld look" don't pay for loading the
+# whole of weld.
+init = LazyModule('welded.init')
+git = LazyModule('welded.git')
+headers = LazyModule('welded.headers')
+markers = LazyModule('welded.markers')
+ops = LazyModule('welded.ops')
+parser = LazyModule('welded.parser')
+pull_step = LazyModule('welded.pull_step')
+push_step = LazyModule('welded.push_step')
+query = LazyModule('welded.query')
+server = LazyModule('welded.server')
+status = LazyModule('welded.status')
 
 main_parser = OptionParser(usage = __doc__)
 main_parser.add_option("-v", "--verbose", action="store_true",
@@ -73,6 +80,22 @@ main_parser.add_option('--bulk', action="store_true",
                                 "base in toto, once. This loses your history, but for very deep histories "
                                 "(e.g. the kernel) it is, sadly, the only way to make weld run in a reasonable "
                                 "time" ) )
+main_parser.add_option('--transplant', action="store_true",
+                       dest="transplant", default = False,
+                       help = ( "When pulling, fetch the base's commits into the weld and graft each "
+                                "seam's tree into place, rather than applying patches or copying files. "
+                                "Falls back to the usual way if the graft can't be done. When pushing, "
+                                "build all the base commits from the weld's trees without checking "
+                                "anything out, ready for 'weld finish'." ) )
+main_parser.add_option('--worktree', action="store_true",
+                       dest="worktree", default = False,
+                       help = ( "When pulling or pushing, do the work in a linked git working tree under "
+                                ".weld/state, so that your own checkout only moves when you 'weld finish'." ) )
+main_parser.add_option('--content-aware', action="store_true",
+                       dest="content_aware", default = False,
+                       help = ( "When copying whole seams (e.g. a --bulk pull), compare git's blob ids on "
+                                "each side and only touch files whose content differs, so that build tools "
+                                "don't see unchanged files as modified." ) )
 main_parser.add_option('--single-commit-stepping', action="store_true",
                        dest="single_commit_stepping", default = False,
                        help="When in a stepped pull or push, just replicate commit messages for the rest of the pull/push")
@@ -118,6 +141,14 @@ main_parser.add_option("--ignore-bad-patches", action="store_true",
                        dest="ignore_bad_patches", default = False,
                        help = ( "[a_bit_cross] Ignore any bad patches in (just this!) step - used to fix horrific"
                               "bugs left over from previous bad merges" ))
+main_parser.add_option("-j", "--jobs", action="store", type="int",
+                       dest="jobs", default = None,
+                       help = ( "For 'weld pull', 'weld push' and 'weld base-pull', bring the "
+                                "clones of all the named bases up to date first, JOBS at a time" ))
+main_parser.add_option("--sync-points", action="store_true",
+                       dest="sync_points", default = False,
+                       help = ( "With 'weld query bases', report the last merge and push of every base "
+                                "from a single pass over the weld history" ))
 main_parser.add_option("--combine-style", action="store",
                        dest="combine_style", default= None,
                        help = ( "[miffed] Tells pull-step and other commands what combine style to use once they have"
@@ -125,6 +156,27 @@ main_parser.add_option("--combine-style", action="store",
                                 " 'rebase' means rebase the base changes over the pulling branch. rebase means you   "
                                 "  end up doing a lot of rebase --continue but reduces the chances of a mismerge. " ))
 
+main_parser.add_option("--offline", action="store_true",
+                       dest="offline", default = False,
+                       help = ( "For 'weld status' and 'weld push', don't ask the weld's remote for "
+                                "its HEAD; go by the remote-tracking ref instead" ))
+main_parser.add_option("--remote-ttl", action="store", type="int",
+                       dest="remote_ttl", default = None,
+                       help = ( "For 'weld status' and 'weld push', how many seconds to believe what "
+                                "the weld's remote last said about its HEAD (default 60; 0 to always ask)" ))
+
+main_parser.add_option("--bases", action="store_true",
+                       dest="status_bases", default = False,
+                       help = ( "For 'weld status', report how far each base is from the weld, "
+                                "rather than on the weld's own remote" ))
+main_parser.add_option("--fetch", action="store_true",
+                       dest="status_fetch", default = False,
+                       help = ( "For 'weld status --bases', fetch each base into its clone in "
+                                ".weld/bases first (the clones' checkouts are left alone)" ))
+main_parser.add_option("--json", action="store_true",
+                       dest="as_json", default = False,
+                       help = "For 'weld status --bases', report in JSON rather than as a table")
+
 # CommandName -> CommandClass
 g_command_dict = { }
 
@@ -145,11 +197,31 @@ def command(command_name):
     g_command_names.append(command_name)
     return remember
 
+def main(args):
+    """
+    Run weld with the command line 'args', reporting any errors. Returns
+    the exit code.
+    """
+    try:
+        return go(args)
+    except Bug as e:
+        print("")
+        print("%s"%e)
+        traceback.print_exc()
+        return e.retval
+    except GiveUp as e:
+        print("")
+        text = str(e)
+        if text:
+            print(text)
+        return e.retval
+
 def go(args):
     """
-    Main entry point
+    Main entry point. Returns the exit code.
     """
-    (opts, args) = main_parser.parse_args()
+    argv = args
+    (opts, args) = main_parser.parse_args(args)
 
     # Find a command.
     if (len(args) < 1):
@@ -159,6 +231,8 @@ def go(args):
     # This is really horrid, but it is necessary for canonicalising
     # paths to control scripts.
     opts.cwd = os.getcwd()
+    # Set by commands which bring their bases up to date before starting.
+    opts.bases_updated = False
 
     cmd = args[0]
     if (cmd in g_command_dict):
@@ -171,10 +245,17 @@ def go(args):
 
     if (obj.needs_weld()):
         weld_dir = find_weld_dir(os.getcwd())
-        obj.set_weld_dir(weld_dir)
+        if obj.forward:
+            # If there's a "weld serve" for this weld, let it do the work.
+            rv = server.forward(weld_dir, argv)
+            if (rv is not None):
+                return rv
+        obj.set_weld_dir(weld_dir, bases = obj.bases_wanted(args[1:]))
         ops.ensure_state_dir(weld_dir)
 
-    return obj.go(opts, args[1:])
+    # Commands return whether they stopped part way, not an exit code.
+    obj.go(opts, args[1:])
+    return 0
 
 
 class Command(object):
@@ -183,12 +264,23 @@ class Command(object):
     Abstract base class for commands, with utilities for the wise.
     """
     cmd_name = "<PleaseRegisterYourCommand>"
+    # May this command be handed to a "weld serve"? Only for commands that
+    # work on the weld and its bases on this machine: anything that talks
+    # to a remote may want to ask for a password, and the server has no
+    # terminal to ask on.
+    forward = False
 
-    def set_weld_dir(self, w):
+    def set_weld_dir(self, w, bases = None):
+        """
+        Load the spec for the weld in 'w'. If 'bases' is given, we may
+        only load those bases.
+        """
         self.weld_dir = w
-        p = welded.parser.Parser()
+        p = parser.Parser()
         spec_name = spec_file(w)
-        self.spec = p.parse(spec_name)
+        ops.ensure_cache_dir(w)
+        self.spec = p.parse(spec_name, cache_file = spec_cache_file(w),
+                            only_bases = bases)
         self.spec.set_dir(self.weld_dir)
 
     def syntax(self):
@@ -207,6 +299,22 @@ class Command(object):
         # Most commands need a weld.
         return True
 
+    def bases_wanted(self, args):
+        """
+        The names of the bases this command needs from the spec, given its
+        arguments, or None for all of them (the default).
+        """
+        return None
+
+    def named_bases(self, args):
+        """
+        For commands whose arguments are all base names: those names,
+        or None if they include _all.
+        """
+        if (len(args) == 0 or "_all" in args):
+            return None
+        return args
+
     def base_set_from_args(self, args):
         bases = { } 
         for a in args:
@@ -228,7 +336,8 @@ class Look(Command):
 
        One day, it will also play tetris
     """
-    
+    forward = True
+
     def syntax(self):
         return "look"
 
@@ -281,6 +390,8 @@ class BasePull(Command):
     """Synchronise a base (or all bases)
     
     This just does a git pull in each named base
+
+    If --jobs N is given, N bases are pulled at once.
     """
     def go(self,opts,args):
         to_op = self.base_set_from_args(args)
@@ -289,6 +400,10 @@ class BasePull(Command):
             return 1
         if opts.verbose:
             print "Syncing bases: %s"%(', '.join(to_op))
+        if opts.jobs is not None:
+            ops.update_bases(self.spec, to_op, jobs = opts.jobs, clone = False,
+                             verbose = opts.verbose)
+            return 0
         for o in to_op:
             if opts.verbose:
                 print "Sync base %s"%o
@@ -330,9 +445,9 @@ class Init(Command):
         if (len(args) != 1):
             raise GiveUp("Missing <weld-xml-file>")
         
-        p = welded.parser.Parser()
+        p = parser.Parser()
         weld = p.parse(args[0])
-        welded.init.init_weld(weld, os.getcwd())
+        init.init_weld(weld, os.getcwd())
 
     def needs_weld(self):
         # init doesn't need a weld.
@@ -366,9 +481,9 @@ class Adopt(Command):
         if (len(args) != 1):
             raise GiveUp("Missing <weld-xml-file>")
         
-        p = welded.parser.Parser()
+        p = parser.Parser()
         weld = p.parse(args[0])
-        welded.init.adopt_weld(weld, os.getcwd())
+        init.adopt_weld(weld, os.getcwd())
 
     def needs_weld(self):
         # init doesn't need a weld.
@@ -393,7 +508,14 @@ class Pull(Command):
     If you specify multiple bases to "weld pull", and have to "weld finish" or
     "weld abort" one of them, the "weld pull" will not continue on to the next
     base; you will have to reissue the command again.
+
+    If --jobs N is given, the clones of all the named bases in .weld/bases
+    are brought up to date first, N at a time, before any of them is pulled
+    into the weld. If any of them can't be updated, nothing is pulled.
     """
+    def bases_wanted(self, args):
+        return self.named_bases(args)
+
     def go(self,opts,args):
         to_pull = self.base_set_from_args(args)
         if len(to_pull) == 0:
@@ -401,9 +523,13 @@ class Pull(Command):
             return 1
         if opts.verbose:
             print "Pulling bases: %s"%(', '.join(to_pull))
+        if opts.jobs is not None:
+            ops.update_bases(self.spec, to_pull, jobs = opts.jobs,
+                             verbose = opts.verbose)
+            opts.bases_updated = True
         for p in to_pull:
             opts.finish_stepping = True
-            rv = pull_step(self.spec, p, opts)
+            rv = pull_step.pull_step(self.spec, p, opts)
             if rv != 0:
                 return rv
 
@@ -416,6 +542,9 @@ class PullStep(Command):
     except that the individual commits from the base are merged into
     the weld.
     """
+    def bases_wanted(self, args):
+        return self.named_bases(args)
+
     def go(self, opts, args):
         to_pull = self.base_set_from_args(args)
         if len(to_pull) == 0:
@@ -424,7 +553,7 @@ class PullStep(Command):
         if opts.verbose:
             print 'Pull-step - bases are: %s'%(', '.join(to_pull))
         for base_name in to_pull:
-            rv = pull_step(self.spec, base_name, opts)
+            rv = pull_step.pull_step(self.spec, base_name, opts)
             if (rv != 0):
                 return rv
 
@@ -445,6 +574,9 @@ class PushStep(Command):
     "weld finish" or "weld abort").
 
     """
+    def bases_wanted(self, args):
+        return self.named_bases(args)
+
     def go(self, opts, args):
         to_push = self.base_set_from_args(args)
         if len(to_push) == 0:
@@ -453,7 +585,7 @@ class PushStep(Command):
         if opts.verbose:
             print 'Push-step - bases are: %s'%(', '.join(to_push))
         for base_name in to_push:
-            rv = push_step(self.spec, base_name,
+            rv = push_step.push_step(self.spec, base_name,
                            opts)
             if rv != 0:
                 return rv
@@ -487,7 +619,13 @@ class Push(Command):
     If you specify multiple bases to "weld push", and have to "weld finish"
     or "weld abort" one of them, the "weld push" will not continue on to the
     next base; you will have to reissue the command again.
+
+    If --jobs N is given, the clones of all the named bases in .weld/bases
+    are brought up to date first, N at a time, before any of them is pushed.
     """
+    def bases_wanted(self, args):
+        return self.named_bases(args)
+
     def go(self,opts,args):
         to_push = self.base_set_from_args(args)
         if len(to_push) == 0:
@@ -495,9 +633,13 @@ class Push(Command):
             return 1
         if opts.verbose:
             print "Pushing bases: %s"%(', '.join(to_push))
+        if opts.jobs is not None:
+            ops.update_bases(self.spec, to_push, jobs = opts.jobs,
+                             verbose = opts.verbose)
+            opts.bases_updated = True
         for base_name in to_push:
             opts.finish_stepping = True
-            rv = push_step(self.spec, base_name, opts)
+            rv = push_step.push_step(self.spec, base_name, opts)
             if rv != 0:
                 return rv
 
@@ -531,6 +673,8 @@ class Do(Command):
     consistent with the equivalent source code in the main weld. As such,
     you may need to do "weld pull" of the base.
     """
+    forward = True
+
     def go(self,opts,args):
         if (len(args)  < 1):
             raise GiveUp("No verb supplied to 'do'")
@@ -542,6 +686,8 @@ class Finish(Command):
     Finish a "weld pull" or a "weld pull" that needed user intervetion.
 
     """
+    forward = True
+
     def go(self, opts, args):
         ops.do(self.spec, 'finish', opts, do_next_verbs = True)
 
@@ -550,6 +696,8 @@ class Abort(Command):
     """
     Abort a "weld pull" or "weld push" that needed user intervention
     """
+    forward = True
+
     def go(self, opts, args):
         ops.do(self.spec, 'abort', opts, do_next_verbs = True)
 
@@ -558,13 +706,15 @@ class Query(Command):
     """
     Query the database
 
-      weld query base <base_name>
+      weld query base <base_name> [<base_name> ...]
 
-        Query the current state of <base_name>
+        Query the current state of <base_name>. If more than one base is
+        named (or _all is given), the weld history is only searched once.
 
-      weld query bases
+      weld query bases [--sync-points]
 
-        List the known bases
+        List the known bases. With --sync-points, report the last merge
+        and push of every base instead.
 
       weld query seam-changes <base_name>
 
@@ -586,6 +736,13 @@ class Query(Command):
         Query the weld headers present in the given repo and commit id.
 
     """
+    def bases_wanted(self, args):
+        if (len(args) > 1 and args[0] == "base"):
+            return self.named_bases(args[1:])
+        if (len(args) == 2 and args[0] in ("seam-changes", "match")):
+            return args[1:]
+        return None
+
     def go(self,opts,args):
         if len(args) < 1:
             raise GiveUp("query requires a subcommand")
@@ -593,22 +750,28 @@ class Query(Command):
         if cmd == "base":
             if len(args) < 2:
                 raise GiveUp("query base requires a base name")
-            query.query_base(self.spec, args[1])
+            if len(args) == 2 and args[1] != "_all":
+                query.query_base(self.spec, args[1])
+            else:
+                query.query_base_list(self.spec, self.base_set_from_args(args[1:]))
         elif cmd == "headers":
             if (len(args) < 3):
                 raise GiveUp("query headers requires a repo dir and commit id")
             log_entry = git.log(args[1], args[2])
-            hdrs = decode_headers(log_entry)
+            hdrs = headers.decode_headers(log_entry)
             print " There are %d state headers."%(len(hdrs))
             for verb,data in hdrs:
-                (base,cid,seams) = decode_commit_data(data)
+                (base,cid,seams) = headers.decode_commit_data(data)
                 print "Header: Verb='%s', base='%s', cid='%s', seams='%s' [from '%s']"%(verb,base,cid,seams,data)
-            hdrs = decode_commit_headers(log_entry)
+            hdrs = headers.decode_commit_headers(log_entry)
             print " There are %d commit headers."%(len(hdrs))
             for (verb, base, cid_from, cid_to) in hdrs:
                 print "Verb = '%s', base = '%s', cid_from = '%s', cid_to = '%s'"%(verb,base,cid_from,cid_to)
         elif cmd == "bases":
-            query.query_bases(self.spec)
+            if opts.sync_points:
+                query.query_bases_sync_points(self.spec)
+            else:
+                query.query_bases(self.spec)
         elif cmd == "seam-changes":
             if len(args) != 2:
                 raise GiveUp("query seam-changes requires a base name")
@@ -631,6 +794,54 @@ class Query(Command):
         else:
             raise GiveUp("No query subcommand '%s'"%cmd)
 
+@command('serve')
+class Serve(Command):
+    """
+    Keep a weld loaded and ready to run commands.
+
+      weld serve         - serve this weld until stopped
+      weld serve stop    - stop the server for this weld
+
+    "weld serve" stays in the foreground (run it in another terminal, or
+    in the background) and listens on .weld/state/server.sock. While it
+    is running, "weld look" and the verbs you step through a pull or push
+    with ("weld step", "weld commit", "weld inspect" and so on) are handed
+    to it to run, which saves starting weld and reading the weld again for
+    each one. Other commands, which may need to talk to a remote, and
+    verbs that may need to edit a commit message are still run directly.
+
+    Set $WELD_NO_SERVER to stop commands being handed to the server.
+    """
+    def syntax(self):
+        return "serve [stop]"
+
+    def go(self, opts, args):
+        if (len(args) == 0):
+            server.serve(self.spec.base_dir, verbose = opts.verbose)
+        elif (args == [ 'stop' ]):
+            if not server.stop(self.spec.base_dir):
+                print "No weld server is running for %s"%self.spec.base_dir
+        else:
+            raise GiveUp('Syntax: weld serve [stop]')
+
+@command('reindex')
+class Reindex(Command):
+    """
+    Rebuild the record of where each base was last merged and pushed.
+
+    Weld keeps an index of the "X-Weld-State:" headers in the weld's history,
+    and refs (refs/weld/bases/<base>/last-merge, refs/weld/bases/<base>/last-push
+    and refs/weld/init) pointing at the last sync points. These are kept
+    up to date automatically, but this command throws them away and rebuilds
+    them from the headers, in case they have been damaged.
+    """
+    def go(self, opts, args):
+        if len(args) > 0:
+            raise GiveUp('"weld reindex" takes no arguments')
+        idx = markers.reindex(self.spec.base_dir, verbose = opts.verbose)
+        for ref in sorted(git.list_refs(self.spec.base_dir, "refs/weld/")):
+            print "%s %s"%(git.rev_parse(self.spec.base_dir, ref), ref)
+
 @command('debug')
 class Debug(Command):
     """
@@ -666,13 +877,19 @@ class Status(Command):
     Report on the weld status.
 
       weld status [<remote-name>]
+      weld status --bases [<base-name> ...]
 
     If we are part-way through a "weld pull" or "weld push", then say so.
 
     Otherwise, report on whether we should do a "git pull" or "git push" of
     our weld. This is intended to be useful before doing a "weld pull" or
     "weld push" of our bases. Note that it queries the remote to determine
-    the HEAD of the branch on the remote.
+    the HEAD of the branch on the remote - though what it hears is kept
+    (in .weld/cache) for --remote-ttl seconds, 60 by default, or until the
+    remote-tracking ref for the branch moves.
+
+    If you specify --offline, the remote isn't asked at all; we go by the
+    remote-tracking ref (as of your last "git fetch" or "git push").
 
     If <remote-name> is not given, "origin" is assumed.
 
@@ -690,8 +907,18 @@ class Status(Command):
     early term is True, later terms may be None because we either haven't
     checked, or because (in the case of "git push") it can actually be
     undecidable until a "git pull" has been done.
+
+    With --bases, report on the named bases (or all of them) instead: for
+    each, how many base commits there are to pull and weld commits to push
+    since it was last merged or pushed, and how many of those touch its
+    seams. The bases are looked at in parallel (--jobs at a time), using
+    what was last fetched into our clones in .weld/bases; the clones are
+    not changed. Give --fetch to "git fetch" into each of them first.
+    Use --json to get the report as JSON.
     """
     def go(self, opts, args):
+        if opts.status_bases:
+            return self.go_bases(opts, args)
         if len(args) > 1:
             raise GiveUp('Too many arguments - "weld status [<remote-name>]"')
 
@@ -704,9 +931,10 @@ class Status(Command):
         else:
             remote_name = None
 
-            in_op, should_git_pull, should_git_push = \
-                welded.status.get_status_2(where, remote_name=remote_name,
-                                           verbose=verbose)
+        in_op, should_git_pull, should_git_push = \
+            status.get_status_2(where, remote_name=remote_name,
+                                verbose=verbose, offline=opts.offline,
+                                ttl=opts.remote_ttl)
 
         if in_op:
             print 'Part way through a weld command - %s'%in_op
@@ -726,4 +954,18 @@ class Status(Command):
         if output_tuple:
             print in_op, should_git_pull, should_git_push
 
+    def go_bases(self, opts, args):
+        if len(args) == 0:
+            base_names = self.spec.base_names()
+        else:
+            base_names = self.base_set_from_args(args)
+        if opts.status_fetch and opts.offline:
+            raise GiveUp("--fetch and --offline don't go together")
+        rows = status.get_bases_status(self.spec, base_names, fetch = opts.status_fetch,
+                                       jobs = opts.jobs, verbose = opts.verbose)
+        if opts.as_json:
+            print json.dumps(rows, indent = 1, sort_keys = True)
+        else:
+            status.print_bases_status(rows)
+
 # End file.
@@ -0,0 +1,167 @@
+"""
+Copying files between checkouts without shelling out to rsync.
+
+Files are named relative to a source directory and recreated at the same
+relative paths under a destination directory, keeping their mode and
+modification time (as "rsync -a" would). Regular files are cloned with a
+reflink where the filesystem can do it (btrfs, xfs, ..), and otherwise
+copied a chunk at a time. Many small files are
+spread over a pool of threads, since most of the time goes in system
+calls rather than in Python.
+"""
+
+import os
+import errno
+import fcntl
+import shutil
+import stat
+import threading
+from multiprocessing.pool import ThreadPool
+
+from welded.utils import GiveUp
+
+# From <linux/fs.h>: _IOW(0x94, 9, int)
+FICLONE = 0x40049409
+
+# How much of a file we copy at once when we can't clone it.
+CHUNK_SIZE = 1 << 20
+
+# How many files we hand a thread at once.
+BATCH_SIZE = 64
+
+# Try a reflink, then copy.
+METHOD_AUTO = 'auto'
+# Just copy.
+METHOD_COPY = 'copy'
+
+# errnos which tell us that this filesystem (or pair of them) won't clone
+# files, so there is no point trying again.
+UNSUPPORTED = (errno.EOPNOTSUPP, errno.ENOTTY, errno.EXDEV, errno.EINVAL,
+               errno.EPERM, errno.ENOSYS)
+
+def default_jobs():
+    try:
+        import multiprocessing
+        return min(8, multiprocessing.cpu_count())
+    except NotImplementedError:
+        return 4
+
+class Copier(object):
+    """Copies files from one directory tree to another.
+
+    Remembers whether reflinks have failed, so that we only
+    find out once per copy that the filesystem won't do them.
+    """
+
+    def __init__(self, from_dir, to_dir, method = METHOD_AUTO):
+        if method not in (METHOD_AUTO, METHOD_COPY):
+            raise GiveUp("Unknown copy method '%s'"%method)
+        self.from_dir = from_dir
+        self.to_dir = to_dir
+        self.try_reflink = (method == METHOD_AUTO)
+        self.lock = threading.Lock()
+        self.counts = { }
+
+    def count(self, how):
+        with self.lock:
+            self.counts[how] = self.counts.get(how, 0) + 1
+
+    def describe(self):
+        return ', '.join([ '%d %s'%(self.counts[k], k) for k in sorted(self.counts.keys()) ])
+
+    def make_parent(self, path):
+        parent = os.path.dirname(path)
+        if not os.path.isdir(parent):
+            try:
+                os.makedirs(parent, 0755)
+            except OSError as e:
+                # Another thread may have beaten us to it.
+                if e.errno != errno.EEXIST:
+                    raise
+
+    def copy_one(self, name):
+        src = os.path.join(self.from_dir, name)
+        dest = os.path.join(self.to_dir, name)
+        st = os.lstat(src)
+        if stat.S_ISDIR(st.st_mode):
+            # A submodule; we don't do those.
+            self.count('skipped')
+            return
+        self.make_parent(dest)
+        # Never write through an existing file - it may be a link to
+        # something we'd rather not change.
+        if os.path.lexists(dest):
+            os.unlink(dest)
+        if stat.S_ISLNK(st.st_mode):
+            os.symlink(os.readlink(src), dest)
+            self.count('symlinked')
+            return
+        with open(src, 'rb') as in_f:
+            with open(dest, 'wb') as out_f:
+                cloned = False
+                if self.try_reflink:
+                    try:
+                        fcntl.ioctl(out_f.fileno(), FICLONE, in_f.fileno())
+                        cloned = True
+                    except IOError as e:
+                        if e.errno not in UNSUPPORTED:
+                            raise
+                        self.try_reflink = False
+                if not cloned:
+                    while True:
+                        data = in_f.read(CHUNK_SIZE)
+                        if (len(data) == 0):
+                            break
+                        out_f.write(data)
+        shutil.copystat(src, dest)
+        self.count('cloned' if cloned else 'copied')
+
+    def copy_batch(self, names):
+        for name in names:
+            try:
+                self.copy_one(name)
+            except (IOError, OSError) as e:
+                raise GiveUp("Cannot copy %s from %s to %s: %s"%(name, self.from_dir,
+                                                                self.to_dir, e))
+        return len(names)
+
+def batches(names, size):
+    batch = [ ]
+    for name in names:
+        batch.append(name)
+        if (len(batch) >= size):
+            yield batch
+            batch = [ ]
+    if (len(batch) > 0):
+        yield batch
+
+def copy_files(from_dir, to_dir, names, method = METHOD_AUTO, jobs = None, verbose = False):
+    """Copy the files 'names' (relative to 'from_dir') into 'to_dir'
+
+    'names' may be any iterable - typically git.iter_files(from_dir) - and
+    is consumed as we go. Directories are created as needed; existing files
+    are replaced. Returns the number of files copied.
+    """
+    if (jobs is None):
+        jobs = default_jobs()
+    copier = Copier(from_dir, to_dir, method)
+    if verbose:
+        print "> copy %s -> %s (%s, %d job%s)"%(from_dir, to_dir, method,
+                                               jobs, '' if jobs == 1 else 's')
+    nr_copied = 0
+    if (jobs > 1):
+        pool = ThreadPool(jobs)
+        try:
+            for n in pool.imap_unordered(copier.copy_batch, batches(names, BATCH_SIZE)):
+                nr_copied += n
+        finally:
+            pool.terminate()
+            pool.join()
+    else:
+        for batch in batches(names, BATCH_SIZE):
+            nr_copied += copier.copy_batch(batch)
+    if verbose and nr_copied > 0:
+        print "  %d file%s: %s"%(nr_copied, '' if nr_copied == 1 else 's', copier.describe())
+    return nr_copied
+
+# End file.
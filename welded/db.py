@@ -5,39 +5,62 @@ The weld database; contains a description of a weld.
 from xml.sax.saxutils import quoteattr
 from functools import total_ordering
 
-class Base:
+def intern_str(s):
     """
-    Represents a base
+    Intern 's' if we can; a spec has a lot of repeated names and paths.
     """
-    
-    # Name.
-    name = None
-    # URI
-    uri = None
-
-    # Branch
-    branch = None
+    if (type(s) is str):
+        return intern(s)
+    return s
 
-    # Tag
-    tag = None
-    
-    # rev
-    rev = None
+class Base(object):
+    """
+    Represents a base
+    """
 
-    # seams using this base. Since seams can be anonymous, an array.
-    seams = [ ]
+    # name: Name.
+    # uri: URI
+    # branch: Branch
+    # tag: Tag
+    # rev: rev
+    # seams: seams using this base. Since seams can be anonymous, an array.
+    __slots__ = ( '_name', 'uri', 'branch', 'tag', 'rev', 'seams' )
 
     def __init__(self):
-        self.name = None
+        self._name = None
         self.uri = None
         self.branch = None
         self.tag = None
         self.rev = None
         self.seams = [ ]
 
+    def get_name(self):
+        return self._name
+
+    def set_name(self, name):
+        self._name = intern_str(name)
+
+    name = property(get_name, set_name)
+
     def get_seams(self):
         return self.seams
 
+    def __getstate__(self):
+        return ( self._name, self.uri, self.branch, self.tag, self.rev, self.seams )
+
+    def __setstate__(self, state):
+        if isinstance(state, dict):
+            # Pickled before Base had slots - as in the state of an
+            # operation started by an older weld.
+            self._name = intern_str(state.get('name'))
+            self.uri = state.get('uri')
+            self.branch = state.get('branch')
+            self.tag = state.get('tag')
+            self.rev = state.get('rev')
+            self.seams = state.get('seams', [ ])
+            return
+        ( self._name, self.uri, self.branch, self.tag, self.rev, self.seams ) = state
+
     def __repr__(self):
         res = "<base name=%s uri=%s"%(quoteattr(self.name), quoteattr(self.uri))
         if (self.branch is not None):
@@ -52,28 +75,78 @@ class Base:
         return res
 
 @total_ordering
-class Seam:
+class Seam(object):
     """
     Represents a seam
+
+    Seams are compared and hashed by their key - ( source, dest, base name,
+    name ) - which is worked out when first needed after any of those
+    change, rather than by building their repr() every time.
     """
 
-    # Name
-    name = None
+    # name: Name
+    # base: Base - this is a Base object
+    # source: Source directory
+    # dest: Destination
+    __slots__ = ( '_name', '_base', '_source', '_dest', 'current', '_key', '_srcdest' )
+
+    def __init__(self):
+        self._name = None
+        self._base = None
+        self._source = None
+        self._dest = None
+        self.current = None
+        self._key = None
+        self._srcdest = None
 
-    # Base - this is a Base object
-    base = None
+    def get_name(self):
+        return self._name
 
-    # Source directory
-    source = None
+    def set_name(self, name):
+        self._name = intern_str(name)
+        self._key = None
 
-    # Destination
-    dest = None
+    name = property(get_name, set_name)
 
-    def __init__(self):
-        self.name = None
-        self.base = None
-        self.source = None
-        self.dest = None
+    def get_base_obj(self):
+        return self._base
+
+    def set_base_obj(self, base):
+        self._base = base
+        self._key = None
+
+    base = property(get_base_obj, set_base_obj)
+
+    def get_source_attr(self):
+        return self._source
+
+    def set_source_attr(self, source):
+        self._source = intern_str(source)
+        self._key = None
+        self._srcdest = None
+
+    source = property(get_source_attr, set_source_attr)
+
+    def get_dest_attr(self):
+        return self._dest
+
+    def set_dest_attr(self, dest):
+        self._dest = intern_str(dest)
+        self._key = None
+        self._srcdest = None
+
+    dest = property(get_dest_attr, set_dest_attr)
+
+    def key(self):
+        k = self._key
+        if (k is None):
+            if (self._base is None):
+                base_name = None
+            else:
+                base_name = self._base.name
+            k = ( self._source, self._dest, base_name, self._name )
+            self._key = k
+        return k
 
     def get_source(self):
         if (self.source is None):
@@ -87,6 +160,23 @@ class Seam:
         else:
             return self.dest
 
+    def __getstate__(self):
+        return ( self._name, self._base, self._source, self._dest, self.current )
+
+    def __setstate__(self, state):
+        if isinstance(state, dict):
+            # Pickled before Seam had slots.
+            self._name = intern_str(state.get('name'))
+            self._base = state.get('base')
+            self._source = intern_str(state.get('source'))
+            self._dest = intern_str(state.get('dest'))
+            self.current = state.get('current')
+        else:
+            ( self._name, self._base, self._source, self._dest, self.current ) = state
+        # The base may not be fully unpickled yet, so leave the key for later.
+        self._key = None
+        self._srcdest = None
+
     def __str__(self):
         return self.__repr__()
 
@@ -106,27 +196,134 @@ class Seam:
         return res
 
     def __eq__(self, other):
-        return repr(self) == repr(other)
+        if not isinstance(other, Seam):
+            return NotImplemented
+        return self.key() == other.key()
 
     def __ne__(self, other):
-        return repr(self) != repr(other)
+        if not isinstance(other, Seam):
+            return NotImplemented
+        return self.key() != other.key()
 
     def __lt__(self, other):
-        return repr(self) < repr(other)
+        return self.key() < other.key()
 
     def __hash__(self):
-        return hash(repr(self))
+        return hash(self.key())
 
     def srcdest(self):
-        res = ""
-        if (self.source is not None):
-            res = res + self.source
-        res = res + ":"
-        if (self.dest is not None):
-            res = res + self.dest
+        res = self._srcdest
+        if (res is None):
+            res = ""
+            if (self.source is not None):
+                res = res + self.source
+            res = res + ":"
+            if (self.dest is not None):
+                res = res + self.dest
+            self._srcdest = res
         return res
 
 
+def path_components(path):
+    """
+    Split 'path' into its components, ignoring empty ones and '.' - so
+    "", "." and "./" are all the root.
+    """
+    return [ c for c in path.split('/') if (len(c) > 0 and c != '.') ]
+
+class PathTrie(object):
+    """
+    Maps directories to values, so that we can find the value for the
+    deepest directory containing a path in one step per path component,
+    rather than by trying every directory in turn.
+
+    Each node is a pair ( value, children ), where 'children' maps a path
+    component to a node and 'value' is NO_VALUE if nothing is mapped there.
+    """
+    __slots__ = ( 'root', )
+
+    NO_VALUE = object()
+
+    def __init__(self):
+        self.root = [ PathTrie.NO_VALUE, { } ]
+
+    def add(self, path, value):
+        node = self.root
+        for c in path_components(path):
+            children = node[1]
+            if (c not in children):
+                children[c] = [ PathTrie.NO_VALUE, { } ]
+            node = children[c]
+        node[0] = value
+
+    def lookup(self, path, strict = False):
+        """
+        Returns ( value, remainder ) for the deepest directory mapped which
+        contains 'path' - or is 'path', unless 'strict' is true - where
+        'remainder' is the rest of 'path' below it ("" if there isn't any).
+
+        Returns ( None, None ) if there is no such directory.
+        """
+        components = path_components(path)
+        node = self.root
+        found = None
+        for i in range(len(components) + 1):
+            if (node[0] is not PathTrie.NO_VALUE and (i < len(components) or not strict)):
+                found = ( node[0], i )
+            if (i == len(components)):
+                break
+            node = node[1].get(components[i])
+            if (node is None):
+                break
+        if (found is None):
+            return ( None, None )
+        return ( found[0], '/'.join(components[found[1]:]) )
+
+    def exact(self, path):
+        """
+        Returns the value mapped at exactly 'path', or None.
+        """
+        node = self.root
+        for c in path_components(path):
+            node = node[1].get(c)
+            if (node is None):
+                return None
+        if (node[0] is PathTrie.NO_VALUE):
+            return None
+        return node[0]
+
+class SeamIndex(object):
+    """
+    Maps paths to the seams which own them: paths in a base to seams by
+    their source, and paths in the weld to seams by their destination.
+    Nested seams are allowed; the innermost one wins.
+    """
+    __slots__ = ( 'by_source', 'by_dest' )
+
+    def __init__(self, seams = ( )):
+        self.by_source = PathTrie()
+        self.by_dest = PathTrie()
+        for s in seams:
+            self.add(s)
+
+    def add(self, seam):
+        self.by_source.add(seam.get_source(), seam)
+        self.by_dest.add(seam.get_dest(), seam)
+
+    def source_seam(self, path, strict = False):
+        """
+        Returns ( seam, path relative to the seam's source ) for 'path' in
+        a base, or ( None, None ) if no seam covers it.
+        """
+        return self.by_source.lookup(path, strict)
+
+    def dest_seam(self, path, strict = False):
+        """
+        Returns ( seam, path relative to the seam's destination ) for 'path'
+        in the weld, or ( None, None ) if no seam covers it.
+        """
+        return self.by_dest.lookup(path, strict)
+
 class Weld:
     # The name of this weld.
     name = None
@@ -139,8 +336,12 @@ class Weld:
     # Bases - maps a name to a Base
     bases = { }
 
+    # SeamIndex of all our seams, once someone has asked for it.
+    index = None
+
     def __init__(self):
         self.name = "[anonymous]"
+        self.bases = { }
     
     def seam_names(self):
         """
@@ -152,6 +353,14 @@ class Weld:
                 rv[s] = True
         return rv
 
+    def seam_index(self):
+        """
+        A SeamIndex of all our seams, built the first time it is asked for.
+        """
+        if (self.index is None):
+            self.index = SeamIndex(self.get_seams())
+        return self.index
+
     def get_seams(self):
         rv = [ ]
         for b in self.bases.values():
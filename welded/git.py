@@ -4,29 +4,253 @@ Git utilities
 @todo We rely on porcelain quite heavily here - we should stop doing that.
 """
 
+import atexit
+import subprocess
 import tempfile
 import os
 import re
+import time
 
-from welded.headers import header_grep_merge, header_grep_push, header_grep_init
-from welded.utils import run_silently, run_to_stdout, GiveUp
+from welded.utils import run_silently, run_to_stdout, GiveUp, with_env
 
-def init(where):
-    run_silently(["git", "init"], cwd=where)
+class CatFile(object):
+    """A long-lived object reader for a single repository.
 
-def add_in_subdir(where, dirname):
-    if (not os.path.exists(dirname)):
-        run_silently(["git", "rm", "--ignore-unmatch", "-f", "-r", dirname], cwd = where)
-    else:
-        run_silently(["git", "add", "-f", "-A", "%s/**"%dirname], cwd=where)
+    Keeps a "git cat-file --batch" and a "git cat-file --batch-check"
+    process running (each started the first time it is needed), so that
+    looking up an object costs a pipe round-trip rather than a fork of git.
+
+    Object names are resolved by git on each request, so refs (including
+    HEAD) moved by other git commands are seen straight away.
+    """
+
+    def __init__(self, where):
+        self.where = where
+        self.batch = None
+        self.check = None
+
+    def _start(self, mode):
+        try:
+            return subprocess.Popen(["git", "cat-file", mode],
+                                    stdin=subprocess.PIPE,
+                                    stdout=subprocess.PIPE,
+                                    cwd=self.where)
+        except OSError as e:
+            raise GiveUp("Cannot start 'git cat-file %s' in %s - %s"%(mode, self.where, e))
+
+    def _request(self, proc, name):
+        if ('\n' in name):
+            raise GiveUp("Invalid object name %r"%name)
+        try:
+            proc.stdin.write('%s\n'%name)
+            proc.stdin.flush()
+            line = proc.stdout.readline()
+        except IOError as e:
+            line = ''
+        if (len(line) == 0):
+            self.close()
+            raise GiveUp("'git cat-file' in %s exited unexpectedly"%self.where)
+        return line
+
+    def info(self, name):
+        """Return (sha1, type, size) for the object 'name', or None if
+        there is no such object.
+        """
+        if (self.check is None):
+            self.check = self._start("--batch-check")
+        line = self._request(self.check, name)
+        f = line.split()
+        if (len(f) != 3):
+            return None
+        return (f[0], f[1], int(f[2]))
+
+    def read(self, name):
+        """Return (sha1, type, contents) for the object 'name', or None if
+        there is no such object.
+        """
+        if (self.batch is None):
+            self.batch = self._start("--batch")
+        line = self._request(self.batch, name)
+        f = line.split()
+        if (len(f) != 3):
+            return None
+        size = int(f[2])
+        data = self.batch.stdout.read(size)
+        # Each object is followed by a newline.
+        self.batch.stdout.read(1)
+        if (len(data) != size):
+            self.close()
+            raise GiveUp("Short read of %s from 'git cat-file' in %s"%(name, self.where))
+        return (f[0], f[1], data)
+
+    def close(self, kill = False):
+        """
+        Stop our processes. 'kill' them if they may be part way through a
+        reply that nobody is going to read.
+        """
+        for proc in (self.batch, self.check):
+            if proc is not None:
+                try:
+                    if kill:
+                        proc.kill()
+                    proc.stdin.close()
+                    proc.wait()
+                except (IOError, OSError):
+                    pass
+        self.batch = None
+        self.check = None
+
+# Maps a repository path to its CatFile.
+g_cat_files = { }
+
+def cat_file(where):
+    """
+    Return the CatFile for the repository in 'where', creating it if needed.
+    """
+    key = os.path.realpath(where)
+    if (key not in g_cat_files):
+        g_cat_files[key] = CatFile(key)
+    return g_cat_files[key]
+
+def close_cat_files(kill = False):
+    """
+    Shut down all our cat-file processes.
+    """
+    for c in g_cat_files.values():
+        c.close(kill)
+    g_cat_files.clear()
+
+atexit.register(close_cat_files)
+
+def commit_message(where, commit_id):
+    """
+    Return the raw message (as "git log --format=%B") of 'commit_id'
+    """
+    obj = cat_file(where).read('%s^{commit}'%commit_id)
+    if (obj is None):
+        raise GiveUp("No commit '%s' in %s"%(commit_id, where))
+    (sha1, kind, data) = obj
+    # The message follows the first blank line
+    idx = data.find('\n\n')
+    if (idx < 0):
+        return ''
+    return data[idx+2:]
+
+def rev_parse(where, name):
+    """
+    Return the SHA1 id of the object 'name' in 'where', or None if there
+    is no such object.
+    """
+    obj = cat_file(where).info(name)
+    if (obj is None):
+        return None
+    return obj[0]
+
+def subtree_id(where, commit_id, path):
+    """
+    Return the SHA1 id of the tree at 'path' in 'commit_id' (the whole
+    tree if 'path' is '.' or empty), or None if there isn't one.
+    """
+    if (commit_id is None):
+        return None
+    path = os.path.normpath(path or '.')
+    if (path == '.'):
+        return rev_parse(where, '%s^{tree}'%commit_id)
+    return rev_parse(where, '%s:%s'%(commit_id, path))
 
-def make_index_match(where, files, verbose = True):
-    run_silently(["git", "add", "-f", "-A" ] + files, cwd=where, verbose=verbose)
+def commit_time(where, commit_id):
+    """
+    Return the committer time of 'commit_id', in seconds since the epoch.
+    """
+    obj = cat_file(where).read('%s^{commit}'%commit_id)
+    if (obj is None):
+        raise GiveUp("No commit '%s' in %s"%(commit_id, where))
+    for line in obj[2].split('\n'):
+        if (len(line) == 0):
+            break
+        if line.startswith('committer '):
+            return int(line.split(' ')[-2])
+    raise GiveUp("Commit %s in %s has no committer"%(commit_id, where))
+
+def init(where, verbose=True):
+    run_silently(["git", "init"], cwd=where, verbose=verbose)
+
+class Stager(object):
+    """Collects paths whose index entries should be made to match the
+    working tree of one repository, so that they can all be staged at once.
+
+    Every "git add" or "git rm" reads and rewrites the whole index, so
+    staging a seam (or a handful of files) at a time soon adds up. Instead,
+    stage() the paths as you go and flush() once: that is one "git rm
+    --cached" for the paths which have gone and one "git add" for the rest,
+    with the paths fed to git on standard input rather than the command line.
+
+    Paths are relative to 'where' (or absolute, within it), and are taken
+    literally - no globs. A directory stands for everything under it.
+    """
+
+    def __init__(self, where, verbose = False):
+        self.where = where
+        self.verbose = verbose
+        self.paths = [ ]
+        self.seen = set()
+
+    def stage(self, paths):
+        for path in paths:
+            if path not in self.seen:
+                self.seen.add(path)
+                self.paths.append(path)
+
+    def pending(self):
+        return len(self.paths)
+
+    def flush(self):
+        """Stage everything we've collected. Returns the number of paths.
+        """
+        if (len(self.paths) == 0):
+            return 0
+        start = time.time()
+        # "git rm --pathspec-from-file" won't run in a subdirectory, so run
+        # everything at the top level, with absolute paths.
+        if os.path.exists(os.path.join(self.where, '.git')):
+            top = self.where
+        else:
+            rv, out = run_silently([ "git", "rev-parse", "--show-toplevel" ],
+                                   cwd = self.where, verbose = self.verbose)
+            top = out.strip()
+        present = [ ]
+        gone = [ ]
+        for path in self.paths:
+            path = os.path.join(os.path.abspath(self.where), path)
+            if os.path.lexists(path):
+                present.append(path)
+            else:
+                gone.append(path)
+        nr_paths = len(self.paths)
+        self.paths = [ ]
+        self.seen = set()
+        from_stdin = [ "--pathspec-from-file=-", "--pathspec-file-nul" ]
+        if (len(gone) > 0):
+            run_silently([ "git", "--literal-pathspecs", "rm", "--cached", "-r", "-q",
+                           "--ignore-unmatch" ] + from_stdin,
+                         cwd = top, input = '\0'.join(gone), verbose = self.verbose)
+        if (len(present) > 0):
+            run_silently([ "git", "--literal-pathspecs", "add", "-f", "-A" ] + from_stdin,
+                         cwd = top, input = '\0'.join(present), verbose = self.verbose)
+        if self.verbose:
+            print "Staged %d path%s (%d gone) in %s in %.2fs"%(nr_paths, '' if nr_paths == 1 else 's',
+                                                             len(gone), self.where, time.time() - start)
+        return nr_paths
 
 def add(where, files, verbose=True):
     run_silently(["git", "add", "-f" ] + files, cwd=where, verbose=verbose)
 
-def clone(dir_into, from_repo, from_branch, from_tag, from_rev):
+def clone(dir_into, from_repo, from_branch, from_tag, from_rev, to_stdout=True):
+    """Clone 'from_repo' into 'dir_into'.
+
+    If 'to_stdout' is false, git's output is captured and returned rather
+    than being written to our stdout.
+    """
     cmd = [ "git", "clone" ]
     if (from_branch is not None):
         cmd.extend([ "--branch", from_branch ])
@@ -37,9 +261,18 @@ def clone(dir_into, from_repo, from_branch, from_tag, from_rev):
         cmd.extend([ "-r", from_rev ])
     cmd.append(from_repo)
     cmd.append(dir_into)
-    run_to_stdout(cmd)
+    if to_stdout:
+        run_to_stdout(cmd)
+    else:
+        rv, out = run_silently(cmd, verbose=False)
+        return out
+
+def pull(dir_into, remote, from_branch, from_tag, from_rev, to_stdout=True):
+    """Pull into 'dir_into' from 'remote'.
 
-def pull(dir_into, remote, from_branch, from_tag, from_rev):
+    If 'to_stdout' is false, git's output is captured and returned rather
+    than being written to our stdout.
+    """
     cmd = [ "git", "pull", remote ]
     # XXX Is the user going to be surprised by this precedence (and the
     # XXX consequent ignoring of values because of it?)
@@ -51,7 +284,33 @@ def pull(dir_into, remote, from_branch, from_tag, from_rev):
         cmd.append(from_rev)
     else:
         cmd.append("master")
-    run_to_stdout(cmd, cwd=dir_into)
+    if to_stdout:
+        run_to_stdout(cmd, cwd=dir_into)
+    else:
+        rv, out = run_silently(cmd, cwd=dir_into, verbose=False)
+        return out
+
+def fetch(dir_into, remote, from_branch, from_tag, from_rev, to_stdout=True):
+    """Fetch into 'dir_into' from 'remote', as pull() would, but leave the
+    checkout alone. What was fetched is left in FETCH_HEAD.
+
+    If 'to_stdout' is false, git's output is captured and returned rather
+    than being written to our stdout.
+    """
+    cmd = [ "git", "fetch", remote ]
+    if (from_branch is not None):
+        cmd.append(from_branch)
+    elif (from_tag is not None):
+        cmd.append(from_tag)
+    elif (from_rev is not None):
+        cmd.append(from_rev)
+    else:
+        cmd.append("master")
+    if to_stdout:
+        run_to_stdout(cmd, cwd=dir_into)
+    else:
+        rv, out = run_silently(cmd, cwd=dir_into, verbose=False)
+        return out
 
 def push(where, uri = None, branch = None, verbose=True):
     """Push.
@@ -174,9 +433,7 @@ def log(where, commit_id):
     """
     Get the log entry for a commit
     """
-    rv, out = run_silently(["git", "log", "-n", "1", "--format=format:%B", commit_id],
-                       cwd=where)
-    return out
+    return commit_message(where, commit_id)
 
 def log_between(where, from_id, to_id, paths=None, verbose=False, opts = None):
     """Do a git log for "<from_id>..<to_id> -- <paths>"
@@ -197,89 +454,149 @@ def log_between(where, from_id, to_id, paths=None, verbose=False, opts = None):
     rv, changes = run_silently(cmd, cwd=where, verbose=verbose)
     return changes.splitlines()
 
+def iter_log_messages(where, from_id, to_id, grep = None, verbose = True):
+    """Iterate over the messages of the commits in "<from_id>..<to_id>"
 
-def query_current_commit_id(where):
-    """
-    Retrieve the commit id for the current point in where
-    """
-    rv, out = run_silently(["git", "log", "-n", "1", "--format=format:%H"], cwd=where)
-    return out.strip()
+    If 'from_id' is None, then all the ancestors of 'to_id' are included.
+    If 'grep' is given, it is an extended regular expression, and only
+    commits with a line matching it are returned.
 
-def query_merge(where, base):
-    """Return the id of the last commit which contained a merge for this 'base'
+    Yields (commit_id, commit_time, message), most recent first (that is,
+    in "git log" order). 'commit_time' is in seconds since the epoch.
 
-    Finds the last "X-Weld-State: Merged <base>" commit, and returns its
-    SHA1 id.
-
-    If there wasn't one, return None.
+    The log is read as git produces it, so a caller that stops iterating
+    early doesn't pay for the rest of the history - git is killed.
     """
-    rv, out = run_silently(["git", "log", "--grep=%s"%(header_grep_merge(base)),
-                            "-E", "--oneline", "--no-abbrev-commit"], cwd=where)
-    lines = out.splitlines()
-    if (len(lines) > 0):
-        f = lines[0].split(' ')
-        return f[0]
+    cmd = [ "git", "log", "-z", "--format=%H %ct%n%B" ]
+    if (grep is not None):
+        cmd += [ "-E", "--grep=%s"%grep ]
+    if (from_id is not None):
+        cmd += [ "%s..%s"%(from_id, to_id) ]
     else:
-        return None
+        cmd += [ to_id ]
+    if (verbose):
+        print "> %s"%(" ".join(cmd))
+    errors = tempfile.TemporaryFile()
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=errors, cwd=where)
+    finished = False
+    try:
+        fd = proc.stdout.fileno()
+        pending = ''
+        while True:
+            chunk = os.read(fd, 65536)
+            if (len(chunk) == 0):
+                break
+            entries = (pending + chunk).split('\0')
+            pending = entries.pop()
+            for entry in entries:
+                (first, nl, message) = entry.partition('\n')
+                (cid, commit_time) = first.split(' ')
+                yield (cid, int(commit_time), message)
+        finished = True
+    finally:
+        if not finished:
+            proc.kill()
+        proc.stdout.close()
+        rv = proc.wait()
+        errors.seek(0)
+        text = errors.read()
+        errors.close()
+    if (rv != 0):
+        parts = [ "Command '%s' returned non-zero exit status %d"%(" ".join(cmd), rv) ]
+        parts.extend(['  {}'.format(x) for x in text.splitlines()])
+        raise GiveUp('\n'.join(parts))
+
+def log_messages(where, from_id, to_id, grep = None, verbose = True):
+    """As iter_log_messages(), but returns a list.
+    """
+    return list(iter_log_messages(where, from_id, to_id, grep = grep, verbose = verbose))
 
-def query_push(where, base):
-    """Return the id of the last commit which contained a push of this 'base'
+def is_ancestor(where, ancestor_id, commit_id):
+    """
+    Is 'ancestor_id' an ancestor of (or the same as) 'commit_id'?
 
-    Finds the last "X-Weld-State: Pushed <base>" commit, and returns its
-    SHA1 id.
+    Returns False if either commit is not known.
+    """
+    rv, out = run_silently(["git", "merge-base", "--is-ancestor", ancestor_id, commit_id],
+                           cwd=where, allowFailure=True, verbose=False)
+    return (rv == 0)
 
-    If there wasn't one, return None.
+def list_parents(where, from_id, to_id, verbose = False):
     """
-    rv, out = run_silently(["git", "log", "--grep=%s"%(header_grep_push(base)),
-                            "-E", "--oneline", "--no-abbrev-commit"], cwd=where)
-    lines = out.splitlines()
-    if (len(lines) > 0):
-        f = lines[0].split(' ')
-        return f[0]
+    Return a dictionary mapping each commit in "<from_id>..<to_id>" (or
+    all the ancestors of 'to_id', if 'from_id' is None) to the list of its
+    parents.
+    """
+    cmd = [ "git", "rev-list", "--parents" ]
+    if (from_id is not None):
+        cmd += [ "%s..%s"%(from_id, to_id) ]
     else:
-        return None
-
-def query_merge_or_push(where, base):
-    """Return the id of the last commit which contained a merge or push of this 'base'
-
-    Finds the last "X-Weld-State: Pushed <base>", or
-    "X-Weld-State: Merged <base>" commit, and returns its SHA1 id.
-
-    If there wasn't one, return None.
+        cmd += [ to_id ]
+    rv, out = run_silently(cmd, cwd=where, verbose=verbose)
+    parents = { }
+    for line in out.splitlines():
+        ids = line.split()
+        if ids:
+            parents[ids[0]] = ids[1:]
+    return parents
+
+def log_raw_changes(where, from_id, to_id, paths = None, verbose = False):
     """
-    rv, out = run_silently(["git", "log",
-                            "--grep=%s"%(header_grep_push(base)),
-                            "--grep=%s"%(header_grep_merge(base)),
-                            "-E", "--oneline", "--no-abbrev-commit"], cwd=where)
-    lines = out.splitlines()
-    if (len(lines) > 0):
-        f = lines[0].split(' ')
-        return f[0]
+    Return the commits in "<from_id>..<to_id> -- <paths>" with the files
+    they change, in one pass.
+
+    Returns a list of (commit_id, header, raw_lines), most recent first.
+    'header' is the "<id> <date> <author>" line followed by the message
+    indented by three spaces (the "summary" log style), and 'raw_lines'
+    is the list of "git whatchanged" lines for the files under 'paths'.
+    Merges are compared against each of their parents, as with
+    "whatchanged -m"; their raw lines are collected together.
+    """
+    # %w() can't be used here - git wraps with C strings, and our NUL
+    # separators would truncate the header. We indent the message ourselves.
+    cmd = [ "git", "--no-pager", "log", "-m", "--raw", "--full-history",
+            "--format=%x00%H %ci %an <%ae> %n%B%x00" ]
+    if (from_id is not None):
+        cmd += [ "%s..%s"%(from_id, to_id) ]
     else:
-        return None
+        cmd += [ to_id ]
+    if paths:
+        cmd += [ "--" ] + paths
+    rv, out = run_silently(cmd, cwd=where, verbose=verbose)
+    result = [ ]
+    by_id = { }
+    fields = out.split('\0')
+    # fields[0] is empty; then (header, raw) pairs follow.
+    for i in range(1, len(fields) - 1, 2):
+        text = fields[i]
+        raw = [ l for l in fields[i+1].splitlines() if l.startswith(':') ]
+        cid = text[:text.find(' ')]
+        if cid in by_id:
+            entry = by_id[cid]
+            for l in raw:
+                if l not in entry[2]:
+                    entry[2].append(l)
+            continue
+        lines = text.rstrip('\n').split('\n')
+        header = '\n'.join([ lines[0] ] +
+                           [ '   %s'%l for l in lines[1:] ])
+        entry = (cid, header, raw)
+        by_id[cid] = entry
+        result.append(entry)
+    return result
 
-def query_init(where):
+
+def query_current_commit_id(where):
     """
-    Query the weld init commit
+    Retrieve the commit id for the current point in where
     """
-    rv, out = run_silently(["git", "log", "--grep=%s"%(header_grep_init()),
-                            "-E", "--oneline", "--no-abbrev-commit"], cwd=where)
-    lines = out.splitlines()
-    if (len(lines) > 0):
-        f = lines[0].split(' ')
-        return f[0]
-    raise GiveUp("Cannot find a weld init line in history")
-
+    cid = rev_parse(where, 'HEAD^{commit}')
+    if (cid is None):
+        raise GiveUp("Cannot find a HEAD commit in %s"%where)
+    return cid
 
 def has_branch(where, branch_name):
-    rv, out = run_silently(["git", "branch", "-v"], cwd=where)
-    lines = out.split('\n')
-    for l in lines:
-        l = l[1:].strip()
-        f = l.split(' ')
-        if (len(f) > 1 and f[0]== branch_name):
-            return True
-    return False
+    return (rev_parse(where, 'refs/heads/%s'%branch_name) is not None)
 
 def new_branch_name(where, base_name, commit_id=None):
     """Construct a unique branch name given 'base_name' and 'commit_id'
@@ -314,6 +631,104 @@ def tag(where, name, commit_id, force=True, verbose=False):
         cmd = ['git', 'tag', name, commit_id]
     run_silently(cmd, cwd=where, verbose=verbose)
 
+def list_refs(where, prefix, verbose=False):
+    """Return the names of all the refs starting with 'prefix'
+    """
+    rv, out = run_silently(["git", "for-each-ref", "--format=%(refname)", prefix],
+                           cwd=where, verbose=verbose)
+    return out.split()
+
+def update_refs(where, updates, verbose=False):
+    """Set (or delete) several refs at once.
+
+    'updates' is a list of (refname, commit_id) pairs. If 'commit_id' is
+    None, the ref is deleted.
+    """
+    if (len(updates) == 0):
+        return
+    lines = [ ]
+    for (ref, cid) in updates:
+        if (cid is None):
+            lines.append('delete %s\n'%ref)
+        else:
+            lines.append('update %s %s\n'%(ref, cid))
+    run_silently(["git", "update-ref", "--stdin"], cwd=where, verbose=verbose,
+                 input=''.join(lines))
+
+def fetch_commit(where, from_repo, commit_id, ref, verbose=False):
+    """
+    Fetch 'commit_id' (and everything it needs) from the repository
+    'from_repo' into 'where', and point 'ref' at it so that the next fetch
+    only needs to bring over what has changed since. If 'ref' is None, the
+    commit is only remembered in FETCH_HEAD.
+    """
+    if (ref is None):
+        refspec = commit_id
+    else:
+        refspec = "+%s:%s"%(commit_id, ref)
+    run_silently([ "git", "fetch", "--no-tags", "--quiet", from_repo, refspec ],
+                 cwd=where, verbose=verbose)
+
+def write_tree(where, index_file = None, verbose=False):
+    """
+    Write the index (or 'index_file', if given) of 'where' as a tree, and
+    return its SHA1 id.
+    """
+    env = None
+    if (index_file is not None):
+        env = with_env([ ("GIT_INDEX_FILE", index_file) ])
+    rv, out = run_silently([ "git", "write-tree" ], cwd=where, env=env, verbose=verbose)
+    return out.strip()
+
+def read_tree(where, tree_id, prefix = None, index_file = None, verbose=False):
+    """
+    Read the tree 'tree_id' into the index (or 'index_file', if given) of
+    'where'. If 'prefix' is given, the tree is added under that directory
+    rather than replacing the index, as "git read-tree --prefix".
+    """
+    cmd = [ "git", "read-tree" ]
+    if (prefix is not None):
+        cmd.append("--prefix=%s/"%prefix)
+    cmd.append(tree_id)
+    env = None
+    if (index_file is not None):
+        env = with_env([ ("GIT_INDEX_FILE", index_file) ])
+    run_silently(cmd, cwd=where, env=env, verbose=verbose)
+
+def remove_from_index(where, path, index_file = None, verbose=False):
+    """
+    Remove everything under 'path' from the index (or 'index_file', if
+    given) of 'where', leaving the working tree alone.
+    """
+    env = None
+    if (index_file is not None):
+        env = with_env([ ("GIT_INDEX_FILE", index_file) ])
+    run_silently([ "git", "rm", "--cached", "-r", "-q", "--ignore-unmatch", "--", path ],
+                 cwd=where, env=env, verbose=verbose)
+
+def commit_tree(where, tree_id, parents, message_file, verbose=False):
+    """
+    Make a commit of the tree 'tree_id' with the given 'parents' and the
+    message in 'message_file', without touching any branch, index or
+    working tree. Returns the new commit's SHA1 id.
+    """
+    cmd = [ "git", "commit-tree", tree_id ]
+    for p in parents:
+        cmd.extend([ "-p", p ])
+    cmd.extend([ "-F", message_file ])
+    rv, out = run_silently(cmd, cwd=where, verbose=verbose)
+    return out.strip()
+
+def switch_tree(where, from_tree, to_tree, verbose=False):
+    """
+    Move the index and working tree of 'where' from the tree 'from_tree'
+    (which must be what is in the index) to 'to_tree', touching only the
+    files which differ. Raises GiveUp, having changed nothing, if that
+    would lose local changes.
+    """
+    run_silently([ "git", "read-tree", "-m", "-u", from_tree, to_tree ],
+                 cwd=where, verbose=verbose)
+
 def hard_reset(where):
     run_silently(['git', 'reset', '--hard'], cwd = where)
 
@@ -376,6 +791,31 @@ def rebase(spec, upstream, branch = None, onto = None):
         cmd.append(branch)
     run_to_stdout(cmd, cwd=spec.base_dir)
   
+def add_worktree(where, path, commit_id, new_branch_name=None, verbose=False):
+    """Check out 'commit_id' in a new linked working tree at 'path', so
+    that the working tree in 'where' is left alone.
+
+    If 'new_branch_name' is given, create that branch there; otherwise
+    the new working tree has a detached HEAD.
+    """
+    cmd = [ 'git', 'worktree', 'add' ]
+    if (new_branch_name is not None):
+        cmd.extend([ '-b', new_branch_name ])
+    else:
+        cmd.append('--detach')
+    cmd.extend([ path, commit_id ])
+    run_silently(cmd, cwd=where, verbose=verbose)
+
+def remove_worktree(where, path, verbose=False):
+    """Remove the linked working tree at 'path' (and any changes in it),
+    leaving its branch behind.
+    """
+    if os.path.exists(path):
+        run_silently([ 'git', 'worktree', 'remove', '--force', path ],
+                     cwd=where, verbose=verbose, allowFailure=True)
+    # In case it was removed by hand.
+    run_silently([ 'git', 'worktree', 'prune' ], cwd=where, verbose=verbose)
+
 def switch_branch(where, to_branch):
     run_silently([ "git", "checkout", to_branch ], cwd=where)
 
@@ -486,13 +926,15 @@ def show(where, cid):
     f.file.write(out)
     return f
 
-def show_diff(where, from_cid, to_cid, relative_to = None):
+def diff_command(from_cid, to_cid, relative_to = None, paths = None, no_renames = False):
     """
-    Returns a temporary file containing the diffs from from to to.
+    Returns the "git diff" command line for the diffs from from to to,
+    relative to the directory 'relative_to' if it is given, and limited
+    to 'paths' if they are given.
     """
-    f = tempfile.NamedTemporaryFile(prefix="/tmp/weldcid%s"%to_cid, delete=False)
-    # @todo Could be very much more efficient (and prolly needs to be)
     cmd = ["git", "diff", "--binary"]
+    if no_renames:
+        cmd.extend([ "--no-renames", "--src-prefix=a/", "--dst-prefix=b/" ])
     cmd.append("%s..%s"%(from_cid, to_cid))
     if (relative_to is not None and 
         (len(relative_to) > 0)):
@@ -500,10 +942,146 @@ def show_diff(where, from_cid, to_cid, relative_to = None):
             cmd.extend([ "--relative=%s/"%relative_to ])
         else:
             cmd.extend([ "--relative=%s"%relative_to ])
-    rv, out = run_silently(cmd, cwd=where)
-    f.file.write(out)
+    if paths:
+        cmd.extend([ "--" ] + paths)
+    return cmd
+
+def relocate_diff(lines, relocate):
+    """
+    Rewrite the paths in the "git diff --no-renames" output 'lines' (an
+    iterable of lines) with the function 'relocate', which maps a path in
+    the diff to the path we want instead.
+
+    Yields the rewritten lines. Raises GiveUp if a path can't be rewritten
+    (because it is quoted, or 'relocate' returns None for it).
+    """
+    header = re.compile(r'^diff --git a/(.*) b/(.*)$')
+    in_header = False
+    for l in lines:
+        if (l.startswith('diff --git ')):
+            m = header.match(l.rstrip('\n'))
+            if (m is None or m.group(1) != m.group(2)):
+                raise GiveUp("Cannot relocate diff header '%s'"%l.rstrip('\n'))
+            path = relocate(m.group(1))
+            if (path is None):
+                raise GiveUp("Cannot relocate '%s'"%m.group(1))
+            l = 'diff --git a/%s b/%s\n'%(path, path)
+            in_header = True
+        elif in_header:
+            if (l.startswith('--- a/') or l.startswith('+++ b/')):
+                l = '%s%s\n'%(l[:6], path)
+            elif (l.startswith('@@') or l.startswith('GIT binary patch')):
+                in_header = False
+        yield l
+
+def show_diff(where, from_cid, to_cid, relative_to = None):
+    """
+    Returns a temporary file containing the diffs from from to to.
+    """
+    f = tempfile.NamedTemporaryFile(prefix="/tmp/weldcid%s"%to_cid, delete=False)
+    write_diff(where, from_cid, to_cid, f.file, relative_to = relative_to)
     return f
 
+def write_diff(where, from_cid, to_cid, fh, relative_to = None, verbose = True):
+    """
+    Write the diffs from from to to straight into the open file 'fh',
+    without holding them in memory.
+    """
+    cmd = diff_command(from_cid, to_cid, relative_to)
+    if (verbose):
+        print "> %s"%(" ".join(cmd))
+    fh.flush()
+    errors = tempfile.TemporaryFile()
+    rv = subprocess.call(cmd, stdout=fh, stderr=errors, cwd=where)
+    if (rv != 0):
+        errors.seek(0)
+        raise GiveUp("'%s' failed in %s (%d)\n%s"%(" ".join(cmd), where, rv, errors.read()))
+
+def apply_diff(where, from_cid, to_cid, dest, relative_to = None, directory = None,
+               paths = None, relocate = None, verbose = False):
+    """Apply the diffs from from to to in 'where' to the repository 'dest'.
+
+    The output of "git diff" is fed straight into "git apply --index" (see
+    apply_patch() for 'directory'), so the diff is never held in memory or
+    written to disk. If the diff is empty, "git apply" isn't run at all.
+
+    If 'relocate' is given, renames are turned off and every path in the
+    diff is rewritten with it on the way through (see relocate_diff()). If
+    that fails, "git apply" is killed before it has seen the whole patch,
+    so nothing is applied, and the failure is reported as for a bad patch.
+
+    Returns (size, errors): the size of the diff in bytes, and None if it
+    applied, or else the output of "git apply". Raises GiveUp if we can't
+    make the diff in the first place.
+    """
+    diff_cmd = diff_command(from_cid, to_cid, relative_to, paths = paths,
+                            no_renames = (relocate is not None))
+    apply_cmd = ['git', 'apply', '--index', '--whitespace=nowarn' ]
+    if directory is not None:
+        apply_cmd.append('--directory=%s'%directory)
+    apply_cmd.append('-')
+    if (verbose):
+        print "> %s | (cd %s && %s)"%(" ".join(diff_cmd), dest, " ".join(apply_cmd))
+
+    diff_errors = tempfile.TemporaryFile()
+    apply_output = tempfile.TemporaryFile()
+    diff_proc = subprocess.Popen(diff_cmd, stdout=subprocess.PIPE, stderr=diff_errors, cwd=where)
+    apply_proc = None
+    size = 0
+    finished = False
+    bad_relocation = None
+    if (relocate is None):
+        fd = diff_proc.stdout.fileno()
+        chunks = iter(lambda: os.read(fd, 65536), '')
+    else:
+        chunks = relocate_diff(iter(diff_proc.stdout.readline, ''), relocate)
+    try:
+        while True:
+            try:
+                chunk = next(chunks, '')
+            except GiveUp as e:
+                bad_relocation = str(e)
+                break
+            if (len(chunk) == 0):
+                finished = True
+                break
+            if (apply_proc is None):
+                apply_proc = subprocess.Popen(apply_cmd, stdin=subprocess.PIPE,
+                                              stdout=apply_output, stderr=subprocess.STDOUT,
+                                              cwd=dest)
+            size += len(chunk)
+            try:
+                apply_proc.stdin.write(chunk)
+            except IOError:
+                # git apply has given up; it will tell us why.
+                break
+    finally:
+        if (apply_proc is not None):
+            if (bad_relocation is not None):
+                # Don't let git apply see a truncated patch.
+                apply_proc.kill()
+            try:
+                apply_proc.stdin.close()
+            except IOError:
+                pass
+            apply_rv = apply_proc.wait()
+        if (not finished) and (diff_proc.poll() is None):
+            diff_proc.kill()
+        diff_proc.stdout.close()
+        diff_rv = diff_proc.wait()
+
+    if (bad_relocation is not None):
+        return (max(size, 1), bad_relocation)
+    if (apply_proc is not None and apply_rv != 0):
+        apply_output.seek(0)
+        return (size, "'%s' failed (%d)\n%s"%(" ".join(apply_cmd), apply_rv,
+                                              apply_output.read()))
+    if (diff_rv != 0):
+        diff_errors.seek(0)
+        raise GiveUp("'%s' failed in %s (%d)\n%s"%(" ".join(diff_cmd), where, diff_rv,
+                                                  diff_errors.read()))
+    return (size, None)
+
     
 def apply_patch_file(where, patch_file):
     """
@@ -528,6 +1106,67 @@ def list_files(where, verbose=False):
     lines = text.splitlines()
     return lines
 
+def iter_files(where, verbose=False):
+    """Iterate over the files listed by "git ls-files" in 'where'
+
+    Yields paths relative to 'where', as git produces them, so that even
+    an enormous tree never has to be held as one list (or command line).
+    """
+    cmd = [ "git", "ls-files", "-z" ]
+    if (verbose):
+        print "> %s"%(" ".join(cmd))
+    errors = tempfile.TemporaryFile()
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=errors, cwd=where)
+    finished = False
+    try:
+        fd = proc.stdout.fileno()
+        pending = ''
+        while True:
+            chunk = os.read(fd, 65536)
+            if (len(chunk) == 0):
+                break
+            names = (pending + chunk).split('\0')
+            pending = names.pop()
+            for name in names:
+                yield name
+        finished = True
+    finally:
+        if not finished:
+            proc.kill()
+        proc.stdout.close()
+        rv = proc.wait()
+        errors.seek(0)
+        text = errors.read()
+        errors.close()
+    if (rv != 0):
+        parts = [ "Command '%s' returned non-zero exit status %d"%(" ".join(cmd), rv) ]
+        parts.extend(['  {}'.format(x) for x in text.splitlines()])
+        raise GiveUp('\n'.join(parts))
+
+def list_file_ids(where, verbose=False):
+    """Return the files listed by "git ls-files -s" in 'where'
+
+    Returns a dictionary mapping each path, relative to 'where', to a
+    (mode, blob id) tuple for its entry in the index.
+    """
+    rv, text = run_silently(["git", "ls-files", "-s", "-z"], cwd=where, verbose=verbose)
+    files = { }
+    for entry in text.split('\0'):
+        if (len(entry) == 0):
+            continue
+        (info, path) = entry.split('\t', 1)
+        (mode, blob_id, stage) = info.split(' ')
+        files[path] = (mode, blob_id)
+    return files
+
+def list_modified_files(where, verbose=False):
+    """Return the set of files in 'where' whose working tree copy doesn't
+    match the index (as "git diff-files" sees it), relative to 'where'
+    """
+    rv, text = run_silently(["git", "diff-files", "--name-only", "--relative", "-z"],
+                            cwd=where, verbose=verbose)
+    return set([ f for f in text.split('\0') if len(f) > 0 ])
+
 def rm(where, files, verbose=True, force = True):
     """Delete the named files
 
@@ -538,9 +1177,61 @@ def rm(where, files, verbose=True, force = True):
         cmd.append('-f')
     run_silently(cmd + files, cwd=where, verbose=verbose)
 
-def should_we_pull_or_push(remote_name='origin', branch_name='master', cwd=None, verbose=False):
+def ls_remote_head(where, remote_name, branch_name, verbose=False):
+    """
+    Ask 'remote_name' for the HEAD of 'branch_name'. Returns its SHA1 id,
+    or None if the remote has no such branch.
+    """
+    rv, out = run_silently(['git', 'ls-remote', remote_name, branch_name],
+                           cwd=where, verbose=verbose)
+    lines = out.splitlines()
+    if len(lines) == 0 or lines[0].strip() == '':
+        return None
+    return lines[0].split()[0]
+
+def remote_tracking_head(where, remote_name, branch_name):
+    """
+    Return what we last heard of 'branch_name' on 'remote_name' (from its
+    remote-tracking ref), or None if we've never heard of it.
+    """
+    return rev_parse(where, 'refs/remotes/%s/%s^{commit}'%(remote_name, branch_name))
+
+def ahead_behind(where, local, other, verbose=False):
+    """
+    Return (ahead, behind): the number of commits in 'local' that are not
+    in 'other', and the number in 'other' that are not in 'local'.
+    """
+    rv, out = run_silently(['git', 'rev-list', '--left-right', '--count',
+                            '%s...%s'%(local, other)], cwd=where, verbose=verbose)
+    words = out.split()
+    if len(words) != 2:
+        raise GiveUp("Cannot understand 'git rev-list --left-right --count' output '%s'"%out.strip())
+    return int(words[0]), int(words[1])
+
+def count_commits(where, since, until, paths=None, verbose=False):
+    """
+    Return the number of commits in 'until' that are not in 'since' (all
+    of them, if 'since' is None) - only those which touch 'paths', if that
+    is given.
+    """
+    if since is None:
+        commits = until
+    else:
+        commits = '%s..%s'%(since, until)
+    cmd = ['git', '--literal-pathspecs', 'rev-list', '--count', commits]
+    if paths is not None:
+        cmd.append('--')
+        cmd.extend(paths)
+    rv, out = run_silently(cmd, cwd=where, verbose=verbose)
+    return int(out.strip())
+
+def should_we_pull_or_push(remote_name='origin', branch_name='master', cwd=None, verbose=False,
+                           remote_head=None):
     """Is there something to pull from/push to our remote?
 
+    If 'remote_head' is given, it is the HEAD of the branch on our remote,
+    and we don't ask the remote for it.
+
     Returns one of:
 
     * None, None  - there is no remote
@@ -549,16 +1240,14 @@ def should_we_pull_or_push(remote_name='origin', branch_name='master', cwd=None,
     * False, False - neither is necessary
     """
 
-    # Get the HEAD of that branch on our remote
-    rv, line = run_silently(['git', 'ls-remote', remote_name, branch_name],
-                            cwd=cwd, verbose=verbose)
-    if line == '':
+    if remote_head is None:
+        # Get the HEAD of that branch on our remote
+        remote_head = ls_remote_head(cwd, remote_name, branch_name, verbose=verbose)
+    if remote_head is None:
         # There is no remote, so we can't see its HEAD(!)
         if verbose:
             print 'There is no remote, so we cannot pull or push'
         return None, None
-    words = line.split()
-    remote_head = words[0]
     if verbose:
         print 'The HEAD of %s/%s is %s'%(remote_name, branch_name, remote_head[:10])
 
@@ -566,62 +1255,31 @@ def should_we_pull_or_push(remote_name='origin', branch_name='master', cwd=None,
         print 'Should we "git pull"?'
 
     # Does that exist here? If not, we presumably need to pull...
-    try:
-        # Is the given SHA1 a known commit object?
-        # Find out by asking what (local) branch it is on...
-        # We don't allow "verbose" to be true because if it "goes wrong" it
-        # output the appropriate error diagnostic followed by a help message
-        # on how to use "git branch", which is a bit distracting...
-        run_silently(['git', 'branch', '--contains', remote_head],
-                     cwd=cwd, verbose=False)
-        if verbose:
-            # Repeat the command to show the branch name...
-            run_to_stdout(['git', 'branch', '--contains', remote_head],
-                          cwd=cwd, verbose=True)
-            print 'No, because we already know that commit'
-        should_pull = False
-    except GiveUp as e:
-        # Let's assume that there's only one reason for this...
+    if rev_parse(cwd, '%s^{commit}'%remote_head) is None:
         if verbose:
-            print e.message.splitlines()[0]
             print 'Yes, because we do not know that commit'
-        should_pull = True
+        return True, None
 
+    (ahead, behind) = ahead_behind(cwd, branch_name, remote_head, verbose=verbose)
     if verbose:
+        print 'Local %s is %d commit%s ahead of and %d commit%s behind %s/%s'%(
+            branch_name, ahead, '' if ahead==1 else 's', behind, '' if behind==1 else 's',
+            remote_name, branch_name)
+    if behind > 0:
+        if verbose:
+            print 'Yes, because the remote has commits we do not'
+            print 'No, we should not push, because we need to pull first'
+        # see docstring above
+        return True, None
+    if verbose:
+        print 'No, because we already have that commit'
         print 'Should we "git push"?'
-
-    should_push = None
-
-    # Assuming that exists here (i.e., that we don't need to pull), does
-    # it match our HEAD?
-    rv, local_head = run_silently(['git', 'rev-parse', branch_name],
-                                  cwd=cwd, verbose=verbose)
-    local_head = local_head.strip()
-    if remote_head == local_head:
-        should_push = False
+    if ahead > 0:
         if verbose:
-            print local_head
-            print 'No, because remote HEAD matches local HEAD'
-    else:
-        should_push = True
-        # How far behind are we?
-        try:
-            rv, lines = run_silently(['git', 'rev-list', '%s..%s'%(remote_head, branch_name)],
-                                     cwd=cwd, verbose=verbose)
-        except GiveUp:
-            # It presumably wasn't an ancestor commit - oh dear
-            if verbose:
-                print '%s does not appear to be an ancestor of HEAD of %s'%(remote_head[:10],
-                        branch_name)
-                print 'No, we should not push, because we probably need to pull'
-            should_push = None         # see docstring above
-
-        if should_push is not None and verbose:
-            count = len(lines.splitlines())
-            print 'Local %s is %d commit%s ahead of %s/%s'%(branch_name,
-                    count, '' if count==1 else 's', remote_name, branch_name)
             print 'Yes'
-
-    return should_pull, should_push
+        return False, True
+    if verbose:
+        print 'No, because remote HEAD matches local HEAD'
+    return False, False
 
 # End file.
@@ -25,6 +25,21 @@ def decode_headers(log_entry):
             rv.append( ( m.group(1), m.group(2) ) )
     return rv
 
+def decode_markers(log_entry):
+    """
+    Returns a list [ ( verb, base_name ) ] naming every weld state header,
+    including the Seam-* ones. 'base_name' is None if the header has no base
+    (e.g. "Init").
+    """
+    rv = [ ]
+    rep = re.compile(r'^X-Weld-State:\s+([A-Za-z0-9-]+)\s*([^/\s]*)(/?)', re.MULTILINE)
+    for m in rep.finditer(log_entry):
+        if m.group(3):
+            rv.append( ( m.group(1), m.group(2) ) )
+        else:
+            rv.append( ( m.group(1), None ) )
+    return rv
+
 def decode_commit_headers(log_entry):
     """
     Returns a list of commit headers [ (verb, base, cid_from, cid_to) ]
@@ -105,6 +120,9 @@ def header_grep_push(base):
 def header_grep_init():
     return "^X-Weld-State: Init"
 
+def header_grep_any():
+    return "^X-Weld-State: "
+
 
 def pickle_seams(seams):
     t = [ ]
@@ -6,6 +6,7 @@ import os
 
 import welded.layout as layout
 import welded.git as git
+import welded.markers as markers
 
 from welded.utils import GiveUp
 from welded.headers import header_init
@@ -24,6 +25,7 @@ def adopt_weld(weld,where):
         f.write(".weld/state/**\n")
         f.write(".weld/pushing\n")
         f.write(".weld/bases\n")
+        f.write(".weld/cache/**\n")
         # In case you edit stuff.
         f.write(".weld/*~\n")
         f.write(".weld/bases/**\n")
@@ -35,6 +37,7 @@ def adopt_weld(weld,where):
 
     # Commit.
     git.commit(where, "Weld initialisation", [ header_init() ])
+    markers.update_sync_refs(where)
     print("Weld initialised OK.\n")
 
     
@@ -10,26 +10,53 @@ def weld_dir(base_dir):
 def state_dir(base_dir):
     return os.path.join(base_dir, '.weld', 'state')
 
+def cache_dir(base_dir):
+    return os.path.join(base_dir, '.weld', 'cache')
+
+def marker_index_file(base_dir):
+    return os.path.join(base_dir, '.weld', 'cache', 'markers.bin')
+
+def marker_index_file_x(base_dir):
+    return os.path.join(base_dir, '.weld', 'cache', 'markers.bin.x')
+
+def spec_cache_file(base_dir):
+    return os.path.join(base_dir, '.weld', 'cache', 'welded.bin')
+
+def remote_heads_cache_file(base_dir):
+    return os.path.join(base_dir, '.weld', 'cache', 'remote_heads.json')
+
+def remote_heads_cache_file_x(base_dir):
+    return os.path.join(base_dir, '.weld', 'cache', 'remote_heads.json.x')
+
+def base_status_cache_file(base_dir):
+    return os.path.join(base_dir, '.weld', 'cache', 'base_status.json')
+
+def base_status_cache_file_x(base_dir):
+    return os.path.join(base_dir, '.weld', 'cache', 'base_status.json.x')
+
 def command_file(base_dir):
     return os.path.join(base_dir, '.weld', 'current_cmd')
 
-def pending_verb_dir(base_dir):
-    return os.path.join(base_dir, '.weld', 'state', 'pending_verbs')
-
-def pending_verb_file(base_dir, verb):
-    return os.path.join(base_dir, '.weld', 'state', 'pending_verbs', '%s.py'%verb)
+def state_db_file(base_dir):
+    return os.path.join(base_dir, '.weld', 'state', 'state.db')
 
-def state_data_file(base_dir):
+def legacy_state_data_file(base_dir):
     return os.path.join(base_dir, '.weld', 'state', 'data.bin')
 
-def state_data_file_x(base_dir):
-    return os.path.join(base_dir, '.weld', 'state', 'data.bin.x')
+def verb_table_file(base_dir):
+    return os.path.join(base_dir, '.weld', 'state', 'verbs.json')
+
+def verb_table_file_x(base_dir):
+    return os.path.join(base_dir, '.weld', 'state', 'verbs.json.x')
 
-def verb_dir(base_dir):
+def legacy_verb_dir(base_dir):
     return os.path.join(base_dir, '.weld', 'state', 'verbs')
 
-def verb_file(base_dir,verb):
-    return os.path.join(base_dir, '.weld', 'state', 'verbs', '%s.py'%verb)
+def legacy_pending_verb_dir(base_dir):
+    return os.path.join(base_dir, '.weld', 'state', 'pending_verbs')
+
+def server_socket(base_dir):
+    return os.path.join(base_dir, '.weld', 'state', 'server.sock')
 
 def spec_file(base_dir):
     return os.path.join(base_dir, ".weld", "welded.xml")
@@ -40,6 +67,9 @@ def base_repo(base_dir, base):
 def count_file(base_dir):
     return os.path.join(base_dir, ".weld", "counter")
 
+def worktree_dir(base_dir):
+    return os.path.join(base_dir, '.weld', 'state', 'worktree')
+
 def pushing_dir(base_dir):
     return os.path.join(base_dir, '.weld', 'state', 'pushing')
 
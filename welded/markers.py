@@ -0,0 +1,311 @@
+"""
+markers.py - An index of the weld state markers in a weld's history
+
+Finding the last "X-Weld-State: Merged <base>" (and so on) with "git log
+--grep" costs a scan of the whole history every time. Instead, we keep a
+table of the most recent commit carrying each kind of marker, together with
+the HEAD it was built for, in the weld's cache directory. When HEAD moves
+forward we only need to look at the new commits; if it moves anywhere else,
+we rebuild the table from scratch.
+
+The last merge and push of each base, and the Init commit, are also kept
+as refs:
+
+    refs/weld/bases/<base>/last-merge
+    refs/weld/bases/<base>/last-push
+    refs/weld/init
+
+with refs/weld/head naming the HEAD they were recorded for. While that is
+still HEAD, looking up a sync point is just a ref read.
+"""
+
+import os
+import re
+
+try:
+    import cPickle as pickle
+except:
+    import pickle
+
+import welded.git as git
+import welded.layout as layout
+import welded.ops as ops
+
+from welded.headers import decode_markers, header_grep_any
+from welded.utils import GiveUp
+
+# Bump this if the format of the index changes.
+INDEX_VERSION = 2
+
+class MarkerIndex(object):
+    """
+    Maps ( verb, base_name ) to ( position, commit_id ) for the most
+    recent commit on HEAD with an "X-Weld-State: <verb> <base_name>/..." header.
+
+    'base_name' is None for headers which don't name a base ("Init").
+
+    'position' is where the commit comes in "git log" order, counting up
+    from the oldest commit we've indexed, so the larger of two positions is
+    the commit "git log --grep" would have found first - even when the two
+    were committed in the same second.
+    """
+
+    def __init__(self, where):
+        self.where = where
+        self.head = None
+        self.markers = { }
+
+    def load(self):
+        try:
+            with open(layout.marker_index_file(self.where), 'rb') as f:
+                data = pickle.load(f)
+        except Exception:
+            # Missing or unreadable - we'll just rebuild it.
+            return
+        if (data.get('version') == INDEX_VERSION):
+            self.head = data['head']
+            self.markers = data['markers']
+
+    def save(self):
+        ops.ensure_cache_dir(self.where)
+        data = { 'version' : INDEX_VERSION,
+                 'head' : self.head,
+                 'markers' : self.markers }
+        with open(layout.marker_index_file_x(self.where), 'wb') as f:
+            pickle.dump(data, f, pickle.HIGHEST_PROTOCOL)
+        os.rename(layout.marker_index_file_x(self.where),
+                  layout.marker_index_file(self.where))
+
+    def refresh(self, verbose = False):
+        """
+        Bring the index up to date with HEAD.
+
+        Returns True if the index had to be rebuilt from scratch.
+        """
+        head = git.query_current_commit_id(self.where)
+        if (head == self.head):
+            return False
+        rebuilt = False
+        if (self.head is not None and git.is_ancestor(self.where, self.head, head)):
+            if verbose:
+                print "Indexing weld markers in %s..%s"%(self.head[:10], head[:10])
+            entries = git.log_messages(self.where, self.head, head,
+                                       grep = header_grep_any(), verbose = verbose)
+        else:
+            if verbose:
+                print "Indexing weld markers up to %s"%head[:10]
+            self.markers = { }
+            entries = git.log_messages(self.where, None, head,
+                                       grep = header_grep_any(), verbose = verbose)
+            rebuilt = True
+        self.add(entries)
+        self.head = head
+        self.save()
+        return rebuilt
+
+    def add(self, entries):
+        """
+        'entries' is a list of ( commit_id, commit_time, message ), in
+        "git log" order, for commits newer than any we have already.
+        """
+        # "git log" lists the most recent first, so the first one we see
+        # of each kind is the one that "git log --grep" would have found.
+        if self.markers:
+            first = max(value[0] for value in self.markers.values()) + 1
+        else:
+            first = 0
+        found = { }
+        for (idx, (cid, commit_time, message)) in enumerate(entries):
+            for key in decode_markers(message):
+                if (key not in found):
+                    found[key] = (first + len(entries) - idx, cid)
+        self.markers.update(found)
+
+    def latest(self, verbs, base_name = None):
+        """
+        Return the id of the most recent commit with a marker for any of
+        'verbs' and 'base_name', or None if there isn't one.
+        """
+        best = None
+        for verb in verbs:
+            value = self.markers.get( (verb, base_name) )
+            if (value is not None and (best is None or value[0] > best[0])):
+                best = value
+        if (best is None):
+            return None
+        return best[1]
+
+# The ref naming the HEAD that the sync point refs are correct for.
+HEAD_REF = "refs/weld/head"
+
+# Where we keep the base commits fetched into the weld. These aren't
+# sync points, so write_sync_refs() leaves them alone.
+FETCHED_REF_PREFIX = "refs/weld/fetched/"
+
+# The verbs we keep per-base refs for, and what we call those refs.
+SYNC_REF_NAMES = { "Merged" : "last-merge",
+                   "Pushed" : "last-push" }
+
+def sync_ref(verb, base_name = None):
+    """
+    Return the name of the ref recording the last 'verb' for 'base_name',
+    or None if we don't keep one.
+    """
+    if (verb == "Init"):
+        return "refs/weld/init"
+    if (verb not in SYNC_REF_NAMES or base_name is None):
+        return None
+    if not ref_safe(base_name):
+        return None
+    return "refs/weld/bases/%s/%s"%(base_name, SYNC_REF_NAMES[verb])
+
+def fetched_ref(base_name):
+    """
+    Return the name of the ref which remembers the last commit we fetched
+    from 'base_name' into the weld, or None if we can't have one.
+    """
+    if not ref_safe(base_name):
+        return None
+    return "%s%s"%(FETCHED_REF_PREFIX, base_name)
+
+def ref_safe(base_name):
+    """
+    Can 'base_name' be used in a ref name? We don't try to make refs for
+    base names git wouldn't accept.
+    """
+    return not (re.match(r'^[A-Za-z0-9_][A-Za-z0-9._-]*$', base_name) is None or
+                '..' in base_name or base_name.endswith('.lock'))
+
+def write_sync_refs(idx, rebuilt = False, verbose = False):
+    """
+    Make the refs under refs/weld match the MarkerIndex 'idx'.
+
+    If 'rebuilt', the index may have lost entries, so remove any refs
+    which no longer correspond to one.
+    """
+    where = idx.where
+    wanted = { }
+    for (verb, base_name), (position, cid) in idx.markers.items():
+        ref = sync_ref(verb, base_name)
+        if (ref is not None):
+            wanted[ref] = cid
+    updates = [ ]
+    for ref, cid in wanted.items():
+        if (git.rev_parse(where, ref) != cid):
+            updates.append( (ref, cid) )
+    if rebuilt:
+        for ref in git.list_refs(where, "refs/weld/"):
+            if (ref not in wanted and ref != HEAD_REF and
+                not ref.startswith(FETCHED_REF_PREFIX)):
+                updates.append( (ref, None) )
+    updates.append( (HEAD_REF, idx.head) )
+    git.update_refs(where, updates, verbose = verbose)
+
+# Maps a weld directory to its MarkerIndex
+g_indices = { }
+
+def marker_index(where, verbose = False):
+    """
+    Return the (up to date) MarkerIndex for the weld in 'where'.
+
+    If bringing it up to date changed it, the refs are rewritten too.
+    """
+    key = os.path.realpath(where)
+    if (key not in g_indices):
+        idx = MarkerIndex(where)
+        idx.load()
+        g_indices[key] = idx
+    idx = g_indices[key]
+    old_head = idx.head
+    rebuilt = idx.refresh(verbose = verbose)
+    if (rebuilt or idx.head != old_head or
+        git.rev_parse(where, HEAD_REF) != idx.head):
+        write_sync_refs(idx, rebuilt = rebuilt, verbose = verbose)
+    return idx
+
+def update_sync_refs(where, verbose = False):
+    """
+    Bring the refs under refs/weld up to date with HEAD.
+
+    Called after we've committed a new sync point, so that the next lookup
+    is just a ref read.
+    """
+    marker_index(where, verbose = verbose)
+
+def reindex(where, verbose = False):
+    """
+    Throw away the index and the refs, and rebuild them from the headers
+    in the weld's history.
+
+    Returns the new MarkerIndex.
+    """
+    key = os.path.realpath(where)
+    if (key in g_indices):
+        del g_indices[key]
+    if os.path.exists(layout.marker_index_file(where)):
+        os.remove(layout.marker_index_file(where))
+    idx = MarkerIndex(where)
+    g_indices[key] = idx
+    idx.refresh(verbose = verbose)
+    write_sync_refs(idx, rebuilt = True, verbose = verbose)
+    return idx
+
+def latest(where, verbs, base_name = None):
+    """
+    Return the id of the most recent commit on HEAD with a marker for any
+    of 'verbs' and 'base_name', or None if there isn't one.
+    """
+    refs = [ sync_ref(verb, base_name) for verb in verbs ]
+    if (None not in refs and
+        git.rev_parse(where, HEAD_REF) == git.query_current_commit_id(where)):
+        best = None
+        for ref in refs:
+            cid = git.rev_parse(where, ref)
+            if (cid is None):
+                continue
+            if (len(refs) == 1):
+                return cid
+            if (best is None or more_recent(where, cid, best)):
+                best = cid
+        return best
+    return marker_index(where).latest(verbs, base_name)
+
+def more_recent(where, cid, other):
+    """
+    Does 'cid' come after 'other' in the history of HEAD?
+
+    As in the MarkerIndex, a commit comes after its ancestors however close
+    together they were made; otherwise we go by commit time, as "git log"
+    does.
+    """
+    if git.is_ancestor(where, other, cid):
+        return True
+    if git.is_ancestor(where, cid, other):
+        return False
+    return git.commit_time(where, cid) > git.commit_time(where, other)
+
+def query_merge(where, base):
+    """Return the id of the last "X-Weld-State: Merged <base>" commit, or None.
+    """
+    return latest(where, [ "Merged" ], base)
+
+def query_push(where, base):
+    """Return the id of the last "X-Weld-State: Pushed <base>" commit, or None.
+    """
+    return latest(where, [ "Pushed" ], base)
+
+def query_merge_or_push(where, base):
+    """Return the id of the last Merged or Pushed commit for 'base', or None.
+    """
+    return latest(where, [ "Pushed", "Merged" ], base)
+
+def query_init(where):
+    """
+    Return the id of the weld init commit.
+    """
+    cid = latest(where, [ "Init" ])
+    if (cid is None):
+        raise GiveUp("Cannot find a weld init line in history")
+    return cid
+
+# End file.
@@ -2,6 +2,8 @@
 Generic operations
 """
 
+import importlib
+import json
 import os
 import re
 import shutil
@@ -9,6 +11,8 @@ import tempfile
 import traceback
 import groan
 
+from multiprocessing.pool import ThreadPool
+
 try:
     import cPickle as pickle
 except:
@@ -18,20 +22,99 @@ import welded.git as git
 import welded.headers as headers
 import welded.layout as layout
 
-from welded.utils import GiveUp, run_silently, dynamic_load, run_to_stdout
+from welded.db import SeamIndex
+from welded.utils import GiveUp, LazyModule, run_to_stdout
+
+# Only wanted part way through an operation.
+copier = LazyModule('welded.copier')
+statestore = LazyModule('welded.statestore')
 
-def update_base(spec, base):
+def update_base(spec, base, to_stdout = True):
     """
     Update the local base checkout
+
+    If 'to_stdout' is false, git's output is returned rather than printed.
     """
     b = layout.base_repo(spec.base_dir, base.name)
     if (not os.path.exists(b)):
         os.makedirs(b)
     g = os.path.join(b, ".git")
+    out = ''
     if (not os.path.exists(g)):
-        git.clone(b, base.uri, base.branch, base.tag, base.rev)
+        out += git.clone(b, base.uri, base.branch, base.tag, base.rev,
+                         to_stdout = to_stdout) or ''
     # Now update ..
-    git.pull(b, base.uri, base.branch, base.tag, base.rev)
+    out += git.pull(b, base.uri, base.branch, base.tag, base.rev,
+                    to_stdout = to_stdout) or ''
+    return out
+
+def update_bases(spec, base_names, jobs = 1, clone = True, fetch = False,
+                 verbose = False, quiet = False):
+    """
+    Bring the local checkouts of all of 'base_names' up to date, using up
+    to 'jobs' of them at once.
+
+    If 'clone' is true, each base is brought up to date with update_base(),
+    otherwise with pull_base(). If 'fetch' is true, we just fetch into each
+    (existing) clone with fetch_base() instead. If 'quiet' is true, we don't
+    report our progress.
+
+    A failure to update one base doesn't stop the others; once they have
+    all been tried, we raise GiveUp naming every base that failed.
+    """
+    # Make sure the shared parent directory exists before the workers
+    # start trying to create their own directories in it.
+    bases_dir = os.path.join(layout.weld_dir(spec.base_dir), 'bases')
+    if (not os.path.exists(bases_dir)):
+        os.makedirs(bases_dir)
+
+    def refresh(base_name):
+        try:
+            if fetch:
+                out = fetch_base(spec, base_name, to_stdout = False)
+            elif clone:
+                out = update_base(spec, spec.query_base(base_name), to_stdout = False)
+            else:
+                out = pull_base(spec, base_name, to_stdout = False)
+            return (base_name, out, None)
+        except Exception as e:
+            return (base_name, None, e)
+
+    if (jobs is None or jobs < 1):
+        jobs = 1
+    jobs = min(jobs, len(base_names))
+    if not quiet:
+        print "Updating %d base%s (%d at a time) .."%(len(base_names),
+                                                      '' if len(base_names) == 1 else 's',
+                                                      max(jobs, 1))
+    failed = [ ]
+    if (jobs > 1):
+        pool = ThreadPool(jobs)
+        try:
+            results = list(pool.imap_unordered(refresh, base_names))
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = map(refresh, base_names)
+
+    for (base_name, out, e) in sorted(results):
+        if e is None:
+            if not quiet:
+                print " - %s updated"%base_name
+            if verbose and out:
+                print '\n'.join(['     {}'.format(x) for x in out.splitlines()])
+        else:
+            if not quiet:
+                print " - %s FAILED"%base_name
+            failed.append( (base_name, e) )
+
+    if failed:
+        parts = [ 'Could not update %d base%s:'%(len(failed), '' if len(failed) == 1 else 's') ]
+        for (base_name, e) in failed:
+            parts.append('  %s:'%base_name)
+            parts.extend(['    {}'.format(x) for x in str(e).splitlines()])
+        raise GiveUp('\n'.join(parts))
     
 def query_head_of_base(spec, base_obj):
     """
@@ -39,27 +122,34 @@ def query_head_of_base(spec, base_obj):
     """
     return git.query_current_commit_id(layout.base_repo(spec.base_dir, base_obj.name))
 
-def delete_seams(spec, base_obj, seams, base_commit):
+def delete_seams(spec, base_obj, seams, base_commit, where = None):
     """
     Take the array of seam objects in seams and delete them from base_obj in spec, then
     commit the result.
+
+    The work is done in the weld checkout in 'where', which defaults to
+    spec.base_dir.
     """
+    if (where is None):
+        where = spec.base_dir
     # Actually remarkably easy. First, delete stuff.
     if (len(seams) == 0): 
         # It's a no-op
         return
 
+    stager = git.Stager(where)
     for s in seams:
-        to_zap = os.path.join(spec.base_dir, s.dest)
+        to_zap = os.path.join(where, s.dest)
         if os.path.exists(to_zap): 
             print("W: Remove %s\n"%to_zap)
             shutil.rmtree(to_zap)
-        git.add_in_subdir(spec.base_dir, s.dest )
+        stager.stage([ s.dest ])
+    stager.flush()
     
     # Now create the header for all this ..
     hdr = headers.seam_op(headers.SEAM_VERB_DELETED, base_obj ,seams, base_commit)
     # .. aaand commit.
-    git.commit(spec.base_dir, hdr, [])
+    git.commit(where, hdr, [])
 
 def rewrite_diff(infile, cid, changes):
     """
@@ -73,6 +163,7 @@ def rewrite_diff(infile, cid, changes):
     outfile = tempfile.NamedTemporaryFile(prefix="weldcid%s-out"%cid, delete = False)
     rec = re.compile(r'^diff\s+--git\s+a/([^\s]+)\s+b/([^\s]+)\s*$')
     are_any = False
+    index = SeamIndex(changes)
 
     # State:
     #        1 - echoing a diff to output.
@@ -89,15 +180,9 @@ def rewrite_diff(infile, cid, changes):
                 if (len(l) > 5):
                     if (l[:5] == '--- a' or l[:5] == '+++ b'):
                         # It's a diff line
-                        for s in changes:
-                            if (s.source is not None and len(s.source) > 0):
-                                src_check = s.source + "/"
-                            else:
-                                src_check = ""
-                            if (l[6:].startswith(src_check)):
-                                x = len(src_check)
-                                l = l[:6] + s.dest + '/' + l[(6+x):]
-                                break
+                        (s, rest) = index.source_seam(l[6:].rstrip('\n'), strict = True)
+                        if (s is not None):
+                            l = l[:6] + s.dest + '/' + rest + '\n'
 
                 outfile.file.write(l)
         else:
@@ -105,25 +190,19 @@ def rewrite_diff(infile, cid, changes):
             src_file = m.group(1)
             dest_file = m.group(2)
             state = 2
-            for s in changes:
-                # Need to make sure it is a '/' so that we don't get
-                # unwanted prefix matches.
-                if (s.source is not None and len(s.source) > 0): 
-                    src_check = s.source + "/"
-                else:
-                    src_check = ""
-                if (dest_file.startswith(src_check) and src_file.startswith(src_check)):
-                    # It's going to be in this seam. 
-                    # Git models moves as "remove A, put B", so there is no
-                    #  moving in the filenames, we can just replace the paths.
-                    l = len(src_check)
-                    src_file = "%s/%s"%(s.dest, src_file[l:])
-                    dest_file = "%s/%s"%(s.dest, dest_file[l:])
-                    l = "diff --git a/%s b/%s\n"%(src_file, dest_file)
-                    outfile.file.write(l)
-                    are_any = True
-                    state = 1
-                    break
+            # Only whole directories count, so "a/bc" isn't in seam "a/b".
+            (s, src_rest) = index.source_seam(src_file, strict = True)
+            (dest_s, dest_rest) = index.source_seam(dest_file, strict = True)
+            if (s is not None and s is dest_s):
+                # It's going to be in this seam. 
+                # Git models moves as "remove A, put B", so there is no
+                #  moving in the filenames, we can just replace the paths.
+                src_file = "%s/%s"%(s.dest, src_rest)
+                dest_file = "%s/%s"%(s.dest, dest_rest)
+                l = "diff --git a/%s b/%s\n"%(src_file, dest_file)
+                outfile.file.write(l)
+                are_any = True
+                state = 1
                     
 
     return (are_any, outfile)
@@ -151,25 +230,32 @@ def modify_seams(spec, base_obj, changes, old_commit, new_commit):
             git.apply_patch_file(spec.base_dir, temp2.name)
         os.remove(n)
         print("W: Add .. \n")
-        for s in changes:
-            git.add_in_subdir(spec.base_dir, os.path.join(spec.base_dir, s.get_dest()))
+        stager = git.Stager(spec.base_dir)
+        stager.stage([ s.get_dest() for s in changes ])
+        stager.flush()
         print("W: Commit .. \n")
         hdr = headers.ported_commit(base_obj, changes, new_commit)
         git.commit(spec.base_dir, hdr, [] )
             
-def add_seams(spec, base_obj, seams, base_commit):
+def add_seams(spec, base_obj, seams, base_commit, where = None):
     """
     Take the array of seam objects in seams and create the new seams in seams.
+
+    They are created in the weld checkout in 'where', which defaults to
+    spec.base_dir.
     """
+    if (where is None):
+        where = spec.base_dir
     if (len(seams) == 0): 
         # It's a no-op
         return
 
+    stager = git.Stager(where)
     for s in seams:
         print("W: Creating new seam (%s->%s) from %s"%(s.get_source(), s.get_dest(), base_obj.name))
         # Really, just copy the directories over. If there are files already there, keep them.
         src = os.path.join(layout.base_repo(spec.base_dir, base_obj.name), s.get_source())
-        dest = os.path.join(spec.base_dir, s.get_dest())
+        dest = os.path.join(where, s.get_dest())
         try:
             os.makedirs(dest)
         except Exception:
@@ -213,12 +299,13 @@ def add_seams(spec, base_obj, seams, base_commit):
         # (and, for extra points, what is our policy on .gitignore files at
         # this level? Is the naive answer of just copying them good enough?)
 
-        # Now just rsync it all over
+        # Now just copy it all over - the files git knows about, that is,
+        # which leaves out the .git directory.
         # The exists test copes with the case where the seam has not yet been added
         # to the base - rrw 2014-09-15
         # 
         if (os.path.exists(src)):
-            run_silently(["rsync", "-avz", "--exclude", ".git/", os.path.join(src, "."), os.path.join(dest, ".")])
+            copier.copy_files(src, dest, git.iter_files(src, verbose = False), verbose = True)
 
             # You really don't want to remove anything, because it is likely that if there are files
             # here, the seam was already added to the repository at the branch point 
@@ -231,15 +318,12 @@ def add_seams(spec, base_obj, seams, base_commit):
                 os.mkdir(dest)
 
         # Make sure you add all the files in the subdirectory, if there are any.
-        if len(os.listdir(dest)) > 0:
-            git.add_in_subdir(spec.base_dir, dest)            
-        else:
-            # Just add the directory
-            git.add(spec.base_dir, [ dest ])
+        stager.stage([ dest ])
 
+    stager.flush()
     # Now commit them with an appropriate header.
     hdrs = headers.seam_op(headers.SEAM_VERB_ADDED, base_obj, seams, base_commit)
-    git.commit(spec.base_dir, hdrs, [] )
+    git.commit(where, hdrs, [] )
 
 FINISH_PULL_PREFIX="import pull\n" + \
     "def go(spec, opts):\n"
@@ -249,10 +333,6 @@ FINISH_PUSH_PREFIX="import push\n" + \
     "def go(spec, opts):"
 FINISH_PUSH_SUFFIX="\n"
 
-VERB_PREFIX="import ops\n" + \
-    "def go(spec, opts):\n"
-VERB_SUFFIX="\n"
-
 def have_cmd(base_dir):
     try:
         state = read_state_data_with_file(base_dir)
@@ -284,12 +364,79 @@ def write_finish_push(spec, cmds_ok, cmds_abort):
         f.write(cmds_abort)
         f.write(FINISH_PUSH_SUFFIX)
 
+# The verbs available during a pull or push are kept in one table in the
+# state directory: 'current' maps each verb we can do now to the
+# ( module, function ) in welded which does it, and 'pending' holds the
+# verbs being set up for after the current one succeeds.
+#
+# Older welds wrote a little Python file per verb instead, in
+# .weld/state/verbs and .weld/state/pending_verbs, each calling
+# "<module>.<function>(spec, opts)". If we find those, we read the table
+# from them.
+
+LEGACY_VERB_CALL = re.compile(r'^\s*(pull_step|push_step)\.(\w+)\(spec, opts\)\s*$', re.MULTILINE)
+
+def read_legacy_verbs(verb_dir):
+    verbs = { }
+    if not os.path.isdir(verb_dir):
+        return verbs
+    for name in os.listdir(verb_dir):
+        (verb, ext) = os.path.splitext(name)
+        if (ext != '.py' or verb.startswith('.')):
+            continue
+        try:
+            with open(os.path.join(verb_dir, name), 'r') as f:
+                m = LEGACY_VERB_CALL.search(f.read())
+        except IOError:
+            continue
+        if m is not None:
+            verbs[verb] = ( m.group(1), m.group(2) )
+    return verbs
+
+def read_verb_table(base_dir):
+    """
+    Return the verb table for the weld in 'base_dir', or None if there
+    isn't one.
+
+    If there is no table but an operation is in progress - say one started
+    by an older weld - we make one from the old verb files, and make sure
+    that it can at least be aborted.
+    """
+    try:
+        with open(layout.verb_table_file(base_dir), 'rb') as f:
+            return json.load(f)
+    except IOError:
+        pass
+    except ValueError:
+        return None
+    table = { 'current' : read_legacy_verbs(layout.legacy_verb_dir(base_dir)),
+              'pending' : read_legacy_verbs(layout.legacy_pending_verb_dir(base_dir)) }
+    cmd = have_cmd(base_dir)
+    if cmd in ('pull_step', 'push_step'):
+        table['current'].setdefault('abort', ( cmd, 'abort' ))
+    if not (table['current'] or table['pending']):
+        return None
+    return table
+
+def write_verb_table(base_dir, table):
+    with open(layout.verb_table_file_x(base_dir), 'wb') as f:
+        json.dump(table, f)
+    os.rename(layout.verb_table_file_x(base_dir),
+              layout.verb_table_file(base_dir))
+    # The table now has anything an older weld left behind.
+    for d in (layout.legacy_verb_dir(base_dir), layout.legacy_pending_verb_dir(base_dir)):
+        if os.path.isdir(d):
+            shutil.rmtree(d)
+
 def clear_verbs(spec):
     """
     Clear all verbs, pending and real.
     """
-    shutil.rmtree(layout.verb_dir(spec.base_dir))
-    shuilt.rmtree(layout.pending_verb_dir(spec.base_dir))
+    if os.path.exists(layout.verb_table_file(spec.base_dir)):
+        os.remove(layout.verb_table_file(spec.base_dir))
+    for d in (layout.legacy_verb_dir(spec.base_dir), layout.legacy_pending_verb_dir(spec.base_dir)):
+        if os.path.isdir(d):
+            shutil.rmtree(d)
 
 def verb_me(spec, module, fn, verb = None):
     """
@@ -298,54 +445,20 @@ def verb_me(spec, module, fn, verb = None):
     """
     if verb is None:
         verb = fn
-    return make_verb_available(spec, verb, [ 'import %s'%module,
-                                             '%s.%s(spec, opts)'%(module, fn) ])
-
-
-def make_verb_available(spec, cmd, code):
-    try:
-        os.mkdir(layout.pending_verb_dir(spec.base_dir), 0755)
-    except:
-        pass
-
-    with open(layout.pending_verb_file(spec.base_dir, cmd), "w+") as f:
-        f.write(VERB_PREFIX)
-        for l in code:
-            f.write(' ' + l + '\n')
-        f.write(VERB_SUFFIX)
-
-def write_verbs(spec, cmds, erase_old_verbs = True):
-    """
-    Writes a finish spec. cmds is a hash of verb -> some text to be evaluated
-    on that verb
-
-    The finish spec is written in the pending verbs directory.
-    """
-    if erase_old_verbs:
-        shutil.rmtree(layout.pending_verb_dir(spec.base_dir))
-
-    try:
-        os.mkdir(layout.pending_verb_dir(spec.base_dir), 0755)
-    except:
-        pass
-
-    for (cmd, text) in cmds:
-        with open(layout.pending_verb_file(spec.base_dir, cmd), "w+") as f:
-            f.write(VERB_PREFIX)
-            f.write(cmds)
-            f.write(VERB_SUFFIX)
-
+    table = read_verb_table(spec.base_dir)
+    if table is None:
+        table = { 'current' : { }, 'pending' : { } }
+    table['pending'][verb] = ( module, fn )
+    write_verb_table(spec.base_dir, table)
 
 def repeat_verbs(spec):
     """
     Repeat the previous verbs
     """
-    vb =layout.verb_dir(spec.base_dir)
-    nvb = layout.pending_verb_dir(spec.base_dir)
-    if os.path.exists(vb):
-        if os.path.exists(nvb):
-            shutil.rmtree(nvb)
-        shutil.copytree(vb,nvb)
+    table = read_verb_table(spec.base_dir)
+    if table is not None:
+        table['pending'] = dict(table['current'])
+        write_verb_table(spec.base_dir, table)
 
 def next_verbs(spec):
     """
@@ -353,22 +466,22 @@ def next_verbs(spec):
     pending verbs
     """
     #traceback.print_stack()
-    vb =layout.verb_dir(spec.base_dir)
-    nvb = layout.pending_verb_dir(spec.base_dir)
-    if os.path.exists(vb):
-        shutil.rmtree(layout.verb_dir(spec.base_dir))
-    if os.path.exists(nvb):
-        shutil.move(nvb, vb)
-
+    table = read_verb_table(spec.base_dir)
+    # If there's no table, whatever we just did has finished and taken
+    # the state directory with it.
+    if table is not None:
+        table['current'] = table['pending']
+        table['pending'] = { }
+        write_verb_table(spec.base_dir, table)
 
 def do(spec, verb, opts, do_next_verbs = False):
     """
     Perform a verb
     """
-    c = layout.verb_file(spec.base_dir, verb)
-    if (os.path.exists(c)):
-        f = dynamic_load(c, no_pyc = True)
-        f.go(spec, opts)
+    table = read_verb_table(spec.base_dir)
+    if (table is not None) and (verb in table['current']):
+        (module, fn) = table['current'][verb]
+        getattr(importlib.import_module('welded.%s'%module), fn)(spec, opts)
         # Success!
         if do_next_verbs:
             next_verbs(spec)
@@ -376,21 +489,17 @@ def do(spec, verb, opts, do_next_verbs = False):
         raise GiveUp("You see no '%s' here. %s "%(verb, groan.with_demise()))
 
 def available_verb(spec, verb):
-    return os.path.exists(layout.verb_file(spec.base_dir, verb))
+    table = read_verb_table(spec.base_dir)
+    return (table is not None) and (verb in table['current'])
 
 def list_verbs(spec):
     return list_verbs_from(spec.base_dir)
 
 def list_verbs_from(base_dir):
-    c = layout.verb_dir(base_dir)
-    rv = [ ]
-    if (os.path.exists(c)):
-        for l in os.listdir(c):
-            if (l[0] != '.'):
-                dot = l.find('.')
-                rv.append(l[:dot])
-
-    return rv
+    table = read_verb_table(base_dir)
+    if table is None:
+        return [ ]
+    return sorted(table['current'].keys())
 
 def count(filename):
     contents = ""
@@ -419,15 +528,26 @@ def read_state_data(spec):
     return read_state_data_with_file(spec.base_dir)
 
 def read_state_data_with_file(base_dir):
-    with open(layout.state_data_file(base_dir), 'r') as f:
-        some_input = f.read()
-    return pickle.loads(some_input)
+    db_file = layout.state_db_file(base_dir)
+    legacy = layout.legacy_state_data_file(base_dir)
+    if not os.path.exists(db_file) and os.path.exists(legacy):
+        # Left by an older weld part way through an operation.
+        with open(legacy, 'r') as f:
+            some_input = f.read()
+        try:
+            data = pickle.loads(some_input)
+        except Exception as e:
+            raise GiveUp("Cannot read the state left in %s by an older weld - %s\n"
+                         "Finish or abort the operation with the weld that started it."%
+                         (legacy, e))
+        return statestore.StateData(db_file, initial = data)
+    return statestore.read(db_file)
 
 def write_state_data(spec, data):
-    with open(layout.state_data_file_x(spec.base_dir), 'w') as f:
-        f.write(pickle.dumps(data))
-    os.rename(layout.state_data_file_x(spec.base_dir),
-              layout.state_data_file(spec.base_dir))
+    statestore.write(layout.state_db_file(spec.base_dir), data)
+    legacy = layout.legacy_state_data_file(spec.base_dir)
+    if os.path.exists(legacy):
+        os.remove(legacy)
 
 def ensure_state_dir(weld_dir):
     try:
@@ -435,6 +555,25 @@ def ensure_state_dir(weld_dir):
     except:
         pass
 
+def ensure_cache_dir(weld_dir):
+    """
+    Make sure the cache directory exists. Unlike the state directory, it
+    survives from one command to the next.
+
+    It ignores itself, so that welds whose .gitignore predates it don't
+    see it as an untracked change.
+    """
+    c = layout.cache_dir(weld_dir)
+    if not os.path.exists(c):
+        try:
+            os.makedirs(c, 0755)
+        except OSError:
+            pass
+    ignore = os.path.join(c, '.gitignore')
+    if not os.path.exists(ignore):
+        with open(ignore, 'w') as f:
+            f.write('*\n')
+
 def list_changes(where, cid_from, cid_to, opts = [ '--topo-order' ]):
     return git.list_changes(where, cid_from, cid_to, opts = opts)
 
@@ -482,6 +621,62 @@ def log_changes(where, cid_from, cid_to, directories, style, verbose = False):
     else:
         raise GiveUp("I do not understand the log style '%s'"%style)
 
+def plan_steps(where, cid_from, changes, directories, verbose = False):
+    """
+    Work out, in two git runs, which of 'changes' touch 'directories'.
+
+    'changes' is the list of commits from 'cid_from' to HEAD that we are
+    going to step through, as returned by list_sensible_changes(). Each
+    commit in "<cid_from>..<last change>" is given to the first change
+    that has it as an ancestor - which is the step in which log_changes()
+    would have reported it.
+
+    Returns a list parallel to 'changes'; each element is a list of
+    (commit_id, touched_directories, log_entry) for the commits given to
+    that change which touch 'directories', most recent first. log_entry
+    is as log_changes() would return it in the "summary" style.
+    """
+    plan = [ [ ] for c in changes ]
+    if (len(changes) == 0):
+        return plan
+    parents = git.list_parents(where, cid_from, changes[-1], verbose = verbose)
+    owner = { }
+    for idx in range(0, len(changes)):
+        todo = [ changes[idx] ]
+        while todo:
+            c = todo.pop()
+            if (c in owner) or (c not in parents):
+                continue
+            owner[c] = idx
+            todo.extend(parents[c])
+
+    for (cid, header, raw) in git.log_raw_changes(where, cid_from, changes[-1],
+                                                  directories, verbose = verbose):
+        if cid not in owner:
+            continue
+        touched = set()
+        for l in raw:
+            path = l.split('\t')[-1]
+            for d in directories:
+                if (d == '.' or path == d or path.startswith(d + '/')):
+                    touched.add(d)
+        if not touched:
+            continue
+        entry = "%s\n\n\n%s\n"%(header, "\n".join(raw))
+        plan[owner[cid]].append( (cid, sorted(touched), entry) )
+    return plan
+
+def planned_changes(plan, idx_from, idx_to):
+    """
+    Return the planned log entries for the changes after 'idx_from' up to
+    and including 'idx_to', most recent first - the equivalent of
+    log_changes() from changes[idx_from] to changes[idx_to].
+    """
+    result = [ ]
+    for idx in range(idx_to, idx_from, -1):
+        result.extend([ entry for (cid, touched, entry) in plan[idx] ])
+    return result
+
 def merge_advice(base, lines,base_repo, head_expln, master_expln):
     return ('Error merging patches to base %s.\n'
             '%s\n'
@@ -537,13 +732,24 @@ def reassociate_base(spec, base_name, verbose = False):
     git.set_remote(repo, 'origin', b.uri)
     git.pull(repo, b.uri, b.branch, b.tag, b.rev)
 
-def pull_base(spec, base_name):
+def pull_base(spec, base_name, to_stdout = True):
     b = spec.query_base(base_name)
     repo = layout.base_repo(spec.base_dir, base_name)
     if not os.path.exists(repo):
         os.makedirs(repo)
-        git.init(repo)
-    git.pull(repo, b.uri, b.branch, b.tag, b.rev)
+        git.init(repo, verbose = to_stdout)
+    return git.pull(repo, b.uri, b.branch, b.tag, b.rev, to_stdout = to_stdout)
+
+def fetch_base(spec, base_name, to_stdout = True):
+    """
+    Fetch what pull_base() would pull into our clone of 'base_name', without
+    touching its checkout.
+    """
+    b = spec.query_base(base_name)
+    repo = layout.base_repo(spec.base_dir, base_name)
+    if not os.path.exists(os.path.join(repo, '.git')):
+        raise GiveUp('No clone of %s in .weld/bases - do "weld base-pull %s"'%(base_name, base_name))
+    return git.fetch(repo, b.uri, b.branch, b.tag, b.rev, to_stdout = to_stdout)
 
 def push_base(spec, base_name):
     b = spec.query_base(base_name)
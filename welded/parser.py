@@ -1,75 +1,193 @@
 """
 parser.py - constructs a Weld from an XML file.
+
+Since every weld command starts by parsing .weld/welded.xml, the parsed
+Weld can be kept in a cache file, keyed on the size, mtime and SHA-1 of the
+XML. If the size and mtime still match we don't even read the XML; if only
+the hash does (it was touched, or checked out again) we refresh the key;
+otherwise we parse it again and rewrite the cache.
+
+Commands which only need some of the bases can ask for just those; a
+partial Weld is never cached.
 """
 
-import xml.dom.minidom
+import hashlib
+import os
+
+try:
+    import xml.etree.cElementTree as ElementTree
+except ImportError:
+    import xml.etree.ElementTree as ElementTree
+
+from StringIO import StringIO
+
+try:
+    import cPickle as pickle
+except:
+    import pickle
 
 from welded.db import Weld, Base, Seam
 from welded.utils import GiveUp
 
+# Bump this if the format of the cache, or of the objects in it, changes.
+CACHE_VERSION = 3
+
+# A weld server keeps its parsed spec here, so that the commands it runs
+# (each in a forked copy of the server) can start from it.
+# Maps absolute file name -> (size, mtime, Weld)
+g_resident = { }
+
 class Parser:
+    """
+    Builds a Weld from welded.xml as the XML is read, rather than via a
+    DOM of the whole thing.
+
+    If 'only_bases' is given, only those bases (and their seams) are
+    loaded; the rest of the spec is skimmed, just enough to check it.
+    """
     def __init__(self):
         self.weld = None
 
-    def parse(self, name):
-        dom = xml.dom.minidom.parse(name)
-        return self.parse_dom(dom)
-    
-    def parse_dom(self, dom):
-        return self.handle_weld(dom)
-    
-    def handle_weld(self, dom):
+    def parse(self, name, cache_file = None, only_bases = None):
+        resident = g_resident.get(os.path.abspath(name))
+        if (resident is not None):
+            st = os.stat(name)
+            if (resident[0] == st.st_size and resident[1] == st.st_mtime):
+                return resident[2]
+
+        if (cache_file is None):
+            return self.parse_file(name, only_bases)
+
+        st = os.stat(name)
+        cached = load_cache(cache_file)
+        if (cached is not None and cached['size'] == st.st_size and
+            cached['mtime'] == st.st_mtime):
+            return cached['weld']
+
+        with open(name, 'rb') as f:
+            data = f.read()
+        digest = hashlib.sha1(data).hexdigest()
+        if (cached is not None and cached['sha1'] == digest):
+            weld = cached['weld']
+        elif (only_bases is not None):
+            # Don't cache part of a weld; the next command to want all of
+            # it will rebuild the cache.
+            return self.parse_file(StringIO(data), only_bases)
+        else:
+            weld = self.parse_file(StringIO(data))
+        save_cache(cache_file, { 'version' : CACHE_VERSION,
+                                 'size' : st.st_size,
+                                 'mtime' : st.st_mtime,
+                                 'sha1' : digest,
+                                 'weld' : weld })
+        return weld
+
+    def parse_file(self, source, only_bases = None):
+        """
+        Parse 'source' - a file name or file object.
+        """
         weld = Weld()
-        node = dom.documentElement
-        if (node.hasAttribute("name")):
-            weld.name = node.getAttribute("name")
+        if (only_bases is None):
+            wanted = None
         else:
-            raise GiveUp("Weld has no name")
-
-        origins = dom.getElementsByTagName("origin")
-        if (len(origins) > 0):
-            # XXX Should the URI be optional?
-            # XXX Should we allow other attributes?
-            weld.origin = origins[0].getAttribute("uri")
-        bases = dom.getElementsByTagName("base")
-        seams = dom.getElementsByTagName("seam")
-        for b in bases:
-            self.handle_base(weld, b)
-        for s in seams:
-            self.handle_seam(weld, s)
+            wanted = set(only_bases)
+        # Every base in the spec, wanted or not, so we can check the seams.
+        all_bases = set()
+        # Seams can name bases which come later, so they wait until the end.
+        seams = [ ]
+        root = None
+        depth = 0
+        for (event, elem) in ElementTree.iterparse(source, events = ('start', 'end')):
+            if (event == 'start'):
+                if (root is None):
+                    root = elem
+                    if (elem.get("name") is None):
+                        raise GiveUp("Weld has no name")
+                    weld.name = elem.get("name")
+                depth += 1
+                continue
+            depth -= 1
+            if (elem.tag == "origin"):
+                # XXX Should the URI be optional?
+                # XXX Should we allow other attributes?
+                if (weld.origin is None):
+                    weld.origin = elem.get("uri", "")
+            elif (elem.tag == "base"):
+                name = elem.get("name")
+                if (name is None):
+                    raise GiveUp("Base without a name")
+                all_bases.add(name)
+                if (wanted is None) or (name in wanted):
+                    self.handle_base(weld, elem)
+            elif (elem.tag == "seam"):
+                seams.append(dict(elem.items()))
+            if (depth == 1):
+                # Done with this child of the weld; let it go.
+                root.clear()
+        for attrs in seams:
+            self.handle_seam(weld, attrs, all_bases)
         return weld
 
     def handle_base(self, weld, node):
         b = Base()
-        if (not node.hasAttribute("name")):
-            raise GiveUp("Base without a name")
-        b.name = node.getAttribute("name")
-        b.uri = node.getAttribute("uri")
-        if (node.hasAttribute("branch")):
-            b.branch = node.getAttribute("branch")
-        if (node.hasAttribute("tag")):
-            b.tag = node.getAttribute("tag")
-        if (node.hasAttribute("rev")):
-            b.rev = node.getAttribute("rev")
+        b.name = node.get("name")
+        b.uri = node.get("uri", "")
+        b.branch = node.get("branch")
+        b.tag = node.get("tag")
+        b.rev = node.get("rev")
 
         weld.bases[b.name] = b
 
-    def handle_seam(self, weld, node):
+    def handle_seam(self, weld, attrs, all_bases):
         s = Seam()
-        if (node.hasAttribute("name")):
-            s.name = node.getAttribute("name")
-        if (not node.hasAttribute("base")):
+        s.name = attrs.get("name")
+        base_name = attrs.get("base")
+        if (base_name is None):
             raise GiveUp("Seam %s has no base."%s.name)
-        base_name = node.getAttribute("base")
-        if (not (base_name in weld.bases)):
+        if (not (base_name in all_bases)):
             raise GiveUp("Seam %s has base %s, which is not defined."%(s.name, base_name))
+        if (not (base_name in weld.bases)):
+            # One we weren't asked for.
+            return
         s.base =  weld.bases[base_name]
-        if (node.hasAttribute("source")): 
-            s.source= node.getAttribute("source")
-        if (node.hasAttribute("dest")): 
-            s.dest = node.getAttribute("dest")
-        if (node.hasAttribute("current")):
-            s.current = node.getAttribute("current")
+        s.source = attrs.get("source")
+        s.dest = attrs.get("dest")
+        if ("current" in attrs):
+            s.current = attrs["current"]
         s.base.seams.append(s)
 
+def keep_resident(name, weld):
+    """
+    Have later parses of 'name' return 'weld' for as long as the file
+    doesn't change. Only for servers - everyone else gets a fresh Weld.
+    """
+    st = os.stat(name)
+    g_resident[os.path.abspath(name)] = (st.st_size, st.st_mtime, weld)
+
+def load_cache(cache_file):
+    """
+    Return the contents of 'cache_file', or None if it is missing,
+    unreadable or out of date.
+    """
+    try:
+        with open(cache_file, 'rb') as f:
+            data = pickle.load(f)
+    except Exception:
+        return None
+    if (data.get('version') != CACHE_VERSION):
+        return None
+    return data
+
+def save_cache(cache_file, data):
+    """
+    Write 'data' to 'cache_file'. The cache is only ever a convenience, so
+    if we can't write it we just carry on without.
+    """
+    try:
+        with open(cache_file + '.x', 'wb') as f:
+            pickle.dump(data, f, pickle.HIGHEST_PROTOCOL)
+        os.rename(cache_file + '.x', cache_file)
+    except (IOError, OSError):
+        pass
+
 # End file.
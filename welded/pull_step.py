@@ -10,6 +10,7 @@ import tempfile
 import welded.git as git
 import welded.ops as ops
 import welded.layout as layout
+import welded.markers as markers
 import welded.push_utils as push_utils
 
 from welded.push_utils import make_files_match, make_patches_match
@@ -40,7 +41,12 @@ def pull_step(spec, base_name, opts):
         
     root_branch = git.current_branch(weld_root)
     
-    if (ops.have_cmd(spec)):
+    # With --worktree the user's tree stays clean, so the check above
+    # doesn't catch an operation in progress; look for its state.
+    if (ops.have_cmd(weld_root) or
+        os.path.exists(layout.state_db_file(weld_root)) or
+        os.path.exists(layout.legacy_state_data_file(weld_root)) or
+        os.path.exists(layout.worktree_dir(weld_root))):
         raise GiveUp('We are part way through a weld operation; finish it (or abort it) and try again')
    
     if (root_branch.startswith('weld-')):
@@ -55,7 +61,7 @@ def pull_step(spec, base_name, opts):
 
     if opts.ignore_history or (last_weld_sync is None):
         # No previous merge
-        last_weld_sync = git.query_init(weld_root)
+        last_weld_sync = markers.query_init(weld_root)
         last_base_sync = None
         if verbose:
             print 'No last push - using weld init at %s'%last_weld_sync[:10]
@@ -91,6 +97,9 @@ def pull_step(spec, base_name, opts):
     state['base_name'] = base_name
     state['base_obj'] = base_obj
     state['weld_root'] = spec.base_dir
+    # Where we do our work - the weld, or a linked working tree.
+    state['work_root'] = spec.base_dir
+    state['worktree'] = opts.worktree
     state['orig_branch'] = root_branch
     state['working_branch' ] = working_branch
     state['base_repo'] = base_repo
@@ -104,6 +113,8 @@ def pull_step(spec, base_name, opts):
     state['verbose'] = opts.verbose
     state['edit_commit_file'] = opts.edit_commit_file
     state['bulk'] = opts.bulk
+    state['content_aware'] = opts.content_aware
+    state['transplant'] = opts.transplant
     state['combine_style'] = opts.combine_style
     if (opts.commit_style is None):
         state['commit_style'] = get_default_commit_style()
@@ -126,9 +137,22 @@ def pull_step(spec, base_name, opts):
     else:
         changes = ops.list_sensible_changes(base_repo, last_base_sync, 'HEAD')
     state['changes'] = changes
+    print("Planning %d step%s .. "%(len(changes), '' if len(changes) == 1 else 's'))
+    state['plan'] = ops.plan_steps(base_repo, last_base_sync, changes,
+                                   state['weld_directories'], verbose = verbose)
         
     print("Branching the weld at %s to get the last sync. "%last_base_sync)
-    git.checkout(weld_root, commit_id = last_weld_sync, new_branch_name = working_branch)
+    if opts.worktree:
+        # Do the work in a working tree of our own, so that the user's weld
+        # only moves once, when we finish.
+        work_root = layout.worktree_dir(weld_root)
+        git.add_worktree(weld_root, work_root, last_weld_sync,
+                         new_branch_name = working_branch, verbose = verbose)
+        state['work_root'] = work_root
+        ops.write_state_data(spec, state)
+    else:
+        work_root = weld_root
+        git.checkout(weld_root, commit_id = last_weld_sync, new_branch_name = working_branch)
 
     base_obj = spec.query_base(base_name)
 
@@ -143,11 +167,11 @@ def pull_step(spec, base_name, opts):
     # Before we sync we need the base to be at last_base_sync
     if (last_base_sync is not None):
         git.checkout(base_repo, last_base_sync)
-        ops.sanitise(weld_root, state, opts, verbose = verbose)
-        ops.delete_seams(spec, base_obj, deleted_in_new, last_base_sync)
-        ops.add_seams(spec, base_obj, added_in_new, last_base_sync)
+        ops.sanitise(work_root, state, opts, verbose = verbose)
+        ops.delete_seams(spec, base_obj, deleted_in_new, last_base_sync, where = work_root)
+        ops.add_seams(spec, base_obj, added_in_new, last_base_sync, where = work_root)
     else:
-        ops.add_seams(spec, base_obj, added_in_new, last_base_sync)
+        ops.add_seams(spec, base_obj, added_in_new, last_base_sync, where = work_root)
 
 
     ops.write_state_data(spec, state)
@@ -155,7 +179,7 @@ def pull_step(spec, base_name, opts):
 
     next_action = ''
     if (len(changes) > 0):
-        if git.has_local_changes(weld_root):
+        if git.has_local_changes(work_root):
             print "Seams have changed since the last push; issuing an initial commit to adjust for this"
             state['initial_commit'] = True
             ops.verb_me(spec, 'pull_step', 'initial_commit', verb = 'commit')
@@ -189,7 +213,7 @@ def initial_commit(spec, opts):
         f.write('\n')    
     if (state['edit_commit_file'] or opts.edit_commit_file):
         push_utils.edit_file(commit_file)
-    git.commit_using_file(spec.base_dir, commit_file, all = True, verbose = state['verbose'])
+    git.commit_using_file(state.get('work_root', state['weld_root']), commit_file, all = True, verbose = state['verbose'])
     ops.write_state_data(spec, state)
     ops.verb_me(spec, 'pull_step', 'abort')
     ops.verb_me(spec, 'pull_step', 'step')
@@ -201,11 +225,12 @@ def step(spec, opts):
     pull-step step function; merge next-idx-to-merge. If you've run out, finish.
     """
     ignore_bad_patches = opts.ignore_bad_patches
+    known_clean = False
 
     while True:
         nr_bad = 0
         state = ops.read_state_data(spec)
-        weld_root = state['weld_root']
+        work_root = state.get('work_root', state['weld_root'])
         changes = state['changes']
         idx = state['next_idx_to_merge']
         idx_from = state['last_idx_merged']
@@ -213,6 +238,7 @@ def step(spec, opts):
         base_seams = state['base_seams']
         verbose = state['verbose'] or opts.verbose
         bulk = state['bulk'] or opts.bulk
+        transplant = state.get('transplant') or opts.transplant
         if opts.commit_style is not None:
             commit_style = opts.commit_style
         else:
@@ -236,7 +262,16 @@ def step(spec, opts):
         print "Stepping:  searching from   %s"%last_cid
         print "                     to     %s"%cid
         
-        base_changes = ops.log_changes(base_repo, last_cid, cid,
+        if ('plan' in state):
+            # The plan says which commits matter, so we only need to ask
+            # git about them if we want a log style other than its own.
+            base_changes = ops.planned_changes(state['plan'], idx_from, idx)
+            if base_changes and (commit_style != 'summary'):
+                base_changes = ops.log_changes(base_repo, last_cid, cid,
+                                               state['weld_directories'],
+                                               commit_style)
+        else:
+            base_changes = ops.log_changes(base_repo, last_cid, cid,
                                                         state['weld_directories'],
                                                         commit_style)
             
@@ -251,38 +286,60 @@ def step(spec, opts):
                 print "No explicit change for these seams in this base commit"
         
         if changed or no_further_commits:
+            transplanted = False
+            if transplant:
+                try:
+                    push_utils.transplant_seams(work_root, base_repo, state['base_name'],
+                                                base_seams, cid, verbose = verbose,
+                                                stats = state.setdefault('seam_stats', { }))
+                    transplanted = True
+                except GiveUp as e:
+                    print "Cannot transplant seams - %s"%e
+                    print " .. falling back to patching."
+
             # Need to use file match if the last cid is None, because you
             # can't diff from None.
-            if bulk or (last_cid is None):
+            if transplanted:
+                pass
+            elif bulk or (last_cid is None):
                 git.checkout(base_repo, cid)
-                # Just make files the same.
+                # Just make files the same, and stage the lot at once.
+                stager = git.Stager(work_root, verbose = verbose)
                 for s in base_seams:
                     if s.source is None:
                         from_dir = base_repo
                     else:
                         from_dir = os.path.join(base_repo, s.source)
-                    to_dir = os.path.join(weld_root, s.get_dest())
+                    to_dir = os.path.join(work_root, s.get_dest())
                     push_utils.make_files_match(from_dir, to_dir, 
                                                 do_commits = False, verbose = verbose,
-                                                delete_missing_from = True)
+                                                delete_missing_from = True,
+                                                content_aware = state.get('content_aware') or opts.content_aware,
+                                                stager = stager)
+                stager.flush()
             else:
                 # Process patches. 
-                nr_bad = make_patches_match(base_repo, weld_root, base_changes, 
+                nr_bad = make_patches_match(base_repo, work_root, base_changes, 
                                             base_seams, last_cid, cid, ignore_bad_patches, verbose = verbose,
-                                            bad_patches_file = "/tmp/weld.bad.patches")
+                                            bad_patches_file = "/tmp/weld.bad.patches",
+                                            stats = state.setdefault('seam_stats', { }))
                 ignore_bad_patches = False
                 
 
             if (not('log' in state)):
                 state['log'] = [ ]
             if base_changes:
-                human_readable = ops.make_human_readable_changes(base_changes)
-                human_readable.extend(state['log'])
-                state['log'] = human_readable
+                # Newest first; adding them in place means only they are written.
+                state['log'][0:0] = ops.make_human_readable_changes(base_changes)
             state['last_idx_merged'] = state['next_idx_to_merge']
             # .. aaand stash everything so that commit can find it.
 
-        has_local_changes = git.has_local_changes(weld_root)
+        if changed or no_further_commits or (not known_clean):
+            has_local_changes = git.has_local_changes(work_root)
+        else:
+            # We've touched nothing since we last looked.
+            has_local_changes = False
+        known_clean = not has_local_changes
         state['next_idx_to_merge'] = state['next_idx_to_merge'] + 1
 
         ops.write_state_data(spec, state)
@@ -300,7 +357,7 @@ def step(spec, opts):
         if nr_bad != 0:
             print " %d patches failed to apply cleanly. Please clear this up and then weld commit"%(nr_bad)
             print " to continue. A copy of the bad patches can be found in /tmp/weld.bad.patches.%d ."
-            ops.sanitise(weld_root, state, opts, verbose = verbose)
+            ops.sanitise(work_root, state, opts, verbose = verbose)
             ops.write_state_data(spec, state)
             break
 
@@ -308,7 +365,7 @@ def step(spec, opts):
             print " we have local changes "
             if opts.single_commit_stepping or opts.pragmatic_stepping:
                 if (state['last_idx_merged'] >= 0):
-                    ops.sanitise(weld_root, state, opts, verbose = verbose)
+                    ops.sanitise(work_root, state, opts, verbose = verbose)
                     ops.write_state_data(spec, state)
                     commit(spec, opts, allow_edit = False)
                     state = ops.read_state_data(spec)
@@ -316,7 +373,7 @@ def step(spec, opts):
                     continue
             elif ((not opts.finish_stepping) or state['last_idx_merged'] < 0) and \
             ((not opts.step_until_git_change) or (changed or no_further_commits)):
-                ops.sanitise(weld_root, state, opts, verbose = verbose)
+                ops.sanitise(work_root, state, opts, verbose = verbose)
                 ops.write_state_data(spec, state)
                 break
         elif no_further_commits:
@@ -324,7 +381,7 @@ def step(spec, opts):
         
             
         if no_further_commits:
-            ops.sanitise(weld_root, state, opts, verbose = verbose)
+            ops.sanitise(work_root, state, opts, verbose = verbose)
             ops.write_state_data(spec, state)
             break
         
@@ -347,7 +404,7 @@ def sanitise(spec, opts):
     """
     state = ops.read_state_data(spec)
     verbose = opts.verbose or state['verbose']
-    ops.sanitise(state['weld_root'], state, opts, verbose = verbose)
+    ops.sanitise(state.get('work_root', state['weld_root']), state, opts, verbose = verbose)
     ops.write_state_data(spec, state)
     ops.repeat_verbs(spec)
 
@@ -359,8 +416,10 @@ def inspect(spec, opts):
     print "Commit log: "
     if ('log' in state):
         print "\n".join(state['log'])
+    if ('seam_stats' in state):
+        print "\n Seams: %s"%push_utils.describe_seam_stats(state['seam_stats'])
     print "\n Files affected: \n"
-    run_to_stdout(['git', 'status'], cwd=state['weld_root'])
+    run_to_stdout(['git', 'status'], cwd=state.get('work_root', state['weld_root']))
     ops.repeat_verbs(spec)
 
 
@@ -411,8 +470,8 @@ def commit(spec, opts, allow_edit= True):
         if (allow_edit and edit_commit_file):
             push_utils.edit_file(commit_file)
         if verbose:
-            run_to_stdout(['git', 'status'], cwd = weld_root)
-        git.commit_using_file(weld_root, commit_file, all = True, verbose = state['verbose'])
+            run_to_stdout(['git', 'status'], cwd = state.get('work_root', state['weld_root']))
+        git.commit_using_file(state.get('work_root', state['weld_root']), commit_file, all = True, verbose = state['verbose'])
         if verbose:
             print "Removing temporary commit file."
         os.remove(commit_file)
@@ -455,6 +514,7 @@ def finish_merge(spec, opts):
     state = ops.read_state_data(spec)
     verbose = state['verbose'] or opts.verbose
     weld_root = state['weld_root']
+    work_root = state.get('work_root', state['weld_root'])
     working_branch = state['working_branch']
     orig_branch = state['orig_branch']
     base_obj = state['base_obj']
@@ -470,12 +530,12 @@ def finish_merge(spec, opts):
             if verbose:
                 print "Merging main branch into working branch .. "
             run_silently(['touch', mi ])
-            git.merge_to_current(weld_root, orig_branch, verbose = verbose, commit = True)
+            git.merge_to_current(work_root, orig_branch, verbose = verbose, commit = True)
         except GiveUp as e:
             lines = e.message.splitlines()
             lines = ['  %s'%line for line in lines]
             raise GiveUp(ops.merge_advice(
-                    base_name, '\n'.join(lines), base_repo, 
+                    base_name, '\n'.join(lines), work_root, 
                     "HEAD is the weld at point of last pull with the base with the base patches applied on top of it",
                     "%s is the head of the branch we are merging into"%orig_branch ))
     else:
@@ -485,13 +545,18 @@ def finish_merge(spec, opts):
     if verbose:
         if state['verbose']:
             print 'xxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxx'
-            print 'In', base_repo
-            run_to_stdout(['git', 'status'], cwd=weld_root)
+            print 'In', work_root
+            run_to_stdout(['git', 'status'], cwd=work_root)
             print 'xxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxx'
 
     if verbose:
         print "Merging back to orig branch .. "
-    git.checkout(weld_root, orig_branch)
+    if state.get('worktree'):
+        # The weld never left orig_branch, and now we're done with our
+        # working tree; this merge is the only time the weld moves.
+        git.remove_worktree(weld_root, work_root, verbose = verbose)
+    else:
+        git.checkout(weld_root, orig_branch)
     git.merge_to_current(weld_root, working_branch, squash = False, verbose = verbose)
     
     if verbose:
@@ -510,6 +575,9 @@ def finish_merge(spec, opts):
         print "Deleting %s"%commit_file
     os.remove(commit_file)
 
+    # Remember where we got to
+    markers.update_sync_refs(weld_root, verbose = verbose)
+
     # Move the base back onto its branch
     git.checkout(state['base_repo'], state['base_branch'])
 
@@ -540,6 +608,10 @@ def finish_rebase(spec, opts):
     # All we can really do here is to rebase the branch onto main ..
     mi = layout.merging_file(weld_root, base_name)
     if not os.path.exists(mi):
+        if state.get('worktree'):
+            # The rebase has to happen in the weld, so we're done with
+            # our own working tree.
+            git.remove_worktree(weld_root, state.get('work_root', state['weld_root']), verbose = verbose)
         try:
             print "Check out %s"%orig_branch
             git.checkout(weld_root, orig_branch)
@@ -558,8 +630,8 @@ def finish_rebase(spec, opts):
     if verbose:
         if state['verbose']:
             print 'xxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxx'
-            print 'In', base_repo
-            run_to_stdout(['git', 'status'], cwd=weld_root)
+            print 'In', work_root
+            run_to_stdout(['git', 'status'], cwd=work_root)
             print 'xxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxx'
 
     if verbose:
@@ -578,6 +650,9 @@ def finish_rebase(spec, opts):
         print "Deleting %s"%commit_file
     os.remove(commit_file)
 
+    # Remember where we got to
+    markers.update_sync_refs(weld_root, verbose = verbose)
+
     # Move the base back onto its branch
     git.checkout(state['base_repo'], state['base_branch'])
 
@@ -598,10 +673,14 @@ def abort(spec, opts):
 
     # Check out the right version of the base.
     git.checkout(state['base_repo'], state['base_branch'])
-    # Remove anything compromising ..
-    git.hard_reset(weld_root)
-    # Move the weld back to its old branch
-    git.checkout(weld_root, state['orig_branch'])
+    if state.get('worktree'):
+        # The weld itself was never touched; just lose our working tree.
+        git.remove_worktree(weld_root, layout.worktree_dir(weld_root))
+    else:
+        # Remove anything compromising ..
+        git.hard_reset(weld_root)
+        # Move the weld back to its old branch
+        git.checkout(weld_root, state['orig_branch'])
     # Remove the working branch
     try:
          git.remove_branch(weld_root, state['working_branch'], irrespective = True)
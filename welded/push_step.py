@@ -10,6 +10,7 @@ import re
 
 import welded.git as git
 import welded.layout as layout
+import welded.markers as markers
 import welded.ops as ops
 import welded.query as query
 
@@ -50,16 +51,18 @@ def push_step(spec, base_name, opts):
     current_branch = git.current_branch(weld_root, verbose = opts.verbose)
     
     in_cmd, should_git_pull, should_git_push =  \
-            get_status_2(weld_root, branch_name = current_branch, verbose = True)
+            get_status_2(weld_root, branch_name = current_branch, verbose = True,
+                         offline = opts.offline, ttl = opts.remote_ttl)
     
     if in_cmd:
         raise GiveUp("Half way through a pull - weld finish/weld abort and try again")
     if current_branch.startswith("weld-"):
         raise GiveUp("You are on a branch used by weld (%s) - get off and try again."%current_branch)
     
-    # Update our base
-    print 'Updating base %s before trying to pushstep.. '%base_name
-    ops.update_base(spec, spec.query_base(base_name))
+    # Update our base, unless that has already been done for us
+    if not opts.bases_updated:
+        print 'Updating base %s before trying to pushstep.. '%base_name
+        ops.update_base(spec, spec.query_base(base_name))
 
     print 
     print "Beginning a stepwise push for %s .. "%base_name
@@ -69,7 +72,8 @@ def push_step(spec, base_name, opts):
     if opts.verbose:
         print "Determining last push for %s:"%base_name
     (last_weld_merge, last_base_merge, last_weld_push, last_base_push,
-     base_head, weld_init) = query.query_base_commits(spec, base_name)
+     base_head, weld_init) = query.query_base_commits(spec, base_name,
+                                                      update = not opts.bases_updated)
     
     if (opts.ignore_history):
         last_weld_merge = None
@@ -136,6 +140,9 @@ def push_step(spec, base_name, opts):
     state['base_seams'] = spec.bases[base_name].get_seams()
     state['spec_from_base'] = spec
     state['weld_directories'] = [s.get_dest() for s in state['base_seams'] ]
+    print("Planning %d step%s .. "%(len(changes), '' if len(changes) == 1 else 's'))
+    state['plan'] = ops.plan_steps(weld_root, latest_sync, changes,
+                                   state['weld_directories'], verbose = opts.verbose)
     state['base_dir'] = base_dir
     state['current_commit'] = current_commit
     state['base_name'] = base_name
@@ -155,10 +162,28 @@ def push_step(spec, base_name, opts):
                                          'weld-pushing',
                                          latest_base_sync)
     state['working_branch'] = working_branch
+    state['latest_base_sync'] = latest_base_sync
+    if opts.transplant:
+        # Build the base commits from trees; nothing gets checked out
+        # until we finish.
+        ops.write_state_data(spec, state)
+        ops.verb_me(spec, 'push_step', 'abort')
+        ops.next_verbs(spec)
+        return transplant(spec, opts)
+
     # Swing the base round .. 
     git.checkout(base_dir, commit_id = latest_base_sync,
                  new_branch_name = working_branch)
 
+    if opts.worktree:
+        # Step through the weld's history in a working tree of our own,
+        # so that the user's weld doesn't move at all.
+        work_root = layout.worktree_dir(weld_root)
+        git.add_worktree(weld_root, work_root, latest_sync, verbose = opts.verbose)
+        state['work_root'] = work_root
+    else:
+        state['work_root'] = weld_root
+
     # ... aand now start our merge in earnest.
     ops.write_state_data(spec, state)
     ops.verb_me(spec, 'push_step', 'step')
@@ -168,6 +193,105 @@ def push_step(spec, base_name, opts):
     return ops.do(spec, 'step', opts, True)
 
 
+def changes_between(weld_root, state, from_idx, to_idx, commit_style):
+    """
+    Return the (escaped) log entries for the weld changes after 'from_idx'
+    up to and including 'to_idx' which touch our seams.
+    """
+    changes = state['changes']
+    if (from_idx >= 0):
+        from_cid = changes[from_idx]
+    else:
+        from_cid = state['latest_sync']
+    if ('plan' in state):
+        base_changes = ops.planned_changes(state['plan'], from_idx, to_idx)
+        if base_changes and (commit_style != 'summary'):
+            base_changes = ops.log_changes(weld_root, from_cid, changes[to_idx],
+                                           state['weld_directories'],
+                                           commit_style)
+    else:
+        base_changes = ops.log_changes(weld_root, from_cid, changes[to_idx],
+                                       state['weld_directories'], 
+                                       commit_style)
+    return push_utils.escape_states(base_changes)
+
+def transplant(spec, opts):
+    """
+    Build the base commits for the whole push from the weld's trees - each
+    one is the previous base tree with the weld commit's seam dests put
+    back at their sources - and hang them on the working branch of the
+    base. Neither working tree is touched: 'finish' does that, once.
+    """
+    state = ops.read_state_data(spec)
+    verbose = opts.verbose or state['verbose']
+    if opts.commit_style is not None:
+        commit_style = opts.commit_style
+    else:
+        commit_style = state['commit_style']
+    weld_root = spec.base_dir
+    base_dir = state['base_dir']
+    base_name = state['base_name']
+    changes = state['changes']
+    moves = [ (s.get_dest(), s.get_source()) for s in state['base_seams'] ]
+
+    parent = state['latest_base_sync']
+    if (git.rev_parse(weld_root, '%s^{commit}'%parent) is None):
+        git.fetch_commit(weld_root, base_dir, parent, markers.fetched_ref(base_name),
+                         verbose = verbose)
+    tree = git.rev_parse(weld_root, '%s^{tree}'%parent)
+
+    commit_file = layout.push_commit_file(weld_root, base_name)
+    try:
+        os.makedirs(layout.pushing_dir(weld_root))
+    except:
+        pass
+    nr_commits = 0
+    last_committed_idx = -1
+    for idx in range(0, len(changes)):
+        last = (idx == len(changes)-1)
+        if (not state['plan'][idx]) and (not last):
+            continue
+        new_tree = push_utils.graft_tree(weld_root, tree, changes[idx], moves,
+                                         verbose = verbose,
+                                         stats = state.setdefault('seam_stats', { }))
+        if (new_tree == tree):
+            continue
+        base_changes = changes_between(weld_root, state, last_committed_idx, idx,
+                                       commit_style)
+        commit_list = changes[last_committed_idx+1:idx+1]
+        with open(commit_file, 'w') as f:
+            f.write('X-Weld-Stepwise-Push: %s %s..%s'%(state['legend'], commit_list[0],
+                                                        commit_list[-1]))
+            f.write('\n')
+            if base_changes:
+                f.write('\n'.join(ops.make_human_readable_changes(base_changes)))
+            else:
+                f.write('(* This commit was likely from another branch; a merge will reintroduce code higher up *)')
+        parent = git.commit_tree(weld_root, new_tree, [ parent ], commit_file, verbose = verbose)
+        os.remove(commit_file)
+        tree = new_tree
+        last_committed_idx = idx
+        nr_commits += 1
+        print "Built base commit %s from weld %s"%(parent, changes[idx])
+
+    # Hand the commits over to the base.
+    git.fetch_commit(base_dir, weld_root, parent, 'refs/heads/%s'%state['working_branch'],
+                     verbose = verbose)
+
+    state['transplanted'] = True
+    state['all_done'] = True
+    state['current_idx'] = len(changes)
+    state['last_merged_idx'] = len(changes)-1
+    state['last_committed_idx'] = len(changes)-1
+    ops.write_state_data(spec, state)
+    ops.verb_me(spec, 'push_step', 'finish')
+    ops.verb_me(spec, 'push_step', 'inspect')
+    ops.verb_me(spec, 'push_step', 'abort')
+    ops.next_verbs(spec)
+    print "Built %d base commit%s on %s. Do 'weld finish' to finish."%(
+        nr_commits, '' if nr_commits == 1 else 's', state['working_branch'])
+    return True
+
 def step(spec, opts):
     """
     Step a step-push; this means that we accumulate changes into the next change up
@@ -183,6 +307,8 @@ def step(spec, opts):
 
     # Right oh. Move up a commit in the list .. 
     weld_root = spec.base_dir
+    work_root = state.get('work_root', weld_root)
+    known_clean = False
     while True:
         base_seams = state['base_seams']
         base_dir = state['base_dir']
@@ -217,12 +343,9 @@ def step(spec, opts):
             print "          merging from      %s"%(last_merged_cid)
             print "          next commit is    %s"%(cid)
             
-            weld_directories = state['weld_directories']
 
-            base_changes = ops.log_changes(weld_root, last_merged_cid, cid,
-                                           weld_directories, 
+            base_changes = changes_between(weld_root, state, last_merged_idx, current_idx,
                                            commit_style)
-            base_changes = push_utils.escape_states(base_changes)
 
             if base_changes:
                 changed = True
@@ -233,8 +356,10 @@ def step(spec, opts):
                 if verbose:
                     print "Nothing changed (apparently)"
           
-            # Check out the right version of the weld
-            git.checkout(weld_root, cid)
+            # Check out the right version of the weld - if nothing changed,
+            # there's nothing to look at and we can save ourselves the bother.
+            if changed:
+                git.checkout(work_root, cid)
 
         # If nothing ostensibly changed, don't bother with a commit - 
         #  this will have been a merge from another branch and 
@@ -244,7 +369,7 @@ def step(spec, opts):
         # (but if it is the last commit, we don't have a choice)
         if changed or no_further_commits:
             # We want to merge patches from the weld_root
-            nr_bad = push_utils.make_patches_match(source_repo = weld_root,
+            nr_bad = push_utils.make_patches_match(source_repo = work_root,
                                                      dest_repo = base_dir,
                                                      what_changed = base_changes,
                                                      seams = base_seams,
@@ -253,7 +378,8 @@ def step(spec, opts):
                                                      ignore_bad_patches = False,
                                                      verbose = verbose,
                                                      is_source_to_dest = False,
-                                                     bad_patches_file = "/tmp/weld.bad.patches")
+                                                     bad_patches_file = "/tmp/weld.bad.patches",
+                                                     stats = state.setdefault('seam_stats', { }))
                                           
 
             # Work out what changed .. 
@@ -268,9 +394,8 @@ def step(spec, opts):
             if (not ('log' in state)):
                 state['log'] = [ ]
             if base_changes: 
-                human_readable = ops.make_human_readable_changes(base_changes)
-                human_readable.extend(state['log'])
-                state['log'] = human_readable
+                # Newest first; adding them in place means only they are written.
+                state['log'][0:0] = ops.make_human_readable_changes(base_changes)
 
         
         # Stash state.
@@ -279,7 +404,12 @@ def step(spec, opts):
         state['commit_list'].append(cid)
         ops.write_state_data(spec, state)
         
-        has_local_changes = git.has_local_changes(base_dir)
+        if changed or no_further_commits or (not known_clean):
+            has_local_changes = git.has_local_changes(base_dir)
+        else:
+            # We've touched nothing since we last looked.
+            has_local_changes = False
+        known_clean = not has_local_changes
 
         # You can now either step, abort, or commit
         ops.verb_me(spec, 'push_step', 'step')
@@ -379,6 +509,8 @@ def inspect(spec, opts):
     print "Commit log: "
     if ('log' in state):
         print "\n".join(state['log'])
+    if ('seam_stats' in state):
+        print "\n Seams: %s"%push_utils.describe_seam_stats(state['seam_stats'])
     print "\n Files affected: \n"
     run_to_stdout(['git', 'status'], cwd=state['base_dir'])
     ops.repeat_verbs(spec)
@@ -484,11 +616,24 @@ def finish(spec, opts):
                                             delete_missing_from = False)
 
     # Now check out the place we want to be on the main branch.
-    if verbose:
-        print "Check out %s on the root .. "%state['current_branch']
-    git.checkout(weld_root, state['current_branch'])
+    work_root = state.get('work_root', weld_root)
+    if work_root != weld_root:
+        # The weld never moved; just lose our working tree.
+        git.remove_worktree(weld_root, work_root, verbose = verbose)
+    else:
+        if verbose:
+            print "Check out %s on the root .. "%state['current_branch']
+        git.checkout(weld_root, state['current_branch'])
 
     mi = layout.push_merging_file(weld_root, base_name)
+    if state.get('transplanted') and not os.path.exists(mi):
+        # The base hasn't been checked out yet. If it hasn't moved on
+        # since the commits were built, all we need is a fast-forward;
+        # otherwise, check out the working branch and merge as usual.
+        if git.is_ancestor(base_dir, orig_branch, working_branch):
+            run_silently(['touch', mi ])
+        else:
+            git.checkout(base_dir, working_branch, verbose = verbose)
     if not os.path.exists(mi):
         # We weren't merging, so do ..
         try:
@@ -553,6 +698,9 @@ def finish(spec, opts):
     git.commit_using_file(spec.base_dir, f.name, all=True, verbose=verbose)
     os.remove(f.name)
 
+    # Remember where we got to
+    markers.update_sync_refs(spec.base_dir, verbose = verbose)
+
     # And we've finished merging!
     if os.path.exists(layout.state_dir(weld_root)):
         shutil.rmtree(layout.state_dir(weld_root))
@@ -577,7 +725,11 @@ def abort(spec, opts):
         pass
         
     # Move back on the weld.
-    git.switch_branch(weld_root, state['current_branch'])
+    work_root = state.get('work_root', weld_root)
+    if work_root != weld_root:
+        git.remove_worktree(weld_root, work_root)
+    else:
+        git.switch_branch(weld_root, state['current_branch'])
     # git reset
     git.hard_reset(base_dir)
     # Move back on to the branch we started the base on.
@@ -8,14 +8,17 @@ import shutil
 import re
 import glob
 
+import welded.copier as copier
 import welded.git as git
 import welded.layout as layout
+import welded.markers as markers
 import welded.ops as ops
 import welded.query as query
 
+from welded.db import PathTrie
 from welded.headers import pickle_seams, decode_log_entry, decode_headers, decode_commit_data
 from welded.headers import decode_commit_headers
-from welded.utils import run_silently, run_to_stdout, GiveUp
+from welded.utils import run_to_stdout, GiveUp
 
 def bases_for_commit(repo, cid, inverb):
     """
@@ -53,30 +56,42 @@ def list_files_by_attribute(base_changes, attr):
     return rv
 
 def transform_directory_prefix(source_dest_table, orig_fn):
-    remainder = None
-    fn = orig_fn
-    while True:
-        if (fn in source_dest_table):
-            # Got it!
-            if (remainder is None):
-                return source_dest_table[fn]
-            else:
-                return os.path.join(source_dest_table[fn], remainder)
-        elif (fn == ""):
-            raise GiveUp("Could not map %s via %s"%(orig_fn,source_dest_table))
-        else:
-            # Break it down.
-            (left, right) = os.path.split(fn)
-            fn = left
-            if (remainder is None):
-                remainder = right
-            else:
-                remainder = os.path.join(right, remainder)
+    """
+    Map 'orig_fn' to its destination, given 'source_dest_table' - a
+    db.PathTrie mapping source directories to destination directories.
+    """
+    (dest, remainder) = source_dest_table.lookup(orig_fn)
+    if (dest is None):
+        raise GiveUp("Could not map %s - it is in none of our seams"%orig_fn)
+    if (len(remainder) == 0):
+        return dest
+    return os.path.join(dest, remainder)
 
 
+def combinable_seams(involved_seams):
+    """
+    Can the diffs for 'involved_seams' - a list of (seam, src, dir_arg) -
+    be applied as one patch? Not if there is only one of them, and not if
+    one source is inside (or the same as) another, since a file would
+    then have to be applied to more than one place.
+    """
+    if (len(involved_seams) < 2):
+        return False
+    sources = [ src for (s, src, dir_arg) in involved_seams ]
+    for i in range(0, len(sources)):
+        a = sources[i]
+        if (len(a) == 0):
+            return False
+        for j in range(0, len(sources)):
+            b = sources[j]
+            if (i != j) and (a == b or b.startswith(a + '/')):
+                return False
+    return True
+
 def make_patches_match(source_repo, dest_repo, what_changed, seams, last_cid, cid, ignore_bad_patches, verbose = False,
                        is_source_to_dest = True,
-                       bad_patches_file = "/tmp/weld.bad.patches"
+                       bad_patches_file = "/tmp/weld.bad.patches",
+                       stats = None
                        ):
     """
     source_repo - where the data is coming from
@@ -88,19 +103,21 @@ def make_patches_match(source_repo, dest_repo, what_changed, seams, last_cid, ci
     ignore_bad_patches - Ignore bad patches?
     is_source_to_dest - if True, take seams src->dest (for merging into the working repo from a base),
                         if False take seams dest->src (for merging into the base from a working repo)
+    stats - if given, a dictionary in which to count (see count_seam()) the
+            seams we patched and those we skipped because their trees matched.
     
     """
     DEBUG = False
     # This is rather horrific. For each change in base_changes,
     #  we mark any seam that has changed.
     #
-    #  Then we can use diff_this() to find each diff in turn.
-    #   .. and apply_patch to apply it.
+    #  Then we can use apply_diff() to pipe each diff in turn
+    #   into git apply.
     change_records = [ ]
     nr_bad = 0
     if len(what_changed) == 0:
         print "Empty change list - nothing to do."
-        return
+        return nr_bad
 
     for q in what_changed:
         change_records.extend(q.split('\n'))
@@ -141,7 +158,9 @@ def make_patches_match(source_repo, dest_repo, what_changed, seams, last_cid, ci
     # Whilst we are about this, build up a table of 
     # src -> dest prefixes that we can use later to
     # work out which files need git adding.
-    source_dest_table = { }
+    source_dest_table = PathTrie()
+    # (seam, src, dir_arg) for each seam involved in this change.
+    involved_seams = [ ]
 
     for s in seams:
         if is_source_to_dest:
@@ -157,53 +176,101 @@ def make_patches_match(source_repo, dest_repo, what_changed, seams, last_cid, ci
             print "Testing seam %s (src *%s* ,dest %s)"%(s.name, src,dest_dir)
         if (len(src)==0)  or  (src in prefixes):
             print "Seam %s is involved in this change"%s
-            source_dest_table[src] = dest_dir
-            # Get me the git diff for these changes.
-            #(os_handle, name) = tempfile.mkstemp(suffix = 'patch', prefix = 'tmpweld')
-            #os.close(os_handle)
-
-            tmpfile =  git.show_diff(source_repo, last_cid, cid, relative_to = src)
-            name = tmpfile.name
-            tmpfile.close() #  Make sure that all data is flushed.
-            #some_data = git.diff_this(source_repo, src, cid, verbose = verbose,
-            #                          from_commit_id = last_cid)
-            # Write it out, rename all the little as and bs and apply it.
-            #with open(name, 'w') as fh:
-            #    fh.write(some_data)
-            if (os.stat(name).st_size >0):
-                try:
-                    # Bit annoying: --directory=. fails to work, because you need
-                    # an _exact_ dir match for the git index, not just an
-                    # effective match. So, remove any './' or '.' from the dest_dir
-                    # before git gets hold of it - rrw 2015-05-18
-                    if (dest_dir == '.'):
-                        dir_arg = None
-                    elif (dest_dir[0:2] == './'):
-                        dir_arg = dest_dir[2:]
-                    else:
-                        dir_arg = dest_dir
-                    if ((dir_arg is not None) and len(dir_arg)==0):
-                        dir_arg = None
-                    
-                    git.apply_patch(dest_repo, name, directory = dir_arg, verbose = verbose)
-                except GiveUp as e:
-                    if (ignore_bad_patches):
-                        print "Ignoring bad patch - eeek!"
-                    else:
-                        print "Patch failed to apply correctly - %s in %s. Stashing."%(e,dest_repo)
-                        with open(name, 'r') as g:
-                            with open("%s.%s"%(bad_patches_file, s.name), 'a') as f:
-                                f.write(g.read())
-                        nr_bad = nr_bad + 1
+            source_dest_table.add(src, dest_dir)
+            # Bit annoying: --directory=. fails to work, because you need
+            # an _exact_ dir match for the git index, not just an
+            # effective match. So, remove any './' or '.' from the dest_dir
+            # before git gets hold of it - rrw 2015-05-18
+            if (dest_dir == '.'):
+                dir_arg = None
+            elif (dest_dir[0:2] == './'):
+                dir_arg = dest_dir[2:]
             else:
-                print " -- %s is empty. Ignoring it."%name
-                # .. and carry on.
-            os.unlink(name)
+                dir_arg = dest_dir
+            if ((dir_arg is not None) and len(dir_arg)==0):
+                dir_arg = None
+            involved_seams.append( (s, src, dir_arg) )
+
+    # Don't make patches for seams whose trees are the same at both ends,
+    # or which dest_repo already has as they will be at cid. The first
+    # check is just object lookups; the second needs a tree of dest_repo's
+    # index, so we only write one if some seam gets that far.
+    dest_tree = [ ]
+    def dest_tree_id():
+        if not dest_tree:
+            try:
+                dest_tree.append(git.write_tree(dest_repo, verbose = verbose))
+            except GiveUp:
+                # Probably conflicts from a bad patch; just don't look.
+                dest_tree.append(None)
+        return dest_tree[0]
+
+    changed_seams = [ ]
+    for (s, src, dir_arg) in involved_seams:
+        new_id = git.subtree_id(source_repo, cid, src)
+        if (new_id == git.subtree_id(source_repo, last_cid, src) or
+            (dest_tree_id() is not None and
+             new_id == git.subtree_id(dest_repo, dest_tree_id(), dir_arg))):
+            if verbose:
+                print "Seam %s has not changed - skipping it."%s
+            count_seam(stats, 'unchanged')
+        else:
+            count_seam(stats, 'changed')
+            changed_seams.append( (s, src, dir_arg) )
+    involved_seams = changed_seams
+
+    # Each git apply takes the index lock and reads the whole index of
+    # dest_repo, so try to do all the seams in one go: one diff of all
+    # their sources, with the paths moved to their destinations on the
+    # way into git apply. If it won't apply, nothing has been changed and
+    # we go round the seams one at a time so we know which ones are bad.
+    one_at_a_time = involved_seams
+    if combinable_seams(involved_seams):
+        dir_args = dict([ (src, dir_arg) for (s, src, dir_arg) in involved_seams ])
+        def relocate(path):
+            for src in dir_args:
+                if path.startswith(src + '/'):
+                    if (dir_args[src] is None):
+                        return path[len(src)+1:]
+                    return '%s/%s'%(dir_args[src], path[len(src)+1:])
+            return None
+
+        (size, errors) = git.apply_diff(source_repo, last_cid, cid, dest_repo,
+                                        paths = dir_args.keys(), relocate = relocate,
+                                        verbose = verbose)
+        if (size == 0):
+            print " -- diff for %d seams is empty. Ignoring it."%len(involved_seams)
+            one_at_a_time = [ ]
+        elif (errors is None):
+            one_at_a_time = [ ]
+        else:
+            print "Combined patch for %d seams failed to apply - trying them one at a time."%(len(involved_seams))
+            if verbose:
+                print errors
+
+    for (s, src, dir_arg) in one_at_a_time:
+        # Stream the diff for these changes straight into git apply.
+        (size, errors) = git.apply_diff(source_repo, last_cid, cid, dest_repo,
+                                        relative_to = src, directory = dir_arg,
+                                        verbose = verbose)
+        if (size == 0):
+            print " -- diff for %s is empty. Ignoring it."%s
+            # .. and carry on.
+        elif (errors is not None):
+            if (ignore_bad_patches):
+                print "Ignoring bad patch - eeek!"
+            else:
+                print "Patch failed to apply correctly - %s in %s. Stashing."%(errors,dest_repo)
+                # The diff has gone by now, so ask for it again - only
+                # bad patches ever get written to disk.
+                with open("%s.%s"%(bad_patches_file, s.name), 'a') as f:
+                    git.write_diff(source_repo, last_cid, cid, f, relative_to = src,
+                                   verbose = verbose)
+                nr_bad = nr_bad + 1
                 
-    # Add the relevant changes.
-    # We have to stage this because there could be rather a lot of them.
-    to_add = [ ]
-    current = [ ]
+    # Add the relevant changes - all at once, since there could be rather
+    # a lot of them.
+    stager = git.Stager(dest_repo, verbose = verbose)
     already_done = set()
     deleted = set()
     
@@ -220,29 +287,129 @@ def make_patches_match(source_repo, dest_repo, what_changed, seams, last_cid, ci
             already_done.add(i[1])
             # So, i[1] is in the source's notation.
             # We want it in the target's.
-            current.append(transform_directory_prefix(source_dest_table, i[1]))
-            if (len(current) > 32):
-                to_add.append(current)
-                current = [ ]
-    if (len(current)> 0):
-        to_add.append(current)
-                
-    for c in to_add:
-        try:
-            print "make_index_match %s"%dest_repo
-            git.make_index_match(dest_repo, c)
-        except Exception as e:
-            if nr_bad > 0:
-                pass
-            else:
-                raise e
+            stager.stage([ transform_directory_prefix(source_dest_table, i[1]) ])
+
+    try:
+        stager.flush()
+    except Exception as e:
+        if nr_bad > 0:
+            pass
+        else:
+            raise e
 
     # That's all folks
     return nr_bad
 
+def graft_tree(where, tree_id, commit_id, moves, verbose = False, stats = None):
+    """
+    Return the id of a tree which is 'tree_id' with the directories in
+    'moves' replaced from 'commit_id' - all objects in 'where'.
+
+    'moves' is a list of (from_path, to_path): to_path is replaced by
+    commit_id:from_path, or removed if commit_id has no from_path. A
+    to_path of '.' replaces the whole tree.
+
+    Moves whose subtrees are already the same are skipped, and if that is
+    all of them, 'tree_id' is returned straight away. Otherwise the work
+    is done in a scratch index, so neither the index nor the working tree
+    of 'where' is touched. If 'stats' is given, it is updated as for
+    count_seam().
+    """
+    needed = [ ]
+    for (from_path, to_path) in moves:
+        if (git.subtree_id(where, commit_id, from_path) ==
+            git.subtree_id(where, tree_id, to_path)):
+            count_seam(stats, 'unchanged')
+        else:
+            count_seam(stats, 'changed')
+            needed.append( (from_path, to_path) )
+    if not needed:
+        return tree_id
+    moves = needed
+
+    (handle, index_file) = tempfile.mkstemp(prefix = 'weldindex')
+    os.close(handle)
+    # An empty file isn't a valid index, but a missing one is.
+    os.unlink(index_file)
+    # Do any whole-tree replacement first, so it doesn't undo the others.
+    moves = sorted(moves, key = lambda m: os.path.normpath(m[1]) != '.')
+    try:
+        git.read_tree(where, tree_id, index_file = index_file, verbose = verbose)
+        for (from_path, to_path) in moves:
+            to_path = os.path.normpath(to_path)
+            subtree = git.subtree_id(where, commit_id, from_path)
+            git.remove_from_index(where, to_path, index_file = index_file, verbose = verbose)
+            if (subtree is None):
+                continue
+            if (to_path == '.'):
+                git.read_tree(where, subtree, index_file = index_file, verbose = verbose)
+            else:
+                git.read_tree(where, subtree, prefix = to_path, index_file = index_file,
+                              verbose = verbose)
+        return git.write_tree(where, index_file = index_file, verbose = verbose)
+    finally:
+        if os.path.exists(index_file):
+            os.unlink(index_file)
+
+def count_seam(stats, what):
+    """
+    Count a seam as 'unchanged' (its trees matched, so we didn't need to
+    touch it) or 'changed' in the dictionary 'stats', if there is one.
+    """
+    if (stats is not None):
+        stats[what] = stats.get(what, 0) + 1
+
+def describe_seam_stats(stats):
+    """
+    Return a line describing the seam counts in 'stats'.
+    """
+    unchanged = stats.get('unchanged', 0)
+    changed = stats.get('changed', 0)
+    return "%d seam%s changed, %d skipped because their trees matched"%(
+        changed, '' if changed == 1 else 's', unchanged)
+
+def transplant_seams(weld_root, base_repo, base_name, seams, cid, verbose = False,
+                     stats = None):
+    """
+    Make the seams in the index and working tree of weld_root match
+    base_repo at cid, without diffs or copying files about.
+
+    The base's objects are fetched into the weld, each seam's subtree
+    (cid:source) is grafted in at its dest in a scratch index, and the
+    weld is then moved from its old tree to the new one, which only
+    touches the files that actually differ.
+
+    Returns True if anything changed. Raises GiveUp, with the weld left as
+    it was, if we can't do it - eg. because of local changes in the way.
+    """
+    for s in seams:
+        dest = os.path.normpath(s.get_dest())
+        if (dest == '.' or dest.startswith('..')):
+            raise GiveUp("Cannot transplant seam %s to '%s'"%(s, s.get_dest()))
+
+    if (git.rev_parse(weld_root, '%s^{commit}'%cid) is None):
+        git.fetch_commit(weld_root, base_repo, cid, markers.fetched_ref(base_name),
+                         verbose = verbose)
+
+    old_tree = git.write_tree(weld_root, verbose = verbose)
+    new_tree = graft_tree(weld_root, old_tree, cid,
+                          [ (s.get_source(), s.get_dest()) for s in seams ],
+                          verbose = verbose, stats = stats)
+    if (new_tree == old_tree):
+        return False
+    git.switch_tree(weld_root, old_tree, new_tree, verbose = verbose)
+    return True
+
 def make_files_match(from_dir, to_dir, do_commits = True, verbose=False, delete_missing_from = False, 
-                     do_delete_files = True):
+                     do_delete_files = True, content_aware = False, stager = None):
     """Make the git handled files in 'to_dir' match those in 'from_dir'
+
+    If 'content_aware' is true, we compare the blob ids git has for each
+    side and only copy, add or remove those files whose content (or mode)
+    really differs, so that everything else keeps its inode and mtime.
+
+    If 'stager' is given (and we aren't committing), the changed files are
+    staged with it and left for the caller to flush.
     """
 
     # if from dir doesn't exist, delete to dir
@@ -262,11 +429,20 @@ def make_files_match(from_dir, to_dir, do_commits = True, verbose=False, delete_
             pass
 
     # What files is git managing for us in each directory?
-    if not os.path.exists(from_dir):
-        from_files = [ ]
+    if content_aware:
+        from_ids = git.list_file_ids(from_dir, verbose=verbose)
+        to_ids = git.list_file_ids(to_dir, verbose=verbose)
+        # The index can only vouch for files whose working copy matches it.
+        modified = (git.list_modified_files(from_dir, verbose=verbose) |
+                    git.list_modified_files(to_dir, verbose=verbose))
+        from_files = sorted(from_ids.keys())
+        to_files = sorted(to_ids.keys())
+        to_copy = [ f for f in from_files
+                    if (f in modified) or (from_ids[f] != to_ids.get(f)) ]
     else:
         from_files = git.list_files(from_dir)
-    to_files = git.list_files(to_dir)
+        to_files = git.list_files(to_dir)
+        to_copy = from_files
 
     from_files_set = set(from_files)
     to_files_set = set(to_files)
@@ -292,6 +468,8 @@ def make_files_match(from_dir, to_dir, do_commits = True, verbose=False, delete_
             else:
                 print '%-*s  %s'%(max_len, ' ', name)
         print '====================='
+        if content_aware:
+            print '%d of %d files differ'%(len(to_copy), len(from_files))
 
     # If we copy over everything from the "from" directory to the "to"
     # directory, and "git add" them all, then that will cope with changes to
@@ -299,26 +477,31 @@ def make_files_match(from_dir, to_dir, do_commits = True, verbose=False, delete_
     # to "git rm" any files that are meant to have gone away, at which point we
     # can commit all the changes.
     #
-    # We use rsync for our copy because it will handle things like:
-    #
-    #   rsync -a --relative four/jim four/bob <weld_root>/.weld/bases/project124
-    #
-    # and put "jim" and "bob" into <weld_root>/.weld/bases/project124/four
-    if os.path.exists(from_dir):
-        cmd = ['rsync', '-a', '--relative']
-        cmd += from_files
-        cmd += [to_dir]
-        run_silently(cmd, cwd=from_dir, verbose=verbose)
-
-    if len(from_files) >0:
-        git.add(to_dir, from_files, verbose=verbose)
+    # The copy keeps relative paths, so "four/jim" and "four/bob" end up in
+    # <to_dir>/four, creating it if need be.
+    if (stager is None) or do_commits:
+        stager = git.Stager(to_dir, verbose = verbose)
+        flush = True
+    else:
+        flush = False
+    if len(to_copy) > 0:
+        copier.copy_files(from_dir, to_dir, to_copy, verbose=verbose)
+
+        stager.stage([ os.path.join(to_dir, f) for f in to_copy ])
     if do_commits:
+        stager.flush()
         git.commit_using_message(to_dir, "Add files from %s"%from_dir, verbose=verbose)
 
     if deleted_files and do_delete_files:
-        git.rm(to_dir, list(deleted_files))
+        for f in deleted_files:
+            if os.path.lexists(os.path.join(to_dir, f)):
+                os.unlink(os.path.join(to_dir, f))
+        stager.stage([ os.path.join(to_dir, f) for f in deleted_files ])
         if do_commits: 
+            stager.flush()
             git.commit_using_message(to_dir, "Delete files no longer in %s"%from_dir)
+    if flush:
+        stager.flush()
 
 
 def escape_states(lines):
@@ -3,23 +3,26 @@ query.py - Query data from weld
 """
 
 import welded.git as git
+import welded.markers as markers
 import welded.ops as ops
-import welded.utils as utils
 import os
 
+from welded.db import PathTrie
 from welded.utils import classify_seams, GiveUp
-from welded.headers import decode_log_entry
+from welded.headers import decode_log_entry, decode_headers, decode_commit_data
+from welded.headers import header_grep_any
 
-def query_base_commits(spec, base_name):
+def query_base_commits(spec, base_name, update = True):
     # Find the last merge. This returns (None, None, []) if there wasn't one
     last_weld_merge, last_base_merge, seams = query_last_merge(spec.base_dir, base_name)
-    weld_init = git.query_init(spec.base_dir)
+    weld_init = markers.query_init(spec.base_dir)
     # Find the last push. Similar things happen if there wasn't one
     last_weld_push, last_base_push, seams = query_last_push(spec.base_dir, base_name)
     # In order to determine the HEAD of our base, we need to make sure it is
-    # there (in .weld/bases/<base-name>)
+    # there (in .weld/bases/<base-name>), unless our caller has just done so
     b = spec.query_base(base_name)
-    ops.update_base(spec, b)
+    if update:
+        ops.update_base(spec, b)
         
     base_head = ops.query_head_of_base(spec, b)
     return (last_weld_merge, last_base_merge, last_weld_push, last_base_push,
@@ -47,6 +50,79 @@ def query_base(spec, base_name):
             last_weld_merge, last_base_merge, last_weld_push, last_base_push,
             base_head, weld_init)
 
+def query_sync_points(spec, base_names, verbose = False):
+    """Find the last merge and push of each of 'base_names', and the weld init.
+
+    This walks the weld history once for all the bases together, and stops
+    as soon as every base has both a merge and a push and we have seen the
+    Init commit.
+
+    Returns ( weld_init, { base_name : ( last_weld_merge, last_base_merge,
+    last_weld_push, last_base_push ) } ), where any of the commit ids may be
+    None if there wasn't one.
+    """
+    merges = { }
+    pushes = { }
+    weld_init = None
+    wanted = set(base_names)
+    for (cid, commit_time, message) in git.iter_log_messages(spec.base_dir, None, 'HEAD',
+                                                             grep = header_grep_any(),
+                                                             verbose = verbose):
+        for verb, data in decode_headers(message):
+            if (verb == "Init"):
+                if (weld_init is None):
+                    weld_init = cid
+                continue
+            elif (verb == "Merged"):
+                found = merges
+            elif (verb == "Pushed"):
+                found = pushes
+            else:
+                continue
+            (base_name, base_cid, seams) = decode_commit_data(data)
+            if (base_name in wanted and base_name not in found):
+                found[base_name] = (cid, base_cid)
+        if (weld_init is not None and
+            len(merges) == len(wanted) and len(pushes) == len(wanted)):
+            break
+
+    if (weld_init is None):
+        raise GiveUp("Cannot find a weld init line in history")
+    result = { }
+    for base_name in base_names:
+        (last_weld_merge, last_base_merge) = merges.get(base_name, (None, None))
+        (last_weld_push, last_base_push) = pushes.get(base_name, (None, None))
+        result[base_name] = (last_weld_merge, last_base_merge,
+                             last_weld_push, last_base_push)
+    return (weld_init, result)
+
+def query_bases_sync_points(spec):
+    """Report the last merge and push for every base.
+    """
+    (weld_init, points) = query_sync_points(spec, spec.base_names())
+    for n in sorted(points.keys()):
+        (last_weld_merge, last_base_merge, last_weld_push, last_base_push) = points[n]
+        print "Base %s"%n
+        print "  last merge, weld %s"%last_weld_merge
+        print "              base %s"%last_base_merge
+        print "  last push,  weld %s"%last_weld_push
+        print "              base %s"%last_base_push
+    print "weld Init  %s"%weld_init
+
+def query_base_list(spec, base_names):
+    """
+    What is the latest commit on each of the given bases?
+    """
+    (weld_init, points) = query_sync_points(spec, base_names)
+    for n in sorted(base_names):
+        (last_weld_merge, last_base_merge, last_weld_push, last_base_push) = points[n]
+        b = spec.query_base(n)
+        ops.update_base(spec, b)
+        base_head = ops.query_head_of_base(spec, b)
+        print_sha1_ids(n,
+                last_weld_merge, last_base_merge, last_weld_push, last_base_push,
+                base_head, weld_init)
+
 def query_bases(spec):
     """Report on the bases we have, and their seams.
 
@@ -63,7 +139,7 @@ def query_seam_changes(spec, base_name):
     (commit_id, base_commit_id, seams) = query_last_merge(spec.base_dir, base_name)
     if commit_id is None:
         # There was no previous merge - fall back to changes since Init
-        commit_id = git.query_init(spec.base_dir)
+        commit_id = markers.query_init(spec.base_dir)
     b = spec.query_base(base_name)
     ( deleted_in_new, changes, added_in_new ) = classify_seams(seams, b.get_seams())
     print "Seams:"
@@ -89,7 +165,7 @@ def query_last_merge(where, base_name):
     If base 'base_name' has never been merged, then we return (None, None, []),
     and the caller will probably have to make do with the Init commit.
     """
-    commit_id = git.query_merge(where, base_name)
+    commit_id = markers.query_merge(where, base_name)
     if commit_id is None:
         return (None, None, [])
     log_entry = git.log(where, commit_id)
@@ -108,7 +184,7 @@ def query_last_push(where, base_name):
     If base 'base_name' has never been merged, then we return (None, None, []),
     and the caller will probably have to make do with the Init commit.
     """
-    commit_id = git.query_push(where, base_name)
+    commit_id = markers.query_push(where, base_name)
     if commit_id is None:
         return (None, None, [])
     log_entry = git.log(where, commit_id)
@@ -132,7 +208,7 @@ def query_last_merge_or_push(where, base_name):
 
     and the caller will probably have to make do with the Init commit.
     """
-    commit_id = git.query_merge_or_push(where, base_name)
+    commit_id = markers.query_merge_or_push(where, base_name)
     if commit_id is None:
         return (None, None, None, [])
     log_entry = git.log(where, commit_id)
@@ -157,24 +233,21 @@ def query_coverage(spec, where):
     # First, build a hash mapping directory to seam..
     DEBUG = False
 
-    dir_map = { }
+    index = spec.seam_index()
     result = [ ]
-    uncovered = { }
-    for s in spec.get_seams():
-        if DEBUG: 
-            print "Seam: %s -> %s"%(s.name, s.get_dest())
-        abs_path = os.path.realpath(os.path.join(where, s.get_dest()))
-        dir_map[abs_path] = s
+    uncovered = [ ]
+    # The uncovered directories, so we can tell when a parent already is.
+    uncovered_trie = PathTrie()
     # Now .. 
     dirs_to_walk = [ '.' ]
     while len(dirs_to_walk) > 0:
         new_to_walk = [ ]
         for d in dirs_to_walk:
-            abs_path = os.path.realpath(os.path.join(where, d))
-            if (abs_path in dir_map):
+            s = index.by_dest.exact(d)
+            if (s is not None):
                 if DEBUG:
                     print "covered: %s"%d
-                result.append( ( d, dir_map[abs_path] ) )
+                result.append( ( d, s ) )
                 continue
 
             if DEBUG:
@@ -198,15 +271,17 @@ def query_coverage(spec, where):
             if file_here:
                 # There is some actual file or other here. If a higher
                 # directory is not already uncovered, uncover us.
-                if (not utils.already_in_hash(d, uncovered)):
-                    uncovered[d] = True
+                (parent, rest) = uncovered_trie.lookup(d, strict = True)
+                if (parent is None):
+                    uncovered_trie.add(d, d)
+                    uncovered.append(d)
                     
         dirs_to_walk = new_to_walk
 
     # Cunning observation: because we do a depth-first traversal, the
     # uncovered list is already in as much of a most-general order
     # as it is convenient to present.
-    return (result,uncovered.keys())
+    return (result,uncovered)
 
 
 # End file.
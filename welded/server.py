@@ -0,0 +1,370 @@
+"""
+server.py - a resident weld, and the client that talks to it
+
+Stepping through a pull or push means running weld over and over again,
+and each run starts from scratch: Python, the weld modules, welded.xml and
+the git helpers. "weld serve" keeps all that loaded in one process,
+listening on a unix socket in .weld/state. When the socket is there,
+commands which ask for it (Command.forward - "weld look" and the verbs of
+a pull or push in progress) hand their command line to the server rather
+than running it themselves; if there's no server (or it won't take the
+command) we just run the command in-process, as ever.
+
+Each command runs in a fork of the server, so it starts from the loaded
+modules, parsed spec and running "git cat-file"s without being able to
+spoil them for the next one. Its stdout and stderr come back to the
+client as it goes, followed by its exit code.
+
+The server has no terminal, so commands which may want one are always run
+by the client: those which may edit commit messages, and anything not
+marked for forwarding - which includes everything that talks to a remote
+(and so may ask for a password).
+
+Messages in both directions are a one character kind, a four byte length
+and that many bytes of data:
+
+  client -> server:  r  JSON {"argv": [..], "cwd": .., "env": {..}}
+                     s  (stop)
+  server -> client:  o  stdout data
+                     e  stderr data
+                     x  exit code, as a decimal string
+                     d  declined - run it yourself
+"""
+
+import errno
+import json
+import os
+import select
+import socket
+import struct
+import sys
+import traceback
+
+import welded.layout as layout
+
+from welded.utils import GiveUp
+
+HEADER = '!cI'
+HEADER_SIZE = struct.calcsize(HEADER)
+
+# How often (in seconds) the server checks that its socket is still there -
+# "weld finish" and "weld abort" throw away .weld/state.
+CHECK_INTERVAL = 5.0
+
+# Set in the commands the server runs, so they don't try to forward
+# themselves back to it.
+g_in_server = False
+
+def send_frame(sock, kind, data = ''):
+    sock.sendall(struct.pack(HEADER, kind, len(data)) + data)
+
+def read_exactly(sock, nr_bytes):
+    parts = [ ]
+    while nr_bytes > 0:
+        data = sock.recv(min(nr_bytes, 65536))
+        if (len(data) == 0):
+            return None
+        parts.append(data)
+        nr_bytes -= len(data)
+    return ''.join(parts)
+
+def read_frame(sock):
+    """
+    Returns (kind, data), or (None, None) if the other end has gone away.
+    """
+    hdr = read_exactly(sock, HEADER_SIZE)
+    if hdr is None:
+        return (None, None)
+    (kind, length) = struct.unpack(HEADER, hdr)
+    data = read_exactly(sock, length)
+    if data is None:
+        return (None, None)
+    return (kind, data)
+
+def connect(weld_dir):
+    """
+    Return a socket connected to the server for 'weld_dir', or None if
+    there isn't one.
+    """
+    path = layout.server_socket(weld_dir)
+    if not os.path.exists(path):
+        return None
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except socket.error:
+        # Most likely a server which died without tidying up.
+        sock.close()
+        return None
+    return sock
+
+def forward(weld_dir, argv):
+    """
+    Run the weld command 'argv' in the server for 'weld_dir', copying its
+    output to ours. Returns its exit code, or None if there is no server
+    to run it and we should run it ourselves.
+    """
+    if g_in_server or os.environ.get('WELD_NO_SERVER'):
+        return None
+    try:
+        request = json.dumps({ 'argv' : argv,
+                               'cwd' : os.getcwd(),
+                               'env' : dict(os.environ) })
+    except UnicodeDecodeError:
+        # Something that won't go in JSON; never mind.
+        return None
+    sock = connect(weld_dir)
+    if sock is None:
+        return None
+    try:
+        send_frame(sock, 'r', request)
+        while True:
+            (kind, data) = read_frame(sock)
+            if (kind == 'o'):
+                sys.stdout.write(data)
+                sys.stdout.flush()
+            elif (kind == 'e'):
+                sys.stderr.write(data)
+                sys.stderr.flush()
+            elif (kind == 'x'):
+                return int(data)
+            elif (kind == 'd'):
+                return None
+            else:
+                raise GiveUp("Lost contact with the weld server for %s"%weld_dir)
+    except socket.error as e:
+        raise GiveUp("Lost contact with the weld server for %s - %s"%(weld_dir, e))
+    finally:
+        sock.close()
+
+def stop(weld_dir):
+    """
+    Ask the server for 'weld_dir' to stop. Returns True if there was one.
+    """
+    sock = connect(weld_dir)
+    if sock is None:
+        return False
+    try:
+        send_frame(sock, 's')
+        read_frame(sock)
+    finally:
+        sock.close()
+    return True
+
+class Server(object):
+    """
+    Runs weld commands for the weld in 'weld_dir', one at a time.
+    """
+
+    def __init__(self, weld_dir, verbose = False):
+        self.weld_dir = weld_dir
+        self.verbose = verbose
+        self.path = layout.server_socket(weld_dir)
+        self.listener = None
+
+    def listen(self):
+        import welded.ops as ops
+        if (self.listener is not None):
+            self.listener.close()
+        ops.ensure_state_dir(self.weld_dir)
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            self.listener.bind(self.path)
+        except socket.error as e:
+            raise GiveUp("Cannot listen on %s - %s"%(self.path, e))
+        os.chmod(self.path, 0600)
+        self.listener.listen(5)
+        self.listener.settimeout(CHECK_INTERVAL)
+
+    def warm_up(self):
+        """
+        Load everything a command is likely to want.
+        """
+        import importlib
+        import welded.git as git
+        import welded.parser as parser
+        for m in ('headers', 'init', 'markers', 'ops', 'pull_step', 'push_step',
+                  'push_utils', 'query', 'status', 'copier', 'statestore'):
+            importlib.import_module('welded.%s'%m)
+        # Cheap if it hasn't changed since last time.
+        spec_name = layout.spec_file(self.weld_dir)
+        weld = parser.Parser().parse(spec_name, cache_file = layout.spec_cache_file(self.weld_dir))
+        parser.keep_resident(spec_name, weld)
+        # Start the object reader for the weld itself.
+        git.rev_parse(self.weld_dir, 'HEAD')
+
+    def serve(self):
+        self.listen()
+        self.warm_up()
+        print "Serving the weld in %s on %s"%(self.weld_dir, self.path)
+        print 'Stop with "weld serve stop" (or Ctrl-C)'
+        sys.stdout.flush()
+        try:
+            while True:
+                if not os.path.exists(self.path):
+                    self.listen()
+                try:
+                    (conn, addr) = self.listener.accept()
+                except socket.timeout:
+                    continue
+                conn.settimeout(None)
+                try:
+                    if not self.handle(conn):
+                        break
+                except socket.error as e:
+                    print "weld serve: lost a client - %s"%e
+                finally:
+                    conn.close()
+                self.warm_up()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.listener.close()
+            if os.path.exists(self.path):
+                os.unlink(self.path)
+        print "weld serve: stopped"
+
+    def handle(self, conn):
+        """
+        Deal with one request. Returns False if we should stop.
+        """
+        (kind, data) = read_frame(conn)
+        if (kind == 's'):
+            send_frame(conn, 'x', '0')
+            return False
+        if (kind != 'r'):
+            return True
+        request = json.loads(data)
+        argv = [ str(a) for a in request['argv'] ]
+        if self.verbose:
+            print "> weld %s"%(' '.join(argv))
+            sys.stdout.flush()
+        if not self.takes(argv) or self.wants_terminal(argv):
+            send_frame(conn, 'd')
+            return True
+        code = self.run(conn, argv, str(request['cwd']),
+                        dict((str(k), str(v)) for (k, v) in request['env'].items()))
+        if (code != 0):
+            # It may have left a git helper half way through a reply.
+            import welded.git as git
+            git.close_cat_files(kill = True)
+        try:
+            send_frame(conn, 'x', str(code))
+        except socket.error:
+            pass
+        return True
+
+    def takes(self, argv):
+        """
+        Is 'argv' a command we are allowed to run?
+        """
+        import welded.cmdline as cmdline
+        try:
+            (opts, args) = cmdline.main_parser.parse_args(argv)
+        except SystemExit:
+            return False
+        if (len(args) < 1):
+            return False
+        # Anything that isn't a command is a verb for "weld do".
+        klass = cmdline.g_command_dict.get(args[0], cmdline.g_command_dict['do'])
+        return klass.forward
+
+    def wants_terminal(self, argv):
+        """
+        Might running 'argv' mean running an editor?
+        """
+        import welded.cmdline as cmdline
+        import welded.ops as ops
+        try:
+            (opts, args) = cmdline.main_parser.parse_args(argv)
+        except SystemExit:
+            # Let the command itself complain.
+            return False
+        if opts.edit_commit_file:
+            return True
+        try:
+            state = ops.read_state_data_with_file(self.weld_dir)
+            return bool(state.get('edit_commit_file'))
+        except Exception:
+            return False
+
+    def run(self, conn, argv, cwd, env):
+        """
+        Run 'argv' in a child, passing its output back over 'conn'.
+        Returns its exit code.
+        """
+        (out_r, out_w) = os.pipe()
+        (err_r, err_w) = os.pipe()
+        pid = os.fork()
+        if (pid == 0):
+            code = 1
+            try:
+                os.close(out_r)
+                os.close(err_r)
+                self.listener.close()
+                conn.close()
+                code = run_child(argv, cwd, env, out_w, err_w)
+            except BaseException:
+                traceback.print_exc()
+            finally:
+                os._exit(code)
+
+        os.close(out_w)
+        os.close(err_w)
+        kinds = { out_r : 'o', err_r : 'e' }
+        talking = True
+        while kinds:
+            try:
+                (ready, w, x) = select.select(kinds.keys(), [], [])
+            except select.error as e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+            for fd in ready:
+                data = os.read(fd, 65536)
+                if (len(data) == 0):
+                    os.close(fd)
+                    del kinds[fd]
+                elif talking:
+                    try:
+                        send_frame(conn, kinds[fd], data)
+                    except socket.error:
+                        # The client has gone; let the command finish anyway.
+                        talking = False
+        (pid, status) = os.waitpid(pid, 0)
+        if os.WIFEXITED(status):
+            return os.WEXITSTATUS(status)
+        return 128 + os.WTERMSIG(status)
+
+def run_child(argv, cwd, env, out_fd, err_fd):
+    """
+    In a forked server: become the weld command 'argv', as run in 'cwd'
+    with 'env', writing to 'out_fd' and 'err_fd'.
+    """
+    global g_in_server
+    g_in_server = True
+    null_fd = os.open(os.devnull, os.O_RDONLY)
+    os.dup2(null_fd, 0)
+    os.dup2(out_fd, 1)
+    os.dup2(err_fd, 2)
+    for fd in (null_fd, out_fd, err_fd):
+        os.close(fd)
+    # Unbuffered, so that our output and that of the programs we run
+    # come out in the right order.
+    sys.stdout = os.fdopen(1, 'w', 0)
+    sys.stderr = os.fdopen(2, 'w', 0)
+    os.environ.clear()
+    os.environ.update(env)
+    os.chdir(cwd)
+    sys.argv = [ 'weld' ] + argv
+    import welded.cmdline as cmdline
+    return cmdline.main(argv)
+
+def serve(weld_dir, verbose = False):
+    if connect(weld_dir) is not None:
+        raise GiveUp("There is already a weld server for %s"%weld_dir)
+    Server(weld_dir, verbose).serve()
+
+# End file.
@@ -0,0 +1,340 @@
+"""
+statestore.py - keeps the state of an operation in progress
+
+The state of a pull or push (the spec, the list of changes, the log and a
+couple of dozen small fields) lives in an SQLite database in .weld/state.
+Most fields are a row each. The big lists - LIST_FIELDS - are a row per
+entry, so that adding to the log or the commit list only writes the new
+entries.
+
+Fields are read only when asked for, and writing the state back only
+writes what has been changed. We keep track of that as we go rather than
+by comparing values: setting a field changes it; so does looking up a
+field that holds a dict or set (since it can then be changed in place);
+lists in LIST_FIELDS remember what was done to them. Any other object
+which is changed in place must be put back into the state to be saved.
+
+A generation number is bumped on every write, and the store carries a
+version so that a weld from some other era won't misread it.
+"""
+
+import os
+import sqlite3
+
+try:
+    import cPickle as pickle
+except:
+    import pickle
+
+from welded.utils import GiveUp
+
+# Bump this if the layout of the database changes.
+STORE_VERSION = 2
+
+PICKLE_PROTOCOL = 2
+
+# Fields which are lists, kept a row per entry.
+LIST_FIELDS = ( 'changes', 'commit_list', 'log', 'plan' )
+
+SCHEMA = [
+    "CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value INTEGER)",
+    # For list fields, value is NULL and the entries are in items.
+    "CREATE TABLE IF NOT EXISTS fields (name TEXT PRIMARY KEY, value BLOB)",
+    "CREATE TABLE IF NOT EXISTS items (name TEXT, pos INTEGER, value BLOB, "
+    "PRIMARY KEY (name, pos))",
+    ]
+
+def dumps(value):
+    return sqlite3.Binary(pickle.dumps(value, PICKLE_PROTOCOL))
+
+def loads(data):
+    return pickle.loads(str(data))
+
+class StateList(list):
+    """
+    A list which remembers how it has changed since it was last saved:
+    entries added at the end or the start, or anything else (in which case
+    we rewrite the lot).
+
+    Its entries are stored at positions first .. last-1; entries added at
+    the start go before 'first'.
+    """
+
+    def __init__(self, values = (), first = 0):
+        list.__init__(self, values)
+        self.first = first
+        self.nr_prepended = 0
+        self.nr_appended = 0
+        self.rewrite = True
+
+    def saved(self):
+        self.first -= self.nr_prepended
+        self.nr_prepended = 0
+        self.nr_appended = 0
+        self.rewrite = False
+
+    def changed(self):
+        return self.rewrite or self.nr_prepended > 0 or self.nr_appended > 0
+
+    def append(self, value):
+        list.append(self, value)
+        self.nr_appended += 1
+
+    def extend(self, values):
+        values = list(values)
+        list.extend(self, values)
+        self.nr_appended += len(values)
+
+    def __iadd__(self, values):
+        self.extend(values)
+        return self
+
+    def insert(self, idx, value):
+        if (idx == 0 and not self.rewrite):
+            self.nr_prepended += 1
+        else:
+            self.rewrite = True
+        list.insert(self, idx, value)
+
+    def __setslice__(self, i, j, values):
+        values = list(values)
+        if (i == 0 and j == 0):
+            self.nr_prepended += len(values)
+        else:
+            self.rewrite = True
+        list.__setslice__(self, i, j, values)
+
+    def __setitem__(self, idx, value):
+        self.rewrite = True
+        list.__setitem__(self, idx, value)
+
+    def __delitem__(self, idx):
+        self.rewrite = True
+        list.__delitem__(self, idx)
+
+    def __delslice__(self, i, j):
+        self.rewrite = True
+        list.__delslice__(self, i, j)
+
+    def pop(self, *args):
+        self.rewrite = True
+        return list.pop(self, *args)
+
+    def remove(self, value):
+        self.rewrite = True
+        list.remove(self, value)
+
+    def reverse(self):
+        self.rewrite = True
+        list.reverse(self)
+
+    def sort(self, *args, **kwargs):
+        self.rewrite = True
+        list.sort(self, *args, **kwargs)
+
+    def __reduce__(self):
+        # Pickle as a plain list.
+        return (list, (list(self),))
+
+class StateData(object):
+    """The state of an operation, as a lazily loaded dictionary.
+
+    Supports the bits of the dict interface that the steppers use. Values
+    are unpickled the first time they are looked up; flush() writes back
+    the ones which have changed (see the top of this file).
+    """
+
+    def __init__(self, db_file, initial = None):
+        self.db_file = db_file
+        # name -> value, for fields we've loaded or set.
+        self.values = { }
+        # Fields (other than lists) to write at the next flush().
+        self.dirty = set()
+        self.deleted = set()
+        self.generation = 0
+        if initial is None:
+            self.names = set(self.read_names())
+            self.replace = False
+        else:
+            # Brand new state; throw away whatever was there before.
+            self.names = set()
+            self.replace = True
+            for (k, v) in initial.items():
+                self[k] = v
+
+    def connect(self):
+        conn = sqlite3.connect(self.db_file)
+        conn.text_factory = str
+        return conn
+
+    def read_names(self):
+        if not os.path.exists(self.db_file):
+            raise GiveUp("No weld operation is in progress (no state in %s)"%self.db_file)
+        conn = self.connect()
+        try:
+            rows = conn.execute("SELECT name, value FROM meta").fetchall()
+            meta = dict(rows)
+            if meta.get('version') != STORE_VERSION:
+                raise GiveUp("State in %s was written by a different version of weld (%s, not %s)\n"
+                             "Finish or abort the operation with that weld."%
+                             (self.db_file, meta.get('version'), STORE_VERSION))
+            self.generation = meta.get('generation', 0)
+            return [ r[0] for r in conn.execute("SELECT name FROM fields") ]
+        except sqlite3.Error as e:
+            raise GiveUp("Cannot read state from %s - %s"%(self.db_file, e))
+        finally:
+            conn.close()
+
+    def load(self, name):
+        conn = self.connect()
+        try:
+            if name in LIST_FIELDS:
+                rows = conn.execute("SELECT pos, value FROM items WHERE name = ? ORDER BY pos",
+                                    (name,)).fetchall()
+            else:
+                row = conn.execute("SELECT value FROM fields WHERE name = ?", (name,)).fetchone()
+        except sqlite3.Error as e:
+            raise GiveUp("Cannot read '%s' from %s - %s"%(name, self.db_file, e))
+        finally:
+            conn.close()
+        if name in LIST_FIELDS:
+            if rows:
+                first = rows[0][0]
+            else:
+                first = 0
+            value = StateList([ loads(r[1]) for r in rows ], first)
+            value.saved()
+        else:
+            if row is None:
+                raise KeyError(name)
+            value = loads(row[0])
+        self.values[name] = value
+
+    def __contains__(self, name):
+        return name in self.names
+
+    def __iter__(self):
+        return iter(sorted(self.names))
+
+    def __len__(self):
+        return len(self.names)
+
+    def keys(self):
+        return sorted(self.names)
+
+    def __getitem__(self, name):
+        if name not in self.names:
+            raise KeyError(name)
+        if name not in self.values:
+            self.load(name)
+        value = self.values[name]
+        if isinstance(value, (dict, set)):
+            # May be changed in place, so assume it will be.
+            self.dirty.add(name)
+        return value
+
+    def __setitem__(self, name, value):
+        if name in LIST_FIELDS:
+            old = self.values.get(name)
+            if value is old:
+                return
+            if not isinstance(value, list):
+                raise GiveUp("State field '%s' must be a list, not %r"%(name, value))
+            value = StateList(value)
+        self.names.add(name)
+        self.deleted.discard(name)
+        self.dirty.add(name)
+        self.values[name] = value
+
+    def __delitem__(self, name):
+        if name not in self.names:
+            raise KeyError(name)
+        self.names.discard(name)
+        self.values.pop(name, None)
+        self.dirty.discard(name)
+        self.deleted.add(name)
+
+    def get(self, name, default = None):
+        if name in self.names:
+            return self[name]
+        return default
+
+    def setdefault(self, name, default = None):
+        if name not in self.names:
+            self[name] = default
+        return self[name]
+
+    def items(self):
+        return [ (k, self[k]) for k in self.keys() ]
+
+    def flush(self):
+        """Write whatever has changed back to the database.
+
+        Returns the number of rows written.
+        """
+        lists = [ (name, value) for (name, value) in self.values.items()
+                  if name in LIST_FIELDS and value.changed() ]
+        fields = [ name for name in self.dirty if name not in LIST_FIELDS ]
+        if not (lists or fields or self.deleted or self.replace):
+            return 0
+        nr_rows = 0
+        conn = self.connect()
+        try:
+            with conn:
+                for stmt in SCHEMA:
+                    conn.execute(stmt)
+                if self.replace:
+                    conn.execute("DELETE FROM fields")
+                    conn.execute("DELETE FROM items")
+                gone = [ (name,) for name in self.deleted ]
+                conn.executemany("DELETE FROM fields WHERE name = ?", gone)
+                conn.executemany("DELETE FROM items WHERE name = ?", gone)
+                conn.executemany("INSERT OR REPLACE INTO fields (name, value) VALUES (?, ?)",
+                                 [ (name, dumps(self.values[name])) for name in fields ])
+                nr_rows += len(fields)
+                for (name, value) in lists:
+                    nr_rows += self.write_list(conn, name, value)
+                row = conn.execute("SELECT value FROM meta WHERE name = 'generation'").fetchone()
+                self.generation = (row[0] if row else 0) + 1
+                conn.executemany("INSERT OR REPLACE INTO meta (name, value) VALUES (?, ?)",
+                                 [ ('version', STORE_VERSION),
+                                   ('generation', self.generation) ])
+        except sqlite3.Error as e:
+            raise GiveUp("Cannot write state to %s - %s"%(self.db_file, e))
+        finally:
+            conn.close()
+        for (name, value) in lists:
+            value.saved()
+        self.dirty = set()
+        self.deleted = set()
+        self.replace = False
+        return nr_rows
+
+    def write_list(self, conn, name, value):
+        conn.execute("INSERT OR REPLACE INTO fields (name, value) VALUES (?, NULL)", (name,))
+        if value.rewrite:
+            conn.execute("DELETE FROM items WHERE name = ?", (name,))
+            value.first = 0
+            value.nr_prepended = 0
+            rows = [ (name, pos, dumps(v)) for (pos, v) in enumerate(value) ]
+        else:
+            nr_old = len(value) - value.nr_prepended - value.nr_appended
+            first = value.first - value.nr_prepended
+            rows = [ (name, first + i, dumps(value[i]))
+                     for i in range(value.nr_prepended) ]
+            end = value.first + nr_old
+            rows.extend([ (name, end + i, dumps(value[value.nr_prepended + nr_old + i]))
+                          for i in range(value.nr_appended) ])
+        conn.executemany("INSERT INTO items (name, pos, value) VALUES (?, ?, ?)", rows)
+        return len(rows)
+
+def read(db_file):
+    return StateData(db_file)
+
+def write(db_file, data):
+    """Save 'data' - a StateData or a plain dict - to 'db_file'"""
+    if not (isinstance(data, StateData) and data.db_file == db_file):
+        data = StateData(db_file, initial = dict((k, data[k]) for k in data))
+    return data.flush()
+
+# End file.
@@ -1,19 +1,87 @@
 """Determine the current status of the weld.
 """
 
+import json
 import os
+import time
 
 import welded.git as git
+import welded.layout as layout
 import welded.ops as ops
+import welded.query as query
+
+from multiprocessing.pool import ThreadPool
 
 from welded.layout import pushing_dir
 
-def get_status_2(where, remote_name=None, branch_name=None, verbose=False):
+# How long (in seconds) we believe what a remote last told us about the
+# HEAD of a branch, unless told otherwise.
+REMOTE_HEAD_TTL = 60
+
+def read_remote_heads(where):
+    try:
+        with open(layout.remote_heads_cache_file(where), 'r') as f:
+            heads = json.load(f)
+    except (IOError, ValueError):
+        return { }
+    if not isinstance(heads, dict):
+        return { }
+    return heads
+
+def write_remote_heads(where, heads):
+    """
+    Save our remote heads. They're only a cache, so if we can't, never mind.
+    """
+    try:
+        ops.ensure_cache_dir(where)
+        with open(layout.remote_heads_cache_file_x(where), 'w') as f:
+            json.dump(heads, f, indent = 1, sort_keys = True)
+        os.rename(layout.remote_heads_cache_file_x(where),
+                  layout.remote_heads_cache_file(where))
+    except (IOError, OSError):
+        pass
+
+def remote_head(where, remote_name, branch_name, offline=False, ttl=None, verbose=False):
+    """Return the HEAD of 'branch_name' on 'remote_name', or None if it
+    hasn't got one.
+
+    If 'offline' is True, we go by the remote-tracking ref alone (as of
+    the last "git fetch" or "git push"). Otherwise we ask the remote,
+    unless we asked it less than 'ttl' seconds ago (REMOTE_HEAD_TTL if
+    'ttl' is None) and the remote-tracking ref hasn't moved since.
+    """
+    tracking = git.remote_tracking_head(where, remote_name, branch_name)
+    if offline:
+        if verbose:
+            print 'Offline, so going by refs/remotes/%s/%s'%(remote_name, branch_name)
+        return tracking
+
+    if ttl is None:
+        ttl = REMOTE_HEAD_TTL
+    key = '%s %s'%(remote_name, branch_name)
+    heads = read_remote_heads(where)
+    now = time.time()
+    entry = heads.get(key)
+    if (entry is not None and isinstance(entry, dict) and
+        0 <= now - entry.get('time', 0) < ttl and entry.get('tracking') == tracking):
+        if verbose:
+            print 'Asked %s about %s %ds ago'%(remote_name, branch_name, now - entry['time'])
+        return entry.get('head')
+
+    head = git.ls_remote_head(where, remote_name, branch_name, verbose=verbose)
+    heads[key] = { 'head' : head, 'tracking' : tracking, 'time' : now }
+    write_remote_heads(where, heads)
+    return head
+
+def get_status_2(where, remote_name=None, branch_name=None, verbose=False,
+                 offline=False, ttl=None):
     """Report on the weld status.
 
     - 'where' is the directory to do this all in.
     - 'remote_name' defaults to "origin".
     - 'branch_name' defaults to the current branch.
+    - 'offline' and 'ttl' say how we find out about the remote - see
+      remote_head().
 
     Returns a triple of the form:
 
@@ -44,7 +112,195 @@ def get_status_2(where, remote_name=None, branch_name=None, verbose=False):
     if branch_name is None:
         branch_name = git.current_branch(where, verbose=verbose)
 
+    head = remote_head(where, remote_name, branch_name, offline=offline, ttl=ttl,
+                       verbose=verbose)
+    if head is None:
+        if verbose:
+            print 'There is no remote, so we cannot pull or push'
+        return None, None, None
+
     should_pull, should_push = git.should_we_pull_or_push(remote_name,
-            branch_name, cwd=where, verbose=verbose)
+            branch_name, cwd=where, verbose=verbose, remote_head=head)
 
     return None, should_pull, should_push
+
+def last_fetched(where, base_name):
+    """
+    When did we last fetch into our clone of 'base_name'? Returns seconds
+    since the epoch, or None if we don't have a clone.
+    """
+    repo = layout.base_repo(where, base_name)
+    for name in ('FETCH_HEAD', 'HEAD'):
+        try:
+            return os.stat(os.path.join(repo, '.git', name)).st_mtime
+        except OSError:
+            pass
+    return None
+
+def read_base_counts(where):
+    try:
+        with open(layout.base_status_cache_file(where), 'r') as f:
+            counts = json.load(f)
+    except (IOError, ValueError):
+        return { }
+    if not isinstance(counts, dict):
+        return { }
+    return counts
+
+def write_base_counts(where, counts):
+    try:
+        ops.ensure_cache_dir(where)
+        with open(layout.base_status_cache_file_x(where), 'w') as f:
+            json.dump(counts, f, indent = 1, sort_keys = True)
+        os.rename(layout.base_status_cache_file_x(where),
+                  layout.base_status_cache_file(where))
+    except (IOError, OSError):
+        pass
+
+def get_bases_status(spec, base_names, fetch=False, jobs=None, verbose=False):
+    """Work out how far each of 'base_names' is from the weld.
+
+    For each base we count the base commits since its last sync point (the
+    last merge or push, whichever came later) - those waiting to be pulled
+    - and the weld commits since then - those waiting to be pushed - and how
+    many of each touch the base's seams.
+
+    The base's HEAD is what was last fetched into our clone in .weld/bases
+    (its FETCH_HEAD), or the clone's own HEAD if that is newer. We don't
+    change the clones - except that if 'fetch' is true, we "git fetch" into
+    each of them first. Bases are dealt with 'jobs' at a time, and the
+    counts are kept in .weld/cache until something they depend on moves.
+
+    Returns a list of dictionaries, one per base, sorted by base name.
+    """
+    where = spec.base_dir
+    base_names = sorted(base_names)
+    if jobs is None or jobs < 1:
+        jobs = min(8, max(1, len(base_names)))
+
+    if fetch:
+        # Missing clones are reported below.
+        cloned = [ n for n in base_names if last_fetched(where, n) is not None ]
+        if cloned:
+            ops.update_bases(spec, cloned, jobs = jobs, fetch = True,
+                             verbose = verbose, quiet = True)
+
+    (weld_init, points) = query.query_sync_points(spec, base_names, verbose = verbose)
+    weld_head = git.query_current_commit_id(where)
+
+    # The weld's object reader isn't safe to share between threads, so
+    # sort out which sync point is the latest before we start any.
+    syncs = { }
+    for n in base_names:
+        (last_weld_merge, last_base_merge, last_weld_push, last_base_push) = points[n]
+        candidates = [ ]
+        if last_weld_merge is not None:
+            candidates.append((git.commit_time(where, last_weld_merge), 'merge',
+                               last_weld_merge, last_base_merge))
+        if last_weld_push is not None:
+            candidates.append((git.commit_time(where, last_weld_push), 'push',
+                               last_weld_push, last_base_push))
+        if candidates:
+            syncs[n] = max(candidates)[1:]
+        else:
+            syncs[n] = (None, weld_init, None)
+
+    cached = read_base_counts(where)
+
+    def one_base(base_name):
+        (verb, weld_sync, base_sync) = syncs[base_name]
+        row = { 'name' : base_name,
+                'last_sync' : verb,
+                'weld_sync' : weld_sync,
+                'base_sync' : base_sync,
+                'base_head' : None,
+                'fetched' : last_fetched(where, base_name) }
+        if row['fetched'] is None:
+            row['error'] = 'no clone in .weld/bases - do "weld base-pull %s"'%base_name
+            return (row, None)
+        try:
+            repo = layout.base_repo(where, base_name)
+            base_head = git.query_current_commit_id(repo)
+            fetched = git.rev_parse(repo, 'FETCH_HEAD^{commit}')
+            if (fetched is not None and fetched != base_head and
+                git.is_ancestor(repo, base_head, fetched)):
+                base_head = fetched
+            row['base_head'] = base_head
+            seams = spec.query_base(base_name).get_seams()
+            sources = sorted(set(s.get_source() for s in seams))
+            dests = sorted(set(s.get_dest() for s in seams))
+            key = [ weld_head, base_head, weld_sync, base_sync, sources, dests ]
+            entry = cached.get(base_name)
+            if isinstance(entry, dict) and entry.get('key') == key:
+                counts = entry['counts']
+            elif base_sync is not None and git.rev_parse(repo, '%s^{commit}'%base_sync) is None:
+                row['error'] = 'last synced base commit %s is not in our clone'%base_sync[:10]
+                return (row, None)
+            else:
+                counts = [ git.count_commits(repo, base_sync, base_head),
+                           git.count_commits(repo, base_sync, base_head, sources),
+                           git.count_commits(where, weld_sync, weld_head),
+                           git.count_commits(where, weld_sync, weld_head, dests) ]
+            (row['behind'], row['behind_seams'],
+             row['ahead'], row['ahead_seams']) = counts
+            return (row, { 'key' : key, 'counts' : counts })
+        except Exception as e:
+            text = str(e).strip()
+            if text:
+                row['error'] = text.splitlines()[0]
+            else:
+                row['error'] = e.__class__.__name__
+            return (row, None)
+
+    if jobs > 1 and len(base_names) > 1:
+        pool = ThreadPool(jobs)
+        try:
+            results = pool.map(one_base, base_names)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = map(one_base, base_names)
+
+    rows = [ ]
+    changed = False
+    for (row, entry) in results:
+        rows.append(row)
+        if entry is not None and cached.get(row['name']) != entry:
+            cached[row['name']] = entry
+            changed = True
+    if changed:
+        write_base_counts(where, cached)
+    return rows
+
+def short_id(cid):
+    if cid is None:
+        return '-'
+    return cid[:10]
+
+def print_bases_status(rows):
+    """
+    Print the result of get_bases_status() as a table.
+    """
+    table = [ ( 'Base', 'To pull', '(seams)', 'To push', '(seams)',
+                'Last sync', 'Base HEAD' ) ]
+    errors = [ ]
+    for row in rows:
+        if 'error' in row:
+            table.append( (row['name'], '?', '', '?', '', row['last_sync'] or 'init',
+                           short_id(row['base_head'])) )
+            errors.append('%s: %s'%(row['name'], row['error']))
+            continue
+        if row['last_sync'] is None:
+            sync = 'init'
+        else:
+            sync = '%s %s'%(row['last_sync'], short_id(row['base_sync']))
+        table.append( (row['name'],
+                       str(row['behind']), '(%d)'%row['behind_seams'],
+                       str(row['ahead']), '(%d)'%row['ahead_seams'],
+                       sync, short_id(row['base_head'])) )
+    widths = [ max(len(r[i]) for r in table) for i in range(len(table[0])) ]
+    for r in table:
+        print '  '.join(r[i].ljust(widths[i]) for i in range(len(r))).rstrip()
+    for e in errors:
+        print e
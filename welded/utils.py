@@ -7,6 +7,7 @@ import sys
 import subprocess
 import hashlib
 import imp
+import importlib
 import traceback
 import getpass
 import socket
@@ -81,11 +82,15 @@ def run_to_stdout(cmd, allowFailure=False, verbose=True, cwd=None, env = None):
             raise GiveUp(str(e))
 
 
-def run_silently(cmd, allowFailure=False, verbose=True, cwd=None):
+def run_silently(cmd, allowFailure=False, verbose=True, cwd=None, input=None, env=None):
     """Runs a command and captures its output.
 
     cmd is an array in the usual way.
 
+    If input is given, it is a string which is written to the command's
+    standard input. If env is given, it is the command's environment (see
+    with_env()).
+
     If allowFailure is true, then it returns (returncode, output) where
     'output' is stdout and stderr together.
 
@@ -96,9 +101,18 @@ def run_silently(cmd, allowFailure=False, verbose=True, cwd=None):
     if (verbose):
         print "> %s"%(" ".join(cmd))
     try:
-        out = subprocess.check_output(cmd,
-                                      stderr=subprocess.STDOUT,
-                                      cwd=cwd)
+        if input is None:
+            out = subprocess.check_output(cmd,
+                                          stderr=subprocess.STDOUT,
+                                          cwd=cwd, env=env)
+        else:
+            p = subprocess.Popen(cmd, stdin=subprocess.PIPE,
+                                 stdout=subprocess.PIPE,
+                                 stderr=subprocess.STDOUT,
+                                 cwd=cwd, env=env)
+            out, err = p.communicate(input)
+            if p.returncode != 0:
+                raise subprocess.CalledProcessError(p.returncode, cmd, output=out)
         return 0, out
     except subprocess.CalledProcessError as e:
         if allowFailure:
@@ -206,26 +220,28 @@ def dynamic_load(filename, no_pyc=False):
     except Exception:
         raise GiveUp("Cannot load %s - %s"%(filename, traceback.format_exc()))
 
-def run_file(name, spec):
-    execfile(name, globals(), locals())
-
-def already_in_hash(d, hsh):
+class LazyModule(object):
     """
-    Checks to see if d or any parent of d is already in the hash hsh.
-    
-    @return True if it is, False if it isn't
+    Stands in for a module, which is imported the first time anything is
+    looked up in it. Lets us name our modules at the top of a file without
+    paying for the import until a command actually uses them.
     """
-    x = d
-    already_here = False
-    while (x != '/' and x != ''):
-        (x, lead) = os.path.split(x)
-        if (x in hsh):
-            already_here = True
-            break
-    return already_here
+    def __init__(self, name):
+        self.__dict__['_lazy_name'] = name
+        self.__dict__['_lazy_module'] = None
 
+    def __getattr__(self, attr):
+        mod = self.__dict__['_lazy_module']
+        if mod is None:
+            mod = importlib.import_module(self.__dict__['_lazy_name'])
+            self.__dict__['_lazy_module'] = mod
+        return getattr(mod, attr)
 
+    def __repr__(self):
+        return '<lazy module %s>'%self.__dict__['_lazy_name']
 
+def run_file(name, spec):
+    execfile(name, globals(), locals())
 
 # End file.
 